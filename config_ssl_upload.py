@@ -52,6 +52,11 @@ def cfg():
     max_iters_per_load = 1000 # epoch size, interval for reloading the dataset
     epochs=1
     scan_per_load = -1 # numbers of 3d scans per load for saving memory. If -1, load the entire dataset to the memory
+    dataset_cache_dir = None # directory of the on-disk cache of preprocessed scans (ManualAnnoDataset), memory-mapped on later runs, and of the CT statistics of the folds. No cache if None
+    dataset_read_workers = 1 # threads decoding and preprocessing scans concurrently when a dataset is loaded
+    dataset_img_dtype = 'float32' # type the loaded images are kept in, 'float16' halves the memory of the datasets
+    dataset_lazy_scans = 0 # if > 0, scans are decoded on first access and at most this many are kept in memory (per DataLoader worker, >= 2 keeps the support scan resident in evaluation)
+    dataset_scan_group_size = 32 # with dataset_lazy_scans in training, number of slices drawn from a scan in a row, rounded to a multiple of batch_size
     which_aug = 'sabs_aug' # standard data augmentation with intensity and geometric transforms
     input_size = (IMG_SIZE, IMG_SIZE)
     min_fg_data='100' # when training with manual annotations, indicating number of foreground pixels in a single class single slice. This empirically stablizes the training process
@@ -80,6 +85,15 @@ def cfg():
     proto_grid_size = 8 # L_H, L_W = (32, 32) / 8 = (4, 4)  in training
     feature_hw = [input_size[0]//8, input_size[0]//8] # feature map size, should couple this with backbone in future
     lora = 0
+    lora_adapter = None # path to a LoRA adapter (.pt or .safetensors, see FewShotSeg.save_adapter) applied on top of the encoder
+    merge_lora = True # in validation, merge the LoRA weights into the encoder so that inference costs the same as the base model
+    dinov2_weights = None # path to a local DINOv2 checkpoint (e.g. dinov2_vitl14_pretrain.pth). If set, the in-repo DINOv2 is used instead of torch.hub
+    max_protos = None # if set, cluster local prototype banks down to this many weighted prototypes before matching
+    native_tokens = False # for dinov2: match prototypes on the native token grid instead of upsampling it to 32x32, only the logits are upsampled
+    compare_native_tokens = False # in validation, also run the other native_tokens setting and report both Dice scores
+    coarse_resolutions = None # in validation, e.g. [224, 448]: multi-scale coarse prediction, the logits of the query at each resolution are averaged
+    torch_compile = False # in validation, torch.compile the encoders and the prototype scoring (compiled during a warm-up pass)
+    body_token_thresh = None # for dinov2: e.g. 0.05, only patches above this fraction of the image intensity range (the body) go through the ViT blocks
     use_3_slices=False
     do_cca=False
     use_edge_detector=False
@@ -102,6 +116,14 @@ def cfg():
     use_neg_points=False
     n_support=1 # num support images
     protosam_sam_ver="sam_h" # or medsam
+    sam_roi_size=None # for ProtoSAM: e.g. 512, SAM encodes a crop around the coarse prediction at this input size (multiple of 16) instead of the whole slice at 1024
+    sam_roi_margin=0.2 # for ProtoSAM with sam_roi_size: margin around the coarse prediction, fraction of its longest side
+    onnx_dir=None # for ProtoSAM on cpu: run the ALPNet and SAM image encoders with ONNX Runtime, exported to / loaded from this dir
+    int8_encoders=False # in validation, for cpu inference: dynamic int8 quantization of the encoders (ALPNet and, for ProtoSAM, SAM image encoder), validation then runs on cpu
+    int8_dir=None # with int8_encoders: the int8 encoders are saved to / loaded from this dir
+    precision="fp32" # inference autocast for ProtoSAM / ProtoMedSAM: fp32, bf16 or fp16 (fp16 falls back to bf16 on cpu)
+    model_memory_budget_mb=None # for ProtoSAM / ProtoMedSAM: keep the ALPNet and SAM image encoders within this budget, the least recently used one is offloaded to memory-mapped weights
+    offload_dir="./offload" # where offloaded model weights are written, see util/model_manager.py
     grad_accumulation_steps=1
     ttt=False
     reset_after_slice=True # for TTT, if to reset the model after finetuning on each slice
@@ -118,7 +140,12 @@ def cfg():
         'use_slice_adapter': use_slice_adapter,
         'adapter_layers': adapter_layers,
         'debug': debug,
-        'use_pos_enc': use_pos_enc
+        'use_pos_enc': use_pos_enc,
+        'max_protos': max_protos,
+        'native_tokens': native_tokens,
+        'body_token_thresh': body_token_thresh,
+        'dinov2_weights': dinov2_weights,
+        'lora_adapter': lora_adapter
     }
 
     task = {
@@ -15,8 +15,9 @@ import platform
 import json
 import re
 import cv2
-from dataloaders.common import BaseDataset, Subset
+from dataloaders.common import BaseDataset, Subset, ScanGroupedSampler
 from dataloaders.dataset_utils import*
+from dataloaders.slice_store import SliceStore, LazySliceStore
 from pdb import set_trace
 from util.utils import CircularList
 from util.consts import IMG_SIZE
@@ -38,8 +39,16 @@ class SuperpixelDataset(BaseDataset):
             fix_length:         fix the length of dataset
             exclude_list:       Labels to be excluded
             superpix_scale:     config of superpixels
+            read_workers:       (kwarg) number of threads decoding and preprocessing scans in read_dataset
+            img_dtype:          (kwarg) type the loaded images are stored in, 'float16' halves their memory
+            cache_dir:          (kwarg) directory the CT statistics are also persisted in, see save_CT_statistics
+            lazy_scans:         (kwarg) if > 0, scans are decoded on first access and at most lazy_scans of them are kept in memory.
+                                The entire split is indexed, scan_per_load is ignored. Draw with get_scan_sampler
         """
         super(SuperpixelDataset, self).__init__(base_dir)
+        self.lazy_scans = kwargs.get('lazy_scans', 0)
+        if self.lazy_scans and supervised_train:
+            raise Exception('lazy_scans cannot be used with supervised_train, slices without training labels are only known once a scan is decoded')
 
         self.img_modality = DATASET_INFO[which_dataset]['MODALITY']
         self.sep = DATASET_INFO[which_dataset]['_SEP']
@@ -84,10 +93,9 @@ class SuperpixelDataset(BaseDataset):
 
         self.info_by_scan = None
         self.img_lb_fids = self.organize_sample_fids() # information of scans of the entire fold
-        self.norm_func = get_normalize_op(self.img_modality, [ fid_pair['img_fid'] for _, fid_pair in self.img_lb_fids.items()], ct_mean=norm_mean, ct_std=norm_std)
 
         if self.is_train:
-            if scan_per_load > 0: # if the dataset is too large, only reload a subset in each sub-epoch
+            if scan_per_load > 0 and not self.lazy_scans: # if the dataset is too large, only reload a subset in each sub-epoch
                 self.pid_curr_load = np.random.choice( self.scan_ids, replace = False, size = self.scan_per_load)
             else: # load the entire set without a buffer
                 self.pid_curr_load = self.scan_ids
@@ -96,11 +104,21 @@ class SuperpixelDataset(BaseDataset):
         else:
             raise Exception
         
+        self.read_workers = kwargs.get('read_workers', 1)
+        self.img_dtype = np.dtype(kwargs.get('img_dtype', 'float32'))
+        self.cache_dir = kwargs.get('cache_dir')
+        self.scan_moments = {} # intensity moments of the decoded scans, if the CT statistics are computed by read_dataset
+        img_fids = [ fid_pair['img_fid'] for _, fid_pair in self.img_lb_fids.items()]
+        if self.img_modality == 'CT' and (norm_mean is None or norm_std is None) and not self.lazy_scans and set(map(str, self.pid_curr_load)) == set(self.img_lb_fids) and load_CT_statistics(img_fids, self.cache_dir) is None:
+            self.norm_func = None # the whole fold is decoded by read_dataset anyway, the statistics are accumulated there
+        else:
+            self.norm_func = get_normalize_op(self.img_modality, img_fids, ct_mean=norm_mean, ct_std=norm_std, num_workers=self.read_workers, cache_dir=self.cache_dir)
+
         self.use_clahe = False
         if kwargs['use_clahe']:
             self.use_clahe = True
             clip_limit = 4.0 if self.img_modality == 'MR' else 2.0
-            self.clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(7,7))
+            self.clahe = ThreadLocalCLAHE(clip_limit=clip_limit, tile_grid_size=(7,7)) # load_scan runs in read_workers threads
             
         self.actual_dataset = self.read_dataset()
         self.size = len(self.actual_dataset)
@@ -129,7 +147,7 @@ class SuperpixelDataset(BaseDataset):
         2. update self.ids_this_batch
         3. update other internel variables like __len__
         """
-        if self.scan_per_load <= 0:
+        if self.scan_per_load <= 0 or self.lazy_scans:
             print("We are not using the reload buffer, doing notiong")
             return -1
 
@@ -157,106 +175,130 @@ class SuperpixelDataset(BaseDataset):
             out_list[str(curr_id)] = curr_dict
         return out_list
 
+    def load_scan(self, scan_id, itm):
+        """
+        Decode, normalize and resize a scan and its (pseudo)labels
+        Returns:
+            image and label volumes (H x W x Z) and the meta information of the scan
+        """
+        img, _info = read_nii_bysitk(itm["img_fid"], peel_info = True) # get the meta information out
+        if self.norm_func is None:
+            self.scan_moments[itm["img_fid"]] = get_volume_moments(img)
+        # read connected graph of labels
+        if self.use_clahe:
+            # img = nself.clahe.apply(img.astype(np.uint8))
+            if self.img_modality == 'MR':
+                img = np.stack([((slice - slice.min()) / (slice.max() - slice.min())) * 255 for slice in img], axis=0)
+            img = np.stack([self.clahe.apply(slice.astype(np.uint8)) for slice in img], axis=0)
+
+        img = img.transpose(1,2,0)
+        
+        img = np.float32(img)
+        if self.norm_func is not None: # otherwise normalized by read_dataset once the statistics are known
+            img = self.norm_func(img)
+
+        if self.supervised_train:
+            lb = read_nii_bysitk(itm["gt_lbs_fid"])
+        else:
+            lb = read_nii_bysitk(itm["lbs_fid"])
+        lb = lb.transpose(1,2,0)
+        lb = np.int32(lb)
+
+        # resize img and lb to self.image_size
+        img = cv2.resize(img, (self.image_size, self.image_size), interpolation=cv2.INTER_LINEAR)
+        lb = cv2.resize(lb, (self.image_size, self.image_size), interpolation=cv2.INTER_NEAREST)
+         
+        # format of slices: [axial_H x axial_W x Z]
+        if self.supervised_train:
+            # remove all images that dont have the training labels
+            del_indices = [i for i in range(img.shape[-1]) if not np.any(np.isin(lb[..., i], self.train_list))]
+            # create an new img and lb without indices in del_indices
+            new_img = img[..., ~np.isin(np.arange(img.shape[-1]), del_indices)]
+            new_lb = lb[..., ~np.isin(np.arange(lb.shape[-1]), del_indices)]
+                    
+            img = new_img
+            lb = new_lb
+
+        return img, lb, _info
+
+    def load_scan_volumes(self, scan_id):
+        """
+        Image and label volumes of a scan, for the lazy slice store
+        """
+        img, lb, _ = self.load_scan(scan_id, self.img_lb_fids[scan_id])
+        return img, lb
+
+    def read_lazy_dataset(self, scans):
+        """
+        Index the slices of the scans from the image headers without loading them, see LazySliceStore
+        sup_max_cls needs the labels, it is taken from the slice in __getitem__ instead
+        """
+        out_store = LazySliceStore(self.load_scan_volumes, self.lazy_scans, img_dtype = self.img_dtype, img_out_dtype = np.float32, lb_out_dtype = np.int32)
+        for scan_id, itm in scans:
+            _info = read_nii_info(itm["img_fid"])
+            self.info_by_scan[scan_id] = _info
+
+            nframes = _info["array_size"][0]
+            glb_idx = out_store.add_lazy_scan(scan_id, nframes, nframe = np.full(nframes, nframes))
+            self.scan_z_idx[scan_id] = range(glb_idx, glb_idx + nframes)
+
+        print(f'###### Dataset: {len(out_store)} slices indexed, scans loaded on access, at most {self.lazy_scans} at a time ######')
+        return out_store
+
+    def get_scan_sampler(self, group_size, num_samples = None):
+        """
+        Sampler drawing group_size slices of a scan in a row, to use with lazy_scans
+        """
+        return ScanGroupedSampler(self.scan_z_idx, num_samples or len(self), group_size)
+
+    def normalize_loaded_scans(self, scans, loaded_scans):
+        """
+        Finish the single-pass CT statistics: merge the moments load_scan recorded while decoding the fold, persist
+        them, and normalize the loaded scans in place. The normalization is affine, so applying it after resizing is equivalent
+        """
+        img_fids = [itm['img_fid'] for _, itm in scans]
+        moments = merge_moments(self.scan_moments)
+        self.scan_moments = {}
+        save_CT_statistics(img_fids, moments, self.cache_dir)
+        self.norm_func = get_normalize_op(self.img_modality, img_fids, ct_mean=moments.mean, ct_std=moments.std)
+        for img, _, _ in loaded_scans:
+            img[...] = self.norm_func(img)
+
     def read_dataset(self):
         """
         Read images into memory and store them in 2D
         Build tables for the position of an individual 2D slice in the entire dataset
         """
-        out_list = []
+        out_store = SliceStore(img_dtype = self.img_dtype, img_out_dtype = np.float32, lb_out_dtype = np.int32)
         self.scan_z_idx = {}
         self.info_by_scan = {} # meta data of each scan
-        glb_idx = 0 # global index of a certain slice in a certain scan in entire dataset
 
-        for scan_id, itm in self.img_lb_fids.items():
-            if scan_id not in self.pid_curr_load:
-                continue
+        # decode the scans concurrently, the slice index is still built in scan order
+        scans = [(scan_id, itm) for scan_id, itm in self.img_lb_fids.items() if scan_id in self.pid_curr_load]
+        if self.lazy_scans:
+            return self.read_lazy_dataset(scans)
 
-            img, _info = read_nii_bysitk(itm["img_fid"], peel_info = True) # get the meta information out
-            # read connected graph of labels
-            if self.use_clahe:
-                # img = nself.clahe.apply(img.astype(np.uint8))
-                if self.img_modality == 'MR':
-                    img = np.stack([((slice - slice.min()) / (slice.max() - slice.min())) * 255 for slice in img], axis=0)
-                img = np.stack([self.clahe.apply(slice.astype(np.uint8)) for slice in img], axis=0)
+        loaded_scans = parallel_map(lambda scan: self.load_scan(*scan), scans, self.read_workers)
+        if self.norm_func is None:
+            self.normalize_loaded_scans(scans, loaded_scans)
 
-            img = img.transpose(1,2,0)
-            self.info_by_scan[scan_id] = _info
-            
-            img = np.float32(img)
-            img = self.norm_func(img)
-            self.scan_z_idx[scan_id] = [-1 for _ in range(img.shape[-1])]
-
-            if self.supervised_train:
-                lb = read_nii_bysitk(itm["gt_lbs_fid"])
-            else:
-                lb = read_nii_bysitk(itm["lbs_fid"])
-            lb = lb.transpose(1,2,0)
-            lb = np.int32(lb)
+        for ii, (scan_id, itm) in enumerate(scans):
+            img, lb, _info = loaded_scans[ii]
+            loaded_scans[ii] = None # the store keeps its own copy
 
-            # resize img and lb to self.image_size
-            img = cv2.resize(img, (self.image_size, self.image_size), interpolation=cv2.INTER_LINEAR)
-            lb = cv2.resize(lb, (self.image_size, self.image_size), interpolation=cv2.INTER_NEAREST)
-             
-            # format of slices: [axial_H x axial_W x Z]
-            if self.supervised_train:
-                # remove all images that dont have the training labels
-                del_indices = [i for i in range(img.shape[-1]) if not np.any(np.isin(lb[..., i], self.train_list))]
-                # create an new img and lb without indices in del_indices
-                new_img = np.zeros((img.shape[0], img.shape[1], img.shape[2] - len(del_indices)))
-                new_lb = np.zeros((lb.shape[0], lb.shape[1], lb.shape[2] - len(del_indices)))
-                new_img = img[..., ~np.isin(np.arange(img.shape[-1]), del_indices)]
-                new_lb = lb[..., ~np.isin(np.arange(lb.shape[-1]), del_indices)]
-                        
-                img = new_img
-                lb = new_lb
-                a = [i for i in range(img.shape[-1]) if lb[...,i].max() == 0]
+            self.info_by_scan[scan_id] = _info
 
             nframes = img.shape[-1]
             assert img.shape[-1] == lb.shape[-1]
-            base_idx = img.shape[-1] // 2 # index of the middle slice
-
-            # re-organize 3D images into 2D slices and record essential information for each slice
-            out_list.append( {"img": img[..., 0: 1],
-                           "lb":lb[..., 0: 0 + 1],
-                           "sup_max_cls": lb[..., 0: 0 + 1].max(),
-                           "is_start": True,
-                           "is_end": False,
-                           "nframe": nframes,
-                           "scan_id": scan_id,
-                           "z_id":0,
-                           })
-
-            self.scan_z_idx[scan_id][0] = glb_idx
-            glb_idx += 1
-
-            for ii in range(1, img.shape[-1] - 1):
-                out_list.append( {"img": img[..., ii: ii + 1],
-                           "lb":lb[..., ii: ii + 1],
-                           "is_start": False,
-                           "is_end": False,
-                           "sup_max_cls": lb[..., ii: ii + 1].max(),
-                           "nframe": nframes,
-                           "scan_id": scan_id,
-                           "z_id": ii,
-                           })
-                self.scan_z_idx[scan_id][ii] = glb_idx
-                glb_idx += 1
-
-            ii += 1 # last slice of a 3D volume
-            out_list.append( {"img": img[..., ii: ii + 1],
-                           "lb":lb[..., ii: ii+ 1],
-                           "is_start": False,
-                            "is_end": True,
-                           "sup_max_cls": lb[..., ii: ii + 1].max(),
-                           "nframe": nframes,
-                           "scan_id": scan_id,
-                           "z_id": ii,
-                           })
-
-            self.scan_z_idx[scan_id][ii] = glb_idx
-            glb_idx += 1
 
-        return out_list
+            # 3D images are stored as volumes, with the essential information for each slice
+            glb_idx = out_store.add_scan(scan_id, img, lb,
+                                         nframe = np.full(nframes, nframes),
+                                         sup_max_cls = lb.max(axis = (0, 1)))
+            self.scan_z_idx[scan_id] = range(glb_idx, glb_idx + nframes)
+
+        print(f'###### Dataset: {len(out_store)} slices loaded, {out_store.nbytes() / 1024 ** 2:.0f} MB ######')
+        return out_store
 
     def read_classfiles(self):
         """
@@ -315,7 +357,7 @@ class SuperpixelDataset(BaseDataset):
     def __getitem__(self, index):
         index = index % len(self.actual_dataset)
         curr_dict = self.actual_dataset[index]
-        sup_max_cls = curr_dict['sup_max_cls']
+        sup_max_cls = curr_dict['sup_max_cls'] if 'sup_max_cls' in curr_dict else curr_dict['lb'].max() # not indexed for lazily loaded scans
         if sup_max_cls < 1:
             return self.__getitem__(index + 1)
 
@@ -14,9 +14,11 @@ import platform
 import json
 import re
 import cv2
-from dataloaders.common import BaseDataset, Subset, ValidationDataset
+from dataloaders.common import BaseDataset, Subset, ValidationDataset, ScanGroupedSampler
 # from common import BaseDataset, Subset
 from dataloaders.dataset_utils import*
+from dataloaders.slice_cache import SliceCache, describe_normalize_op
+from dataloaders.slice_store import SliceStore, LazySliceStore
 from pdb import set_trace
 from util.utils import CircularList
 from util.consts import IMG_SIZE
@@ -41,6 +43,11 @@ class ManualAnnoDataset(BaseDataset):
             fix_length:         fix the length of dataset
             exclude_list:       Labels to be excluded
             extern_normalize_function:  normalization function used for data pre-processing  
+            cache_dir:          (kwarg) directory of the preprocessed slice cache, see slice_cache.py, and of the CT statistics. No cache if not given
+            read_workers:       (kwarg) number of threads decoding and preprocessing scans in read_dataset
+            img_dtype:          (kwarg) type the loaded images are stored in, 'float16' halves their memory
+            lazy_scans:         (kwarg) if > 0, scans are decoded on first access and at most lazy_scans of them are kept in memory.
+                                The entire split is indexed, scan_per_load is ignored
         """
         super(ManualAnnoDataset, self).__init__(base_dir)
         self.img_modality = DATASET_INFO[which_dataset]['MODALITY']
@@ -63,7 +70,7 @@ class ManualAnnoDataset(BaseDataset):
         else:
             self.use_clahe = kwargs['use_clahe']
         if self.use_clahe:
-            self.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(7,7))
+            self.clahe = ThreadLocalCLAHE(clip_limit=2.0, tile_grid_size=(7,7)) # load_scan runs in read_workers threads
            
         self.use_3_slices = kwargs["use_3_slices"] if 'use_3_slices' in kwargs else False 
         if self.use_3_slices:
@@ -86,15 +93,15 @@ class ManualAnnoDataset(BaseDataset):
         self.info_by_scan = None
         self.img_lb_fids = self.organize_sample_fids() # information of scans of the entire fold
 
-        if extern_normalize_func is not None: # helps to keep consistent between training and testing dataset.
-            self.norm_func = extern_normalize_func
-            print(f'###### Dataset: using external normalization statistics ######')
-        else:
-            self.norm_func = get_normalize_op(self.img_modality, [ fid_pair['img_fid'] for _, fid_pair in self.img_lb_fids.items()])
-            print(f'###### Dataset: using normalization statistics calculated from loaded data ######')
+        self.which_dataset = which_dataset
+        self.read_workers = kwargs.get('read_workers', 1)
+        self.img_dtype = np.dtype(kwargs.get('img_dtype', 'float32'))
+        self.lazy_scans = kwargs.get('lazy_scans', 0)
+        self.cache_dir = kwargs.get('cache_dir')
+        self.cache = None
 
         if self.is_train:
-            if scan_per_load > 0: # buffer needed
+            if scan_per_load > 0 and not self.lazy_scans: # buffer needed
                 self.pid_curr_load = np.random.choice( self.scan_ids, replace = False, size = self.scan_per_load)
             else: # load the entire set without a buffer
                 self.pid_curr_load = self.scan_ids
@@ -103,11 +110,38 @@ class ManualAnnoDataset(BaseDataset):
             self.potential_support_sid = []
         else:
             raise Exception
+
+        self.scan_moments = {} # intensity moments of the decoded scans, if the CT statistics are computed by read_dataset
+        if extern_normalize_func is not None: # helps to keep consistent between training and testing dataset.
+            self.set_normalize_op(extern_normalize_func)
+            print(f'###### Dataset: using external normalization statistics ######')
+        else:
+            img_fids = [ fid_pair['img_fid'] for _, fid_pair in self.img_lb_fids.items()]
+            if self.img_modality == 'CT' and not self.lazy_scans and set(map(str, self.pid_curr_load)) == set(self.img_lb_fids) and load_CT_statistics(img_fids, self.cache_dir) is None:
+                self.norm_func = None # the whole fold is decoded by read_dataset anyway, the statistics are accumulated there
+            else:
+                self.set_normalize_op(get_normalize_op(self.img_modality, img_fids, num_workers = self.read_workers, cache_dir = self.cache_dir))
+            print(f'###### Dataset: using normalization statistics calculated from loaded data ######')
+
         self.actual_dataset = self.read_dataset()
         self.size = len(self.actual_dataset)
         self.overall_slice_by_cls = self.read_classfiles()
         self.update_subclass_lookup()
 
+    def set_normalize_op(self, norm_func):
+        """
+        Set the normalization function, and open the slice cache of the preprocessing it belongs to
+        """
+        self.norm_func = norm_func
+        if self.cache_dir:
+            self.cache = SliceCache(self.cache_dir, self.which_dataset, {
+                'base_dir': os.path.abspath(self.base_dir),
+                'image_size': self.image_size,
+                'use_clahe': self.use_clahe,
+                'normalize': describe_normalize_op(self.norm_func),
+                'img_dtype': self.img_dtype.name,
+            })
+
     def get_scanids(self, mode, idx_split):
         val_ids  = copy.deepcopy(self.img_pids[self.sep[idx_split]: self.sep[idx_split + 1] + self.nsup])
         self.potential_support_sid = val_ids[-self.nsup:] # this is actual file scan id, not index
@@ -123,7 +157,7 @@ class ManualAnnoDataset(BaseDataset):
         2. update self.ids_this_batch
         3. update other internel variables like __len__
         """
-        if self.scan_per_load <= 0:
+        if self.scan_per_load <= 0 or self.lazy_scans:
             print("We are not using the reload buffer, doing notiong")
             return -1
 
@@ -148,83 +182,127 @@ class ManualAnnoDataset(BaseDataset):
             out_list[str(curr_id)] = curr_dict
         return out_list
 
-    def read_dataset(self):
+    def load_scan(self, scan_id, itm):
         """
-        Build index pointers to individual slices
-        Also keep a look-up table from scan_id, slice to index
+        Decode, normalize and resize a scan, or open its preprocessed volumes from the cache
+        Returns:
+            image and label volumes (H x W x Z) and the meta information of the scan
         """
-        out_list = []
-        self.scan_z_idx = {}
-        self.info_by_scan = {} # meta data of each scan
-        glb_idx = 0 # global index of a certain slice in a certain scan in entire dataset
+        source_fids = [itm["img_fid"], itm["lbs_fid"]]
+        if self.cache is not None and self.cache.has(scan_id, source_fids):
+            return self.cache.load(scan_id)
+
+        img, _info = read_nii_bysitk(itm["img_fid"], peel_info = True) # get the meta information out
+        if self.norm_func is None:
+            self.scan_moments[itm["img_fid"]] = get_volume_moments(img)
+
+        img = img.transpose(1,2,0)
+
+        if self.use_clahe:
+            img = np.stack([self.clahe.apply(slice.astype(np.uint8)) for slice in img], axis=0)
+        
+        img = np.float32(img)
+        if self.norm_func is not None: # otherwise normalized by read_dataset once the statistics are known
+            img = self.norm_func(img)
+
+        lb = read_nii_bysitk(itm["lbs_fid"])
+        lb = lb.transpose(1,2,0)
+
+        lb = np.float32(lb)
 
-        for scan_id, itm in self.img_lb_fids.items():
-            if scan_id not in self.pid_curr_load:
-                continue
+        img = cv2.resize(img, (self.image_size, self.image_size), interpolation=cv2.INTER_LINEAR)
+        lb = cv2.resize(lb, (self.image_size, self.image_size), interpolation=cv2.INTER_NEAREST)
 
-            img, _info = read_nii_bysitk(itm["img_fid"], peel_info = True) # get the meta information out
+        if self.cache is not None:
+            self.cache.save(scan_id, img, lb, _info, source_fids)
+        return img, lb, _info
 
-            img = img.transpose(1,2,0)
+    def load_scan_volumes(self, scan_id):
+        """
+        Image and label volumes of a scan, for the lazy slice store
+        """
+        img, lb, _ = self.load_scan(scan_id, self.img_lb_fids[scan_id])
+        return img, lb
 
+    def get_scan_info(self, scan_id, itm):
+        """
+        Meta information of a scan without decoding it, from the slice cache or from the header of the image
+        """
+        if self.cache is not None and self.cache.has(scan_id, [itm["img_fid"], itm["lbs_fid"]]):
+            return self.cache.index['scans'][str(scan_id)]['info']
+        return read_nii_info(itm["img_fid"])
+
+    def read_lazy_dataset(self, scans):
+        """
+        Index the slices of the scans without loading them, see LazySliceStore
+        """
+        out_store = LazySliceStore(self.load_scan_volumes, self.lazy_scans, img_dtype = self.img_dtype, img_out_dtype = np.float32, lb_out_dtype = np.float32)
+        for scan_id, itm in scans:
+            _info = self.get_scan_info(scan_id, itm)
             self.info_by_scan[scan_id] = _info
 
-            if self.use_clahe:
-                img = np.stack([self.clahe.apply(slice.astype(np.uint8)) for slice in img], axis=0)
-            
-            img = np.float32(img)
-            img = self.norm_func(img)
+            nframe = _info["array_size"][0]
+            # the number of frames is only written in the beginning frame
+            glb_idx = out_store.add_lazy_scan(scan_id, nframe, nframe = np.where(np.arange(nframe) == 0, nframe, -1))
+            self.scan_z_idx[scan_id] = range(glb_idx, glb_idx + nframe)
+
+        print(f'###### Dataset: {len(out_store)} slices indexed, scans loaded on access, at most {self.lazy_scans} at a time ######')
+        return out_store
+
+    def get_scan_sampler(self, group_size, num_samples = None):
+        """
+        Sampler drawing group_size slices of a scan in a row, to use with lazy_scans
+        """
+        return ScanGroupedSampler(self.scan_z_idx, num_samples or len(self), group_size)
+
+    def normalize_loaded_scans(self, scans, loaded_scans):
+        """
+        Finish the single-pass CT statistics: merge the moments load_scan recorded while decoding the fold, persist
+        them, and normalize the loaded scans in place. The normalization is affine, so applying it after resizing is equivalent
+        """
+        img_fids = [itm['img_fid'] for _, itm in scans]
+        moments = merge_moments(self.scan_moments)
+        self.scan_moments = {}
+        save_CT_statistics(img_fids, moments, self.cache_dir)
+        self.set_normalize_op(get_normalize_op(self.img_modality, img_fids, ct_mean = moments.mean, ct_std = moments.std))
+        for (scan_id, itm), (img, lb, _info) in zip(scans, loaded_scans):
+            img[...] = self.norm_func(img)
+            if self.cache is not None:
+                self.cache.save(scan_id, img, lb, _info, [itm["img_fid"], itm["lbs_fid"]])
+
+    def read_dataset(self):
+        """
+        Build index pointers to individual slices
+        Also keep a look-up table from scan_id, slice to index
+        """
+        out_store = SliceStore(img_dtype = self.img_dtype, img_out_dtype = np.float32, lb_out_dtype = np.float32)
+        self.scan_z_idx = {}
+        self.info_by_scan = {} # meta data of each scan
 
-            self.scan_z_idx[scan_id] = [-1 for _ in range(img.shape[-1])]
+        # decode the scans concurrently, the slice index is still built in scan order
+        scans = [(scan_id, itm) for scan_id, itm in self.img_lb_fids.items() if scan_id in self.pid_curr_load]
+        if self.lazy_scans:
+            return self.read_lazy_dataset(scans)
 
-            lb = read_nii_bysitk(itm["lbs_fid"])
-            lb = lb.transpose(1,2,0)
+        loaded_scans = parallel_map(lambda scan: self.load_scan(*scan), scans, self.read_workers)
+        if self.norm_func is None:
+            self.normalize_loaded_scans(scans, loaded_scans)
 
-            lb = np.float32(lb)
+        for ii, (scan_id, itm) in enumerate(scans):
+            img, lb, _info = loaded_scans[ii]
+            loaded_scans[ii] = None # the store keeps its own copy
 
-            img = cv2.resize(img, (self.image_size, self.image_size), interpolation=cv2.INTER_LINEAR)
-            lb = cv2.resize(lb, (self.image_size, self.image_size), interpolation=cv2.INTER_NEAREST)
+            self.info_by_scan[scan_id] = _info
 
             assert img.shape[-1] == lb.shape[-1]
-            base_idx = img.shape[-1] // 2 # index of the middle slice
-
-            # write the beginning frame
-            out_list.append( {"img": img[..., 0: 1],
-                           "lb":lb[..., 0: 0 + 1],
-                           "is_start": True,
-                           "is_end": False,
-                           "nframe": img.shape[-1],
-                           "scan_id": scan_id,
-                           "z_id":0})
-
-            self.scan_z_idx[scan_id][0] = glb_idx
-            glb_idx += 1
-
-            for ii in range(1, img.shape[-1] - 1):
-                out_list.append( {"img": img[..., ii: ii + 1],
-                           "lb":lb[..., ii: ii + 1],
-                           "is_start": False,
-                           "is_end": False,
-                           "nframe": -1,
-                           "scan_id": scan_id,
-                           "z_id": ii
-                           })
-                self.scan_z_idx[scan_id][ii] = glb_idx
-                glb_idx += 1
-
-            ii += 1 # last frame, note the is_end flag
-            out_list.append( {"img": img[..., ii: ii + 1],
-                           "lb":lb[..., ii: ii+ 1],
-                           "is_start": False,
-                           "is_end": True,
-                           "nframe": -1,
-                           "scan_id": scan_id,
-                           "z_id": ii
-                           })
-
-            self.scan_z_idx[scan_id][ii] = glb_idx
-            glb_idx += 1
+            nframe = img.shape[-1]
 
-        return out_list
+            # the number of frames is only written in the beginning frame
+            glb_idx = out_store.add_scan(scan_id, img, lb, nframe = np.where(np.arange(nframe) == 0, nframe, -1))
+            self.scan_z_idx[scan_id] = range(glb_idx, glb_idx + nframe)
+
+        print(f'###### Dataset: {len(out_store)} slices loaded, {out_store.nbytes() / 1024 ** 2:.0f} MB ######')
+        return out_store
 
     def read_classfiles(self):
         with open(   os.path.join(self.base_dir, f'.classmap_{self.min_fg}.json') , 'r' ) as fopen:
@@ -249,14 +327,11 @@ class ManualAnnoDataset(BaseDataset):
     def __get_ct_scan___(self, index):
         scan_n = index % len(self.scan_z_idx)
         scan_id = list(self.scan_z_idx.keys())[scan_n]
-        scan_slices = self.scan_z_idx[scan_id]
-        
-        scan_imgs = np.concatenate([self.actual_dataset[_idx]["img"] for _idx in scan_slices], axis = -1).transpose(2, 0, 1)
         
-        scan_lbs = np.concatenate([self.actual_dataset[_idx]["lb"] for _idx in scan_slices], axis = -1).transpose(2, 0, 1)
+        scan_imgs, scan_lbs = self.actual_dataset.get_volume(scan_id) # D x H x W, no copy
         
-        scan_imgs = np.float32(scan_imgs)
-        scan_lbs  = np.float32(scan_lbs)
+        scan_imgs = np.asarray(scan_imgs, dtype = np.float32)
+        scan_lbs  = np.asarray(scan_lbs, dtype = np.float32)
         
         scan_imgs = torch.from_numpy(scan_imgs).unsqueeze(0)
         scan_lbs = torch.from_numpy(scan_lbs)
@@ -547,10 +622,9 @@ class ManualAnnoDataset(BaseDataset):
     def get_support_scan(self, curr_class: int, class_idx: list, scan_idx: list):
         self.potential_support_sid = [self.pid_curr_load[ii] for ii in scan_idx ]
         # print(f'###### Using {len(scan_idx)} shot evaluation!')
-        scan_slices = self.scan_z_idx[self.potential_support_sid[0]]
-        scan_imgs = np.concatenate([self.actual_dataset[_idx]["img"] for _idx in scan_slices], axis = -1).transpose(2, 0, 1)
+        scan_imgs, scan_lbs = self.actual_dataset.get_volume(self.potential_support_sid[0])
         
-        scan_lbs = np.concatenate([self.actual_dataset[_idx]["lb"] for _idx in scan_slices], axis = -1).transpose(2, 0, 1)
+        scan_lbs = np.array(scan_lbs, dtype = np.float32) # copy, the stored labels must not be binarized
         # binarize the labels
         scan_lbs[scan_lbs != curr_class] = 0
         scan_lbs[scan_lbs == curr_class] = 1
@@ -745,6 +819,10 @@ def get_nii_dataset(config, image_size, **kwargs):
                                     nsup = config["task"]["n_shots"],
                                     fix_length=None,
                                     image_size=image_size,
+                                    cache_dir=config.get("dataset_cache_dir"),
+                                    read_workers=config.get("dataset_read_workers", 1),
+                                    img_dtype=config.get("dataset_img_dtype", "float32"),
+                                    lazy_scans=config.get("dataset_lazy_scans", 0),
                                     # extern_normalize_func=norm_func
                                     **kwargs)
     
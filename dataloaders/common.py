@@ -5,7 +5,7 @@ Extended from vanilla PANet code by Wang et al.
 import random
 import torch
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 class BaseDataset(Dataset):
     """
@@ -181,6 +181,44 @@ class Subset(Dataset):
     def __len__(self):
         return len(self.indices)
 
+class ScanGroupedSampler(Sampler):
+    """
+    Random slice order in which consecutive draws come from the same scan, group_size of them at a time
+    Keeps the hit rate of lazily loaded scans high. With DataLoader workers, take group_size as a multiple of the batch
+    size so that each batch, and so each worker, stays on one scan
+    Args:
+        scan_z_idx:     scan_id -> global indices of the slices of the scan
+        num_samples:    number of draws per epoch
+        group_size:     number of consecutive draws from a scan
+    """
+    def __init__(self, scan_z_idx, num_samples, group_size):
+        self.scan_z_idx = scan_z_idx
+        self.num_samples = num_samples
+        self.group_size = group_size
+
+    def get_groups(self):
+        groups = []
+        for slices in self.scan_z_idx.values():
+            perm = torch.randperm(len(slices)).tolist()
+            groups += [[slices[ii] for ii in perm[start: start + self.group_size]] for start in range(0, len(perm), self.group_size)]
+        return [groups[ii] for ii in torch.randperm(len(groups)).tolist()]
+
+    def __iter__(self):
+        n_drawn = 0
+        while n_drawn < self.num_samples:
+            groups = self.get_groups()
+            if len(groups) == 0:
+                return
+            for group in groups:
+                group = group[: self.num_samples - n_drawn]
+                yield from group
+                n_drawn += len(group)
+                if n_drawn >= self.num_samples:
+                    return
+
+    def __len__(self):
+        return self.num_samples
+
 class ValidationDataset(Dataset):
     """
     Dataset for validation
@@ -2,7 +2,13 @@
 Utils for datasets
 """
 import functools
+import hashlib
+import json
+import threading
+import warnings
+import cv2
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 import os
 import sys
@@ -11,6 +17,8 @@ import numpy as np
 import pdb
 import SimpleITK as sitk
 
+from dataloaders.slice_cache import get_file_signature
+
 DATASET_INFO = {
     "CHAOST2": {
             'PSEU_LABEL_NAME': ["BGD", "SUPFG"],
@@ -72,31 +80,178 @@ def read_nii_bysitk(input_fid, peel_info = False):
     else:
         return img_np
 
+def read_nii_info(input_fid):
+    """
+    The information read_nii_bysitk(peel_info = True) takes out, from the header only without decoding the image
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(input_fid)
+    reader.ReadImageInformation()
+    return {
+            "spacing": reader.GetSpacing(),
+            "origin": reader.GetOrigin(),
+            "direction": reader.GetDirection(),
+            "array_size": tuple(reversed(reader.GetSize())) # numpy order, z first
+            }
+
         
-def get_CT_statistics(scan_fids):
+def parallel_map(fn, items, num_workers=1):
+    """
+    [fn(item) for item in items] on a pool of num_workers threads, results in the order of items.
+    The heavy parts of loading a scan (SimpleITK decoding, numpy, cv2 resizing and CLAHE) run outside the GIL,
+    and threads share the decoded arrays without pickling them back as a process pool would
+    """
+    items = list(items)
+    if num_workers is None or num_workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(num_workers, len(items))) as pool:
+        return list(pool.map(fn, items))
+
+class ThreadLocalCLAHE:
+    """
+    cv2.CLAHE for scans loaded in parallel_map threads: a cv2.CLAHE object keeps per-call state and is not
+    thread safe, each thread gets its own, created on its first apply
+    """
+    def __init__(self, clip_limit, tile_grid_size=(7, 7)):
+        self.clip_limit = clip_limit
+        self.tile_grid_size = tile_grid_size
+        self.local = threading.local()
+
+    def apply(self, img):
+        clahe = getattr(self.local, 'clahe', None)
+        if clahe is None:
+            clahe = self.local.clahe = cv2.createCLAHE(clipLimit=self.clip_limit, tileGridSize=self.tile_grid_size)
+        return clahe.apply(img)
+
+CT_STATS_FILE = 'ct_statistics.json' # persisted CT statistics of the folds, in the cache directory and next to the scans
+
+class RunningMoments:
+    """
+    Streaming count, mean and sum of squared deviations (M2) of intensities
+    Chunks are merged with the pairwise update of Chan et al., which is numerically stable and lets moments
+    of different scans be computed independently (e.g. in different threads) and combined afterwards
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, x):
+        chunk = RunningMoments()
+        x = np.asarray(x, dtype=np.float64).ravel()
+        chunk.count = x.size
+        if chunk.count > 0:
+            chunk.mean = float(x.mean())
+            chunk.m2 = float(np.sum((x - chunk.mean) ** 2))
+        return self.merge(chunk)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if other.count == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def std(self):
+        return (self.m2 / self.count) ** 0.5
+
+def get_volume_moments(img):
+    """
+    Moments of a volume, accumulated slice by slice so that only one slice at a time is converted to float64
+    """
+    moments = RunningMoments()
+    for slice in img:
+        moments.update(slice)
+    return moments
+
+def merge_moments(moments_by_fid):
+    """
+    Merge per-scan moments in the order of the file names, so the result does not depend on the loading order
+    """
+    moments = RunningMoments()
+    for fid in sorted(moments_by_fid):
+        moments.merge(moments_by_fid[fid])
+    return moments
+
+def get_CT_statistics_key(scan_fids):
+    """
+    Key of a fold in CT_STATS_FILE: its scans, and their size and modification time
+    """
+    sources = [[os.path.basename(fid)] + get_file_signature(fid) for fid in sorted(scan_fids)]
+    return hashlib.sha1(json.dumps(sources).encode()).hexdigest()
+
+def get_CT_statistics_fids(scan_fids, cache_dir=None):
+    """
+    Locations of CT_STATS_FILE, in the order they are read: the cache directory if given, then next to the scans
+    """
+    stats_fids = [os.path.join(os.path.dirname(scan_fids[0]), CT_STATS_FILE)]
+    if cache_dir:
+        stats_fids.insert(0, os.path.join(cache_dir, CT_STATS_FILE))
+    return stats_fids
+
+def load_CT_statistics(scan_fids, cache_dir=None):
+    """
+    Persisted (mean, std) of the scans, None if they were never computed or the scans changed since
+    """
+    key = get_CT_statistics_key(scan_fids)
+    for stats_fid in get_CT_statistics_fids(scan_fids, cache_dir):
+        if not os.path.exists(stats_fid):
+            continue
+        with open(stats_fid, 'r') as fopen:
+            stats = json.load(fopen).get(key)
+        if stats is not None:
+            return stats['mean'], stats['std']
+    return None
+
+def write_CT_statistics(stats_fid, key, stats):
+    all_stats = {}
+    if os.path.exists(stats_fid):
+        with open(stats_fid, 'r') as fopen:
+            all_stats = json.load(fopen)
+    all_stats[key] = stats
+    tmp_fid = f'{stats_fid}.{os.getpid()}.tmp'
+    with open(tmp_fid, 'w') as fopen:
+        json.dump(all_stats, fopen, indent = 2)
+    os.replace(tmp_fid, stats_fid)
+
+def save_CT_statistics(scan_fids, moments, cache_dir=None):
+    """
+    Persist the statistics in the cache directory, failing loudly if it is not writable, and next to the scans if that is
+    writable. Without a cache directory, a read-only data directory means the statistics are recomputed on every launch
+    """
+    key = get_CT_statistics_key(scan_fids)
+    stats = {'mean': moments.mean, 'std': moments.std, 'n_pix': moments.count, 'n_scan': len(scan_fids)}
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok = True)
+        write_CT_statistics(os.path.join(cache_dir, CT_STATS_FILE), key, stats)
+
+    stats_fid = get_CT_statistics_fids(scan_fids)[0]
+    try:
+        write_CT_statistics(stats_fid, key, stats)
+    except OSError as e:
+        if not cache_dir:
+            warnings.warn(f'could not persist CT statistics to {stats_fid} ({e}), they will be recomputed on every launch. Set a cache directory (dataset_cache_dir) to keep them')
+
+def get_CT_statistics(scan_fids, num_workers=1, cache_dir=None):
     """
     As CT are quantitative, get mean and std for CT images for image normalizing
     As in reality we might not be able to load all images at a time, we would better detach statistics calculation with actual data loading
+    The statistics are computed in a single pass over the scans and persisted in CT_STATS_FILE, they are
+    only recomputed when the scans of the fold change
     """
-    total_val = 0
-    n_pix = 0
-    for fid in scan_fids:
-        in_img = read_nii_bysitk(fid)
-        total_val += in_img.sum()
-        n_pix += np.prod(in_img.shape)
-        del in_img
-    meanval = total_val / n_pix
-
-    total_var = 0
-    for fid in scan_fids:
-        in_img = read_nii_bysitk(fid)
-        total_var += np.sum((in_img - meanval) ** 2 )
-        del in_img
-    var_all = total_var / n_pix
+    stats = load_CT_statistics(scan_fids, cache_dir)
+    if stats is not None:
+        return stats
 
-    global_std = var_all ** 0.5
+    moments_by_fid = dict(zip(scan_fids, parallel_map(lambda fid: get_volume_moments(read_nii_bysitk(fid)), scan_fids, num_workers)))
+    moments = merge_moments(moments_by_fid)
+    save_CT_statistics(scan_fids, moments, cache_dir)
 
-    return meanval, global_std
+    return moments.mean, moments.std
 
 def MR_normalize(x_in):
     return (x_in - x_in.mean()) / x_in.std()
@@ -107,19 +262,21 @@ def CT_normalize(x_in, ct_mean, ct_std):
     """
     return (x_in - ct_mean) / ct_std
 
-def get_normalize_op(modality, fids, ct_mean=None, ct_std=None):
+def get_normalize_op(modality, fids, ct_mean=None, ct_std=None, num_workers=1, cache_dir=None):
     """
     As title
     Args:
         modality:   CT or MR
         fids:       fids for the fold
+        num_workers:    threads reading the scans if the CT statistics have to be computed
+        cache_dir:      directory the CT statistics are also persisted in, see save_CT_statistics
     """
     if modality == 'MR':
         return MR_normalize
 
     elif modality == 'CT':
         if ct_mean is None or ct_std is None:
-            ct_mean, ct_std = get_CT_statistics(fids)
+            ct_mean, ct_std = get_CT_statistics(fids, num_workers, cache_dir)
         # debug
         print(f'###### DEBUG_DATASET CT_STATS NORMALIZED MEAN {ct_mean} STD {ct_std} ######')
 
@@ -0,0 +1,120 @@
+"""
+On-disk cache of preprocessed scans
+Decoding the .nii.gz volumes, normalizing, applying CLAHE and resizing every slice takes minutes on large datasets
+and is repeated on every launch. The cache stores the fully preprocessed image and label volumes of each scan as
+raw .npy files, slice-major (Z x H x W) so that a single slice is contiguous on disk, plus an index.json with the
+meta information of the scans. The volumes are opened memory-mapped, slices are paged in on demand.
+They are stored in the types SliceStore keeps them in (images in the img_dtype option, labels in the smallest type
+holding them), so the store uses the mapped files as they are instead of copying them.
+
+A cache directory is keyed by the dataset and every option of the preprocessing (normalizer and its statistics,
+image size, CLAHE, ...), and by CACHE_VERSION, to be bumped whenever the preprocessing code changes.
+Scans are re-processed if their source files changed (size or modification time).
+"""
+import functools
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from dataloaders.slice_store import get_label_dtype
+
+CACHE_VERSION = 2
+
+
+def describe_normalize_op(norm_func):
+    """
+    JSON-able description of a normalization function of dataset_utils, including the CT statistics it uses
+    """
+    if isinstance(norm_func, functools.partial):
+        return {'func': norm_func.func.__name__,
+                'kwargs': {k: float(v) if np.isscalar(v) else repr(v) for k, v in sorted(norm_func.keywords.items())}}
+    return {'func': getattr(norm_func, '__name__', repr(norm_func))}
+
+
+def get_file_signature(fid):
+    stat = os.stat(fid)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def _to_json(obj):
+    if isinstance(obj, (tuple, list)):
+        return [_to_json(x) for x in obj]
+    if isinstance(obj, dict):
+        return {k: _to_json(v) for k, v in obj.items()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+class SliceCache:
+    """
+    Args:
+        cache_dir:  root directory of the caches
+        name:       dataset name, prefix of the cache directory
+        options:    JSON-able dict of everything the preprocessed arrays depend on. Its 'img_dtype' is the type the images
+                    are stored in, float32 if not given
+    """
+    def __init__(self, cache_dir, name, options):
+        key = hashlib.sha1(json.dumps({'version': CACHE_VERSION, **options}, sort_keys=True).encode()).hexdigest()[:16]
+        self.root = os.path.join(cache_dir, f'{name}_{key}')
+        self.index_fid = os.path.join(self.root, 'index.json')
+        self.options = options
+        self.img_dtype = np.dtype(options.get('img_dtype', 'float32'))
+        self.lock = threading.Lock()  # scans may be saved from several loading threads
+        os.makedirs(self.root, exist_ok=True)
+        self.index = self.read_index()
+        print(f'###### Dataset: preprocessed slice cache at {self.root}, {len(self.index["scans"])} scans cached ######')
+
+    def read_index(self):
+        if os.path.exists(self.index_fid):
+            with open(self.index_fid, 'r') as fopen:
+                index = json.load(fopen)
+            if index.get('version') == CACHE_VERSION:
+                return index
+        return {'version': CACHE_VERSION, 'options': self.options, 'scans': {}}
+
+    def write_index(self):
+        tmp_fid = f'{self.index_fid}.{os.getpid()}.tmp'
+        with open(tmp_fid, 'w') as fopen:
+            json.dump(self.index, fopen)
+        os.replace(tmp_fid, self.index_fid)
+
+    def get_fids(self, scan_id):
+        return os.path.join(self.root, f'image_{scan_id}.npy'), os.path.join(self.root, f'label_{scan_id}.npy')
+
+    def has(self, scan_id, source_fids):
+        entry = self.index['scans'].get(str(scan_id))
+        if entry is None or entry['sources'] != [get_file_signature(fid) for fid in source_fids]:
+            return False
+        return all(os.path.exists(fid) for fid in self.get_fids(scan_id))
+
+    def load(self, scan_id):
+        """
+        Memory-mapped image and label volumes of a scan, as H x W x Z views, and its meta information
+        Copy-on-write: the arrays are writable (e.g. for torch.from_numpy) but the cache files are never modified
+        """
+        img_fid, lb_fid = self.get_fids(scan_id)
+        img = np.load(img_fid, mmap_mode='c').transpose(1, 2, 0)
+        lb = np.load(lb_fid, mmap_mode='c').transpose(1, 2, 0)
+        return img, lb, self.index['scans'][str(scan_id)]['info']
+
+    def save(self, scan_id, img, lb, info, source_fids):
+        """
+        Store the H x W x Z image and label volumes of a scan
+        """
+        for fid, vol, dtype in zip(self.get_fids(scan_id), (img, lb), (self.img_dtype, get_label_dtype(lb))):
+            tmp_fid = f'{fid}.{os.getpid()}.tmp'
+            with open(tmp_fid, 'wb') as fopen:
+                np.save(fopen, np.ascontiguousarray(vol.transpose(2, 0, 1), dtype=dtype))
+            os.replace(tmp_fid, fid)
+        with self.lock:
+            self.index = self.read_index()  # another process may have added scans meanwhile
+            self.index['scans'][str(scan_id)] = {
+                'info': _to_json(info),
+                'nframe': int(img.shape[-1]),
+                'sources': [get_file_signature(fid) for fid in source_fids],
+            }
+            self.write_index()
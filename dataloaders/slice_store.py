@@ -0,0 +1,176 @@
+"""
+Contiguous storage of the slices of loaded scans
+read_dataset used to return a list with one dict per slice, each holding views of the scan volumes. SliceStore keeps
+each volume as one contiguous, slice-major (Z x H x W) array instead, allocated in anonymous shared memory so that
+forked DataLoader workers map the same pages rather than duplicating them, or used as is if it is already memory-mapped
+(e.g. from the slice cache). Labels are kept in the smallest unsigned type that holds them, images optionally in float16.
+
+Indexing the store still gives the per-slice dicts the datasets expect, built on access, and get_volume returns a whole
+scan without copying.
+
+LazySliceStore only indexes the slices up front and decodes the scans on first access, keeping a bounded number of them.
+"""
+import bisect
+import mmap
+from collections import OrderedDict
+
+import numpy as np
+
+
+def shared_empty(shape, dtype):
+    """
+    Uninitialized array in anonymous shared memory, inherited without copy by forked processes
+    """
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(count * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+
+def get_label_dtype(lb):
+    """
+    Smallest unsigned integer type holding the labels, their own type if some are negative or too large
+    """
+    if lb.size == 0 or lb.min() < 0:
+        return lb.dtype
+    lb_max = lb.max()
+    if lb_max <= np.iinfo(np.uint8).max:
+        return np.dtype(np.uint8)
+    if lb_max <= np.iinfo(np.uint16).max:
+        return np.dtype(np.uint16)
+    return lb.dtype
+
+
+def to_slice_major(vol, dtype):
+    """
+    Z x H x W array of an H x W x Z volume. Memory-mapped volumes already stored that way are used as they are,
+    others are copied into shared memory
+    """
+    vol_zhw = vol.transpose(2, 0, 1)
+    if isinstance(vol, np.memmap) and vol_zhw.dtype == dtype and vol_zhw.flags['C_CONTIGUOUS']:
+        return vol_zhw
+    out = shared_empty(vol_zhw.shape, dtype)
+    out[...] = vol_zhw
+    return out
+
+
+class SliceStore:
+    """
+    Args:
+        img_dtype:      storage type of the images, float16 halves their memory
+        img_out_dtype:  type of the images handed out in the slice dicts
+        lb_out_dtype:   type of the labels handed out in the slice dicts
+    """
+    def __init__(self, img_dtype=np.float32, img_out_dtype=np.float32, lb_out_dtype=np.float32):
+        self.img_dtype = np.dtype(img_dtype)
+        self.img_out_dtype = np.dtype(img_out_dtype)
+        self.lb_out_dtype = np.dtype(lb_out_dtype)
+        self.scan_ids = []
+        self.scan_index = {} # scan_id -> position in scan_ids
+        self.imgs = []
+        self.lbs = []
+        self.slice_attrs = []
+        self.nframes = []
+        self.starts = [] # global index of the first slice of each scan
+        self.size = 0
+
+    def add_scan(self, scan_id, img, lb, **slice_attrs):
+        """
+        Add the H x W x Z image and label volumes of a scan
+        Args:
+            slice_attrs:    additional per-slice entries of the slice dicts, as arrays of length Z
+        Returns:
+            global index of the first slice of the scan
+        """
+        assert img.shape == lb.shape, f'image {img.shape} and label {lb.shape} of scan {scan_id} differ'
+        return self.register_scan(scan_id, to_slice_major(img, self.img_dtype), to_slice_major(lb, get_label_dtype(lb)),
+                                  img.shape[-1], slice_attrs)
+
+    def register_scan(self, scan_id, img, lb, nframe, slice_attrs):
+        start = self.size
+        self.scan_index[scan_id] = len(self.scan_ids)
+        self.scan_ids.append(scan_id)
+        self.imgs.append(img)
+        self.lbs.append(lb)
+        self.slice_attrs.append(slice_attrs)
+        self.nframes.append(nframe)
+        self.starts.append(start)
+        self.size += nframe
+        return start
+
+    def get_scan_volumes(self, scan_n):
+        return self.imgs[scan_n], self.lbs[scan_n]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        index = int(index)
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError(f'slice {index} out of range for {self.size} slices')
+        scan_n = bisect.bisect_right(self.starts, index) - 1
+        z_id = index - self.starts[scan_n]
+        img, lb = self.get_scan_volumes(scan_n)
+        curr_dict = {"img": np.asarray(img[z_id][..., None], dtype = self.img_out_dtype),
+                     "lb": np.asarray(lb[z_id][..., None], dtype = self.lb_out_dtype),
+                     "is_start": z_id == 0,
+                     "is_end": z_id == self.nframes[scan_n] - 1,
+                     "scan_id": self.scan_ids[scan_n],
+                     "z_id": z_id,
+                     }
+        for key, val in self.slice_attrs[scan_n].items():
+            curr_dict[key] = val[z_id]
+        return curr_dict
+
+    def get_volume(self, scan_id):
+        """
+        Image and label volumes of a scan as stored, Z x H x W, without copy
+        """
+        return self.get_scan_volumes(self.scan_index[scan_id])
+
+    def nbytes(self):
+        return sum(img.nbytes + lb.nbytes for img, lb in zip(self.imgs, self.lbs) if img is not None)
+
+
+class LazySliceStore(SliceStore):
+    """
+    SliceStore of scans decoded on first access, for datasets larger than memory
+    At most max_scans scans are held, the least recently used one is dropped when another one is loaded.
+    Every DataLoader worker holds its own scans
+    Args:
+        load_fn:        load_fn(scan_id) returns the H x W x Z image and label volumes of a scan
+        max_scans:      number of scans held in memory
+    """
+    def __init__(self, load_fn, max_scans, **kwargs):
+        super(LazySliceStore, self).__init__(**kwargs)
+        self.load_fn = load_fn
+        self.max_scans = max_scans
+        self.resident = OrderedDict() # positions of the loaded scans, least recently used first
+        self.n_loads = 0
+
+    def add_lazy_scan(self, scan_id, n_slices, **slice_attrs):
+        """
+        Index the n_slices slices of a scan without loading it
+        Returns:
+            global index of the first slice of the scan
+        """
+        return self.register_scan(scan_id, None, None, n_slices, slice_attrs)
+
+    def get_scan_volumes(self, scan_n):
+        if scan_n in self.resident:
+            self.resident.move_to_end(scan_n)
+            return self.imgs[scan_n], self.lbs[scan_n]
+
+        scan_id = self.scan_ids[scan_n]
+        img, lb = self.load_fn(scan_id)
+        assert img.shape[-1] == self.nframes[scan_n], f'scan {scan_id} has {img.shape[-1]} slices, {self.nframes[scan_n]} were indexed'
+        self.imgs[scan_n] = to_slice_major(img, self.img_dtype)
+        self.lbs[scan_n] = to_slice_major(lb, get_label_dtype(lb))
+        self.resident[scan_n] = None
+        self.n_loads += 1
+        while len(self.resident) > self.max_scans:
+            evicted, _ = self.resident.popitem(last = False)
+            self.imgs[evicted] = self.lbs[evicted] = None
+        return self.imgs[scan_n], self.lbs[scan_n]
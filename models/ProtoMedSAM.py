@@ -3,28 +3,36 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import matplotlib.pyplot as plt
-from models.ProtoSAM import ModelWrapper
-from segment_anything import sam_model_registry
-from util.utils import rotate_tensor_no_crop, reverse_tensor, need_softmax, get_confidence_from_logits, get_connected_components, cca, plot_connected_components
+from models.ProtoSAM import ModelWrapper, SAM_IMG_SIZE
+from models.segment_anything import sam_model_registry
+from util.checkpoint import build_model
+from util.model_manager import build_with_lazy_submodule
+from util.utils import rotate_tensor_no_crop, reverse_tensor, need_softmax, get_confidence_from_logits, get_connected_components, cca, plot_connected_components, get_autocast
 
 class ProtoMedSAM(nn.Module):
-    def __init__(self, image_size, coarse_segmentation_model:ModelWrapper, sam_pretrained_path="pretrained_model/medsam_vit_b.pth", debug=False, use_cca=False,  coarse_pred_only=False):
+    def __init__(self, image_size, coarse_segmentation_model:ModelWrapper, sam_pretrained_path="pretrained_model/medsam_vit_b.pth", debug=False, use_cca=False,  coarse_pred_only=False, precision='fp32', model_manager=None):
         super().__init__()
         if isinstance(image_size, int):
             image_size = (image_size, image_size)
         self.image_size = image_size
         self.coarse_segmentation_model = coarse_segmentation_model
-        self.get_sam(sam_pretrained_path)
+        self.get_sam(sam_pretrained_path, model_manager)
         self.coarse_pred_only = coarse_pred_only
         self.debug = debug
         self.use_cca = use_cca
+        self.precision = precision # 'fp32', 'bf16' or 'fp16' autocast for the coarse model and MedSAM
         
     
-    def get_sam(self, checkpoint_path):
+    def get_sam(self, checkpoint_path, model_manager=None):
         model_type="vit_b" # TODO make generic?
         if 'vit_h' in checkpoint_path:
             model_type = "vit_h"
-        self.medsam = sam_model_registry[model_type](checkpoint=checkpoint_path).eval()
+        if model_manager is None:
+            self.medsam = build_model(sam_model_registry[model_type], checkpoint=checkpoint_path).eval()
+        else:
+            # the image encoder is built on first use and kept within the manager's memory budget
+            self.medsam = build_with_lazy_submodule(sam_model_registry[model_type], checkpoint_path, 'image_encoder',
+                                                    model_manager, 'sam_image_encoder', img_size=SAM_IMG_SIZE).eval()
 
         
     torch.no_grad()
@@ -33,18 +41,20 @@ class ProtoMedSAM(nn.Module):
         if len(box_torch.shape) == 2:
             box_torch = box_torch[:, None, :]  # (B, 1, 4)
 
-        sparse_embeddings, dense_embeddings = self.medsam.prompt_encoder(
-            points=None,
-            boxes=box_torch,
-            masks=None,
-        )
-        low_res_logits, conf = self.medsam.mask_decoder(
-            image_embeddings=img_embed,  # (B, 256, 64, 64)
-            image_pe=self.medsam.prompt_encoder.get_dense_pe(),  # (1, 256, 64, 64)
-            sparse_prompt_embeddings=sparse_embeddings,  # (B, 2, 256)
-            dense_prompt_embeddings=dense_embeddings,  # (B, 256, 64, 64)
-            multimask_output=True if query_label is not None else False,
-        )
+        with get_autocast(img_embed.device, self.precision):
+            sparse_embeddings, dense_embeddings = self.medsam.prompt_encoder(
+                points=None,
+                boxes=box_torch,
+                masks=None,
+            )
+            low_res_logits, conf = self.medsam.mask_decoder(
+                image_embeddings=img_embed,  # (B, 256, 64, 64)
+                image_pe=self.medsam.prompt_encoder.get_dense_pe(),  # (1, 256, 64, 64)
+                sparse_prompt_embeddings=sparse_embeddings,  # (B, 2, 256)
+                dense_prompt_embeddings=dense_embeddings,  # (B, 256, 64, 64)
+                multimask_output=True if query_label is not None else False,
+            )
+        low_res_logits, conf = low_res_logits.float(), conf.float()
 
         low_res_pred = torch.sigmoid(low_res_logits)  # (1, 1, 256, 256)
 
@@ -129,7 +139,9 @@ class ProtoMedSAM(nn.Module):
         rotated_img, (rot_h, rot_w) = rotate_tensor_no_crop(query_image, degrees_rotate)
         # print(f"rotating query image took {time.time() - start_time} seconds")
         coarse_model_input.set_query_images(rotated_img)
-        output_logits_rot = self.coarse_segmentation_model(coarse_model_input)
+        with get_autocast(query_image.device, self.precision):
+            output_logits_rot = self.coarse_segmentation_model(coarse_model_input)
+        output_logits_rot = output_logits_rot.float() # softmax, cca and the confidences run in fp32
         # print(f"ALPNet took {time.time() - start_time} seconds")
        
         if degrees_rotate != 0:
@@ -201,7 +213,7 @@ class ProtoMedSAM(nn.Module):
         bbox = self.get_bbox_per_cc(conn_components)
         bbox = bbox / np.array([W, H, W, H]) * max(self.image_size)
         query_image = (query_image - query_image.min()) / (query_image.max() - query_image.min())
-        with torch.no_grad():
+        with torch.no_grad(), get_autocast(query_image.device, self.precision):
             image_embedding = self.medsam.image_encoder(query_image)
             
         medsam_seg, conf= self.medsam_inference(image_embedding, bbox, H, W)
@@ -228,7 +240,7 @@ class ProtoMedSAM(nn.Module):
         # bbox = bbox / np.array([W, H, W, H]) * max(self.image_size)
         bbox = np.array([[0, 0, W, H]])
         query_image = (query_image - query_image.min()) / (query_image.max() - query_image.min())
-        with torch.no_grad():
+        with torch.no_grad(), get_autocast(query_image.device, self.precision):
             image_embedding = self.medsam.image_encoder(query_image)
             
         medsam_seg, conf= self.medsam_inference(image_embedding, bbox, H, W, query_label)
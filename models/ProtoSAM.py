@@ -1,3 +1,4 @@
+import os
 import warnings
 import torch
 import torch.nn as nn
@@ -5,14 +6,20 @@ from torch.nn import functional as F
 import matplotlib.pyplot as plt
 import numpy as np
 from models.grid_proto_fewshot import FewShotSeg
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+from models.segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
 from models.SamWrapper import SamWrapper
-from util.utils import cca, get_connected_components, rotate_tensor_no_crop, reverse_tensor, get_confidence_from_logits
+from util.utils import cca, get_connected_components, rotate_tensor_no_crop, reverse_tensor, get_confidence_from_logits, get_autocast
 from util.lora import inject_trainable_lora
+from util.quantization import quantize_linear_int8, save_quantized, load_quantized
+from util.compile_utils import compile_forward
+from util.onnx_utils import export_sam_image_encoder, load_or_export
+from util.checkpoint import build_model
+from util.model_manager import build_with_lazy_submodule
 from models.segment_anything.utils.transforms import ResizeLongestSide
 import cv2
 import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 
 CONF_MODE="conf"
 CENTROID_MODE="centroid"
@@ -21,6 +28,7 @@ POINT_MODES=(CONF_MODE, CENTROID_MODE, BOTH_MODE)
 
 TYPE_ALPNET="alpnet"
 TYPE_SAM="sam"
+SAM_IMG_SIZE=1024 # input size of the SAM image encoders, see segment_anything/build_sam.py
 
 def plot_connected_components(cca_output, original_image, confidences:dict=None, title="debug/connected_components.png"):
     num_labels, labels, stats, centroids = cca_output
@@ -182,13 +190,13 @@ class SamWrapperWrapper(ModelWrapper):
         self.model.sam.to(device)
     
 class ProtoSAM(nn.Module):
-    def __init__(self, image_size, coarse_segmentation_model:ModelWrapper, sam_pretrained_path="pretrained_model/sam_default.pth", num_points_for_sam=1, use_points=True, use_bbox=False, use_mask=False, debug=False, use_cca=False, point_mode=CONF_MODE, use_sam_trans=True, coarse_pred_only=False, alpnet_image_size=None, use_neg_points=False, ):
+    def __init__(self, image_size, coarse_segmentation_model:ModelWrapper, sam_pretrained_path="pretrained_model/sam_default.pth", num_points_for_sam=1, use_points=True, use_bbox=False, use_mask=False, debug=False, use_cca=False, point_mode=CONF_MODE, use_sam_trans=True, coarse_pred_only=False, alpnet_image_size=None, use_neg_points=False, precision='fp32', roi_size=None, roi_margin=0.2, model_manager=None):
         super().__init__()
         if isinstance(image_size, int):
             image_size = (image_size, image_size)
         self.image_size = image_size
         self.coarse_segmentation_model = coarse_segmentation_model
-        self.get_sam(sam_pretrained_path, use_sam_trans)
+        self.get_sam(sam_pretrained_path, use_sam_trans, model_manager)
         self.num_points_for_sam = num_points_for_sam
         self.use_points = use_points
         self.use_bbox = use_bbox # if False then uses points
@@ -201,12 +209,22 @@ class ProtoSAM(nn.Module):
             raise ValueError(f"point mode must be one of {POINT_MODES}")
         self.debug=debug
         self.coarse_pred_only = coarse_pred_only
+        self.precision = precision # 'fp32', 'bf16' or 'fp16' autocast for the coarse model and SAM
+        if roi_size is not None:
+            assert roi_size % 16 == 0 and 0 < roi_size <= SAM_IMG_SIZE, f"roi_size must be a multiple of the SAM patch size 16, at most {SAM_IMG_SIZE}, got {roi_size}"
+        self.roi_size = roi_size # if set, SAM encodes a crop around the coarse prediction at this size, see predict_roi
+        self.roi_margin = roi_margin # margin around the coarse prediction, fraction of its longest side
          
-    def get_sam(self, checkpoint_path, use_sam_trans):
+    def get_sam(self, checkpoint_path, use_sam_trans, model_manager=None):
         model_type="vit_b" # TODO make generic?
         if 'vit_h' in checkpoint_path:
             model_type = "vit_h"
-        self.sam = sam_model_registry[model_type](checkpoint=checkpoint_path).eval()
+        if model_manager is None:
+            self.sam = build_model(sam_model_registry[model_type], checkpoint=checkpoint_path).eval()
+        else:
+            # the image encoder is built on first use and kept within the manager's memory budget
+            self.sam = build_with_lazy_submodule(sam_model_registry[model_type], checkpoint_path, 'image_encoder',
+                                                 model_manager, 'sam_image_encoder', img_size=SAM_IMG_SIZE).eval()
         self.predictor = SamPredictor(self.sam)
         self.sam.requires_grad_(False)
         if use_sam_trans:
@@ -219,6 +237,83 @@ class ProtoSAM(nn.Module):
             
         self.sam_trans = sam_trans
         
+    def quantize_sam_encoder_int8(self, path=None):
+        '''
+        CPU inference: dynamic int8 quantization of the linear layers of the SAM image encoder.
+        If path exists the int8 encoder is loaded from it, otherwise the quantized encoder is saved to path
+        '''
+        if path is not None and os.path.exists(path):
+            self.sam.image_encoder = load_quantized(self.sam.image_encoder, path)
+        else:
+            self.sam.image_encoder = quantize_linear_int8(self.sam.image_encoder)
+            if path is not None:
+                save_quantized(self.sam.image_encoder, path)
+
+    def compile_for_inference(self, warmup=True):
+        '''
+        Opt-in torch.compile of the coarse model (see FewShotSeg.compile_for_inference) and of SAM.
+        The SAM image encoder always sees a 1024 x 1024 input and compiles once, the mask decoder is compiled
+        with dynamic shapes for the varying number of prompts
+        '''
+        if isinstance(self.coarse_segmentation_model, ALPNetWrapper):
+            self.coarse_segmentation_model.model.compile_for_inference(warmup=warmup)
+        compile_forward(self.sam.image_encoder, dynamic=False)
+        compile_forward(self.sam.mask_decoder, dynamic=True)
+        if warmup:
+            with torch.no_grad():
+                img = np.zeros((*self.image_size, 3), dtype=np.uint8)
+                self.set_sam_image(img)
+                self.sam_predict(box=np.array([0, 0, self.image_size[1] // 2, self.image_size[0] // 2]), multimask_output=False)
+            self.predictor.reset_image()
+
+    def use_onnx_runtime(self, onnx_dir):
+        '''
+        CPU inference: run the coarse model encoder and the SAM image encoder with ONNX Runtime.
+        The encoders are exported to onnx_dir on first use. Prompt encoding and mask decoding stay in PyTorch
+        '''
+        assert self.roi_size is None, "the SAM image encoder is exported for img_size inputs only, roi_size needs the PyTorch encoder"
+        if isinstance(self.coarse_segmentation_model, ALPNetWrapper):
+            self.coarse_segmentation_model.model.use_onnx_runtime(os.path.join(onnx_dir, 'fewshotseg_encoder.onnx'))
+        image_encoder = self.sam.image_encoder
+        self.sam.image_encoder = load_or_export(os.path.join(onnx_dir, 'sam_image_encoder.onnx'),
+                                                lambda path: export_sam_image_encoder(image_encoder, path),
+                                                img_size=image_encoder.img_size)
+        print(f'###### SAM image encoder runs with ONNX Runtime from {onnx_dir} ######')
+
+    def set_sam_image(self, qry_img):
+        with get_autocast(self.predictor.device, self.precision):
+            self.predictor.set_image(qry_img)
+
+    def sam_predict(self, point_coords=None, point_labels=None, box=None, mask_input=None, multimask_output=True, return_logits=False):
+        '''
+        SamPredictor.predict with the prompt encoder and mask decoder under autocast,
+        outputs are cast back to fp32 before leaving torch
+        '''
+        predictor = self.predictor
+        coords_torch, labels_torch, box_torch, mask_input_torch = None, None, None, None
+        if point_coords is not None:
+            point_coords = predictor.transform.apply_coords(point_coords, predictor.original_size)
+            coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=predictor.device)[None, :, :]
+            labels_torch = torch.as_tensor(point_labels, dtype=torch.int, device=predictor.device)[None, :]
+        if box is not None:
+            box = predictor.transform.apply_boxes(box, predictor.original_size)
+            box_torch = torch.as_tensor(box, dtype=torch.float, device=predictor.device)[None, :]
+        if mask_input is not None:
+            mask_input_torch = torch.as_tensor(mask_input, dtype=torch.float, device=predictor.device)[None, :, :, :]
+
+        with get_autocast(predictor.device, self.precision):
+            masks, iou_predictions, low_res_masks = predictor.predict_torch(
+                coords_torch,
+                labels_torch,
+                box_torch,
+                mask_input_torch,
+                multimask_output,
+                return_logits=return_logits,
+            )
+        if return_logits:
+            masks = masks.float()
+        return masks[0].detach().cpu().numpy(), iou_predictions[0].float().detach().cpu().numpy(), low_res_masks[0].float().detach().cpu().numpy()
+
     def get_bbox(self, pred):
         '''
         pred tensor of shape (H, W) where 1 represents foreground and 0 represents background
@@ -473,8 +568,8 @@ class ProtoSAM(nn.Module):
             in_mask[in_mask == 1] = 10
             in_mask[in_mask == 0] = -8
             assert qry_img.max() <= 255 and qry_img.min() >= 0 and qry_img.dtype == np.uint8   
-            self.predictor.set_image(qry_img)
-            mask, score, _ = self.predictor.predict(
+            self.set_sam_image(qry_img)
+            mask, score, _ = self.sam_predict(
                 mask_input=in_mask[None, ...].astype(np.uint8),
                 multimask_output=True)
             # get max index from score
@@ -497,9 +592,100 @@ class ProtoSAM(nn.Module):
         
         return masks, scores
     
+    def get_roi(self, fg_mask):
+        '''
+        Crop box (x0, y0, x1, y1) around the union of the coarse components, enlarged by roi_margin on every side
+        '''
+        ys, xs = np.nonzero(fg_mask)
+        x0, y0, x1, y1 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+        margin = int(self.roi_margin * max(x1 - x0, y1 - y0)) + 1
+        H, W = fg_mask.shape
+        return max(0, x0 - margin), max(0, y0 - margin), min(W, x1 + margin), min(H, y1 + margin)
+
+    def encode_roi(self, image):
+        '''
+        SAM image encoder on a roi_size input. ImageEncoderViT.forward interpolates the position embeddings to
+        the smaller token grid, so this goes through the active encoder as is: quantized, compiled (one more
+        compilation for the roi_size input) or offloaded by a ModelManager
+        '''
+        return self.sam.image_encoder(image)
+
+    @contextmanager
+    def roi_prompt_frame(self, embed_size):
+        '''
+        Point the prompt encoder at the roi_size input frame and its embed_size token grid
+        '''
+        prompt_encoder = self.sam.prompt_encoder
+        saved = prompt_encoder.input_image_size, prompt_encoder.image_embedding_size
+        prompt_encoder.input_image_size = (self.roi_size, self.roi_size)
+        prompt_encoder.image_embedding_size = (embed_size, embed_size)
+        try:
+            yield
+        finally:
+            prompt_encoder.input_image_size, prompt_encoder.image_embedding_size = saved
+
+    @torch.no_grad()
+    def predict_roi(self, sam_input_points, bboxes, sam_neg_input_points, qry_img, fg_mask, return_logits=False):
+        '''
+        Same as predict_w_points_bbox, but SAM only sees a crop around the coarse prediction, resized so that its
+        longest side is roi_size and padded to roi_size x roi_size. The encoder cost falls with the square of
+        roi_size / img_size. Prompts are mapped into the crop frame and the masks pasted back into the full frame
+        '''
+        x0, y0, x1, y1 = self.get_roi(fg_mask)
+        crop_h, crop_w = y1 - y0, x1 - x0
+        scale = self.roi_size / max(crop_h, crop_w)
+        in_h, in_w = int(crop_h * scale + 0.5), int(crop_w * scale + 0.5)
+        patch_size = self.sam.image_encoder.img_size // self.sam.prompt_encoder.image_embedding_size[0]
+        device = self.sam.device
+
+        crop = torch.as_tensor(qry_img[y0:y1, x0:x1], device=device).permute(2, 0, 1)[None].float()
+        crop = F.interpolate(crop, size=(in_h, in_w), mode='bilinear', align_corners=False)
+        crop = (crop - self.sam.pixel_mean) / self.sam.pixel_std
+        crop = F.pad(crop, (0, self.roi_size - in_w, 0, self.roi_size - in_h))
+        offset = np.array([x0, y0])
+
+        masks, scores = [], []
+        with get_autocast(device, self.precision), self.roi_prompt_frame(self.roi_size // patch_size):
+            image_embedding = self.encode_roi(crop)
+            image_pe = self.sam.prompt_encoder.get_dense_pe()
+            for point, bbox_xyxy, neg_point in zip(sam_input_points, bboxes, sam_neg_input_points):
+                points = point
+                point_labels = np.array([1] * len(point)) if point is not None else None
+                if self.use_neg_points:
+                    neg_points = [npoint for npoint in neg_point if None not in npoint]
+                    points = np.vstack([point, *neg_points])
+                    point_labels = np.array([1] * len(point) + [0] * len(neg_points))
+                sam_points = None
+                if points is not None:
+                    sam_points = (torch.as_tensor((points - offset) * scale, dtype=torch.float, device=device)[None],
+                                  torch.as_tensor(point_labels, dtype=torch.int, device=device)[None])
+                box_torch = None
+                if bbox_xyxy is not None:
+                    box = (np.asarray(bbox_xyxy, dtype=np.float32).reshape(-1, 4) - np.tile(offset, 2)) * scale
+                    box_torch = torch.as_tensor(box, dtype=torch.float, device=device)
+                sparse_embeddings, dense_embeddings = self.sam.prompt_encoder(points=sam_points, boxes=box_torch, masks=None)
+                low_res_masks, iou_predictions = self.sam.mask_decoder(
+                    image_embeddings=image_embedding,
+                    image_pe=image_pe,
+                    sparse_prompt_embeddings=sparse_embeddings,
+                    dense_prompt_embeddings=dense_embeddings,
+                    multimask_output=False if self.use_cca else True,
+                )
+                # crop frame -> full frame, outside the crop is background
+                mask = F.interpolate(low_res_masks.float(), size=(self.roi_size, self.roi_size), mode='bilinear', align_corners=False)
+                mask = F.interpolate(mask[..., :in_h, :in_w], size=(crop_h, crop_w), mode='bilinear', align_corners=False)[0]
+                full_mask = mask.new_full((mask.shape[0], *qry_img.shape[:2]), -1e4)
+                full_mask[:, y0:y1, x0:x1] = mask
+                if not return_logits:
+                    full_mask = full_mask > self.sam.mask_threshold
+                masks.append(full_mask[0].cpu().numpy())
+                scores.append(iou_predictions[0].float().cpu().numpy()[0])
+
+        return masks, scores
+
     def predict_w_points_bbox(self, sam_input_points, bboxes, sam_neg_input_points, qry_img, pred, return_logits=False):
         masks, scores = [], []
-        self.predictor.set_image(qry_img)
+        self.set_sam_image(qry_img)
         # if sam_input_points is None:
         #     sam_input_points = [None for _ in range(len(bboxes))]
         for point, bbox_xyxy, neg_point in zip(sam_input_points, bboxes, sam_neg_input_points): 
@@ -512,7 +698,7 @@ class ProtoSAM(nn.Module):
                 point_labels = np.array([1] * len(point) + [0] * len(neg_points))
             if self.debug: 
                 self.plot_most_conf_points(points[:, None, ...], None, pred, qry_img, bboxes=bbox_xyxy[None,...] if bbox_xyxy is not None else None, title="debug/pos_neg_points.png") # TODO add plots for all points not just the first set of points
-            mask, score, _ = self.predictor.predict(
+            mask, score, _ = self.sam_predict(
                 point_coords=points,
                 point_labels=point_labels,
                 # box=bbox_xyxy[None, :] if bbox_xyxy is not None else None,
@@ -545,7 +731,9 @@ class ProtoSAM(nn.Module):
         # print(f"rotating query image took {time.time() - start_time} seconds")
         start_time = time.time()
         coarse_model_input.set_query_images(rotated_img)
-        output_logits_rot = self.coarse_segmentation_model(coarse_model_input)
+        with get_autocast(query_image.device, self.precision):
+            output_logits_rot = self.coarse_segmentation_model(coarse_model_input)
+        output_logits_rot = output_logits_rot.float() # softmax, cca and the confidences run in fp32
         # print(f"ALPNet took {time.time() - start_time} seconds")
        
         if degrees_rotate != 0:
@@ -663,7 +851,9 @@ class ProtoSAM(nn.Module):
             masks, scores = self.predict_w_masks(sam_input_masks, query_image, original_size)
         
         start_time = time.time()
-        if self.use_points or self.use_bbox:
+        if (self.use_points or self.use_bbox) and self.roi_size is not None:
+            masks, scores = self.predict_roi(sam_input_points, bboxes, sam_neg_input_points, query_image, conn_components[1] > 0, return_logits=True if self.training else False)
+        elif self.use_points or self.use_bbox:
             masks, scores = self.predict_w_points_bbox(sam_input_points, bboxes, sam_neg_input_points, query_image, pred, return_logits=True if self.training else False)
         # print(f"predicting w points/bbox took {time.time() - start_time} seconds")
             
@@ -3,6 +3,7 @@ import torch.nn as nn
 import numpy as np
 from models.segment_anything import SamPredictor, sam_model_registry, SamAutomaticMaskGenerator
 from models.segment_anything.utils.transforms import ResizeLongestSide
+from util.checkpoint import build_model
 import cv2
 
 def get_iou(mask, label):
@@ -12,6 +13,15 @@ def get_iou(mask, label):
     iou = tp / (tp + fp + fn)
     return iou
 
+def get_batched_iou(masks, label):
+    """
+    IoU of each of the N x H x W boolean masks with the H x W binary label, in one reduction
+    """
+    label = label.bool()
+    tp = (masks & label).flatten(1).sum(1)
+    union = masks.flatten(1).sum(1) + label.sum() - tp
+    return tp / union.clamp(min=1)
+
 class SamWrapper(nn.Module):
     def __init__(self,sam_args):
         """
@@ -22,19 +32,30 @@ class SamWrapper(nn.Module):
         }
         """
         super().__init__()
-        self.sam = sam_model_registry[sam_args['model_type']](checkpoint=sam_args['sam_checkpoint'])
+        self.sam = build_model(sam_model_registry[sam_args['model_type']], checkpoint=sam_args['sam_checkpoint'])
         self.mask_generator = SamAutomaticMaskGenerator(self.sam)
         self.transform = ResizeLongestSide(self.sam.image_encoder.img_size)
         
-    def forward(self, image, image_labels):
+    def forward(self, image, image_labels, fast=True):
         """
         generate masks for a batch of images
         return mask that has the largest iou with the image label
         Args: 
             images (np.ndarray): The image to generate masks for, in HWC uint8 format.
             image_labels (np.ndarray): The image labels to generate masks for, in HWC uint8 format. assuming binary labels
+            fast (bool): keep the candidate masks as a dense tensor on the model device and pick the best one
+                with a single batched IoU (SamAutomaticMaskGenerator.generate_dense). Falls back to the RLE
+                pipeline of generate when small region postprocessing is enabled
         """
         image = self.transform.apply_image(image)
+        if fast and self.mask_generator.min_mask_region_area == 0:
+            masks = self.mask_generator.generate_dense(image)['masks']
+            if len(masks) == 0:
+                return np.zeros(image.shape[:2], dtype=bool)
+            label = torch.as_tensor(image_labels).to(masks.device)
+            best_index = get_batched_iou(masks, label).argmax()
+            return masks[best_index].cpu().numpy()
+
         masks = self.mask_generator.generate(image)
         
         best_index, best_iou = None, 0
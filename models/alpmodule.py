@@ -12,25 +12,53 @@ import matplotlib.pyplot as plt
 # for unit test from spatial_similarity_module import NONLocalBlock2D, LayerNorm
 
 def safe_norm(x, p = 2, dim = 1, eps = 1e-4):
+    x = x.float() # the norm underflows / overflows in fp16
     x_norm = torch.norm(x, p = p, dim = dim) # .detach()
-    x_norm = torch.max(x_norm, torch.ones_like(x_norm).cuda() * eps)
+    x_norm = torch.clamp(x_norm, min = eps)
     x = x.div(x_norm.unsqueeze(1).expand_as(x))
     return x
 
 
+def compress_prototypes(protos, max_protos, n_iters = 5):
+    """
+    Cluster a bank of l2-normalized prototypes with spherical k-means
+    Args:
+        protos:         [npro, nc], l2-normalized prototypes
+        max_protos:     size of the compressed bank
+        n_iters:        number of k-means iterations
+    Returns:
+        centers:        [k, nc], l2-normalized cluster centers (k <= max_protos)
+        weights:        [k], number of original prototypes merged into each center
+    """
+    npro = protos.shape[0]
+    # deterministic init: evenly spaced prototypes along the (row-major) support grid
+    init_idx = torch.linspace(0, npro - 1, max_protos, device = protos.device).long()
+    centers = protos[init_idx]
+    for _ in range(n_iters):
+        assign = torch.mm(protos, centers.t()).argmax(dim = 1)
+        centers = torch.zeros_like(centers).index_add_(0, assign, protos)
+        centers = safe_norm(centers)
+    assign = torch.mm(protos, centers.t()).argmax(dim = 1)
+    weights = torch.bincount(assign, minlength = centers.shape[0]).to(protos.dtype)
+    keep = weights > 0
+    return centers[keep], weights[keep]
+
+
 class MultiProtoAsConv(nn.Module):
-    def __init__(self, proto_grid, feature_hw, embed_dim=768, use_attention=False, upsample_mode = 'bilinear'):
+    def __init__(self, proto_grid, feature_hw, embed_dim=768, use_attention=False, upsample_mode = 'bilinear', max_protos = None):
         """
         ALPModule
         Args:
             proto_grid:     Grid size when doing multi-prototyping. For a 32-by-32 feature map, a size of 16-by-16 leads to a pooling window of 2-by-2
             feature_hw:     Spatial size of input feature map
+            max_protos:     If set, local prototype banks larger than this are clustered down to at most max_protos weighted prototypes
 
         """
         super(MultiProtoAsConv, self).__init__()
         self.feature_hw = feature_hw
         self.proto_grid = proto_grid
         self.upsample_mode = upsample_mode
+        self.max_protos = max_protos
         kernel_size = [ ft_l // grid_l for ft_l, grid_l in zip(feature_hw, proto_grid)  ]
         self.kernel_size = kernel_size
         print(f"MultiProtoAsConv: kernel_size: {kernel_size}")
@@ -54,20 +82,20 @@ class MultiProtoAsConv(nn.Module):
                 nn.Conv2d(128, 1, kernel_size=1, stride=1, padding=0, bias=True),
             )
             
-    def get_prediction_from_prototypes(self, prototypes, query, mode, vis_sim=False ):
+    def get_prediction_from_prototypes(self, prototypes, query, mode, vis_sim=False, proto_weights=None):
         if mode == 'mask':
-            pred_mask = F.cosine_similarity(query, prototypes[..., None, None], dim=1, eps = 1e-4) * 20.0 # [1, h, w]
+            pred_mask = F.cosine_similarity(query.unsqueeze(1), prototypes[None, ..., None, None], dim=2, eps = 1e-4) * 20.0 # [nq, npro, h, w]
             # incase there are more than one prototypes in the same location, take the max
-            pred_mask = pred_mask.max(dim = 0)[0].unsqueeze(0)
+            pred_mask = pred_mask.max(dim = 1)[0] # [nq, h, w]
             vis_dict = {'proto_assign': pred_mask} # things to visualize
             if vis_sim:
                 vis_dict['raw_local_sims'] = pred_mask
-            return pred_mask.unsqueeze(1), [pred_mask], vis_dict  # just a placeholder. pred_mask returned as [1, way(1), h, w]
+            return pred_mask.unsqueeze(1), [pred_mask], vis_dict  # just a placeholder. pred_mask returned as [nq, way(1), h, w]
             
         elif mode == 'gridconv':
             dists = F.conv2d(query, prototypes[..., None, None]) * 20
 
-            pred_grid = torch.sum(F.softmax(dists, dim = 1) * dists, dim = 1, keepdim = True)
+            pred_grid = torch.sum(F.softmax(self._weighted_logits(dists, proto_weights), dim = 1) * dists, dim = 1, keepdim = True)
             debug_assign = dists.argmax(dim = 1).float().detach()
 
             vis_dict = {'proto_assign': debug_assign} # things to visualize
@@ -79,7 +107,7 @@ class MultiProtoAsConv(nn.Module):
         elif mode == 'gridconv+':
             dists = F.conv2d(query, prototypes[..., None, None]) * 20
 
-            pred_grid = torch.sum(F.softmax(dists, dim = 1) * dists, dim = 1, keepdim = True)
+            pred_grid = torch.sum(F.softmax(self._weighted_logits(dists, proto_weights), dim = 1) * dists, dim = 1, keepdim = True)
             # raw_local_sims = dists.det ach()
 
             debug_assign = dists.argmax(dim = 1).float()
@@ -92,8 +120,51 @@ class MultiProtoAsConv(nn.Module):
         
         else:
             raise ValueError(f"Invalid mode: {mode}. Expected 'mask', 'gridconv', or 'gridconv+'.")
+
+    def get_prediction_multishot(self, pro_n, shot_idx, nshot, query, vis_sim=False, proto_weights=None):
+        """
+        Score the query against the prototype banks of all shots with a single convolution,
+        then take the softmax-weighted similarity within each bank and the max over banks.
+        The per-bank softmax is done with scatter ops over shot_idx, shapes do not depend on the bank sizes
+        Args:
+            pro_n:          [npro, nc], normalized prototypes of all shots, grouped by shot
+            shot_idx:       [npro], shot each prototype belongs to
+            query:          [nq, nc, h, w], normalized query features
+        """
+        dists = F.conv2d(query, pro_n[..., None, None]) * 20 # nq, npro, h, w
+        logits = self._weighted_logits(dists, proto_weights)
+
+        # softmax within each bank: per-bank max, then per-bank sums of exp and exp * dists
+        index = shot_idx[None, :, None, None].expand_as(logits)
+        bank_shape = (dists.shape[0], nshot, *dists.shape[-2:]) # nq, nshot, h, w
+        bank_max = logits.new_zeros(bank_shape).scatter_reduce(1, index, logits, reduce = 'amax', include_self = False)
+        exp_logits = torch.exp(logits - bank_max.gather(1, index))
+        denom = logits.new_zeros(bank_shape).scatter_add(1, index, exp_logits)
+        numer = logits.new_zeros(bank_shape).scatter_add(1, index, exp_logits * dists)
+
+        shot_scores = numer / denom # nq, nshot, h, w
+        pred_grid = shot_scores.max(dim = 1, keepdim = True)[0]
+        debug_assign = dists.argmax(dim = 1).float().detach()
+
+        vis_dict = {'proto_assign': debug_assign}
+        if vis_sim:
+            vis_dict['raw_local_sims'] = dists.clone().detach()
+        return pred_grid, [debug_assign], vis_dict
+
+    @staticmethod
+    def _weighted_logits(dists, proto_weights):
+        # a merged prototype standing for w originals gets the softmax mass of w identical channels
+        if proto_weights is None:
+            return dists
+        return dists + torch.log(proto_weights)[None, :, None, None]
         
-        
+    @staticmethod
+    def upsample_proto_grid(proto_grid, val_wsize):
+        # prototype grid of the first shot, every cell repeated over its val_wsize x val_wsize pooling window.
+        # The per-cell loop this replaces only filled the first 2 columns of each window ("+ 2" instead of
+        # "+ val_wsize"), so the returned grid (visualization only) now covers the whole window
+        return proto_grid[:1, :1].repeat_interleave(val_wsize, dim = 2).repeat_interleave(val_wsize, dim = 3)
+
     def get_prototypes(self, sup_x, sup_y, mode, val_wsize, thresh, isval = False):
         if mode == 'mask':
             proto = torch.sum(sup_x * sup_y, dim=(-1, -2)) \
@@ -122,10 +193,7 @@ class MultiProtoAsConv(nn.Module):
             proto_grid[proto_grid < thresh] = 0
             # interpolate the grid to the original size
             non_zero = torch.nonzero(proto_grid)
-            
-            resized_proto_grid = torch.zeros([1, 1, proto_grid.shape[2]*val_wsize, proto_grid.shape[3]*val_wsize])
-            for index in non_zero:
-                resized_proto_grid[0, 0, index[2]*val_wsize:index[2]*val_wsize + val_wsize, index[3]*val_wsize:index[3]*val_wsize + 2] = proto_grid[0, 0, index[2], index[3]]
+            resized_proto_grid = self.upsample_proto_grid(proto_grid, val_wsize)
             
             sup_y_g = sup_y_g.view( sup_nshot, 1, -1  ).permute(1, 0, 2).view(1, -1).unsqueeze(0)
             protos = n_sup_x[sup_y_g > thresh, :] # npro, nc
@@ -143,11 +211,10 @@ class MultiProtoAsConv(nn.Module):
             proto_grid = sup_y_g.clone().detach()
             proto_grid[proto_grid < thresh] = 0
             non_zero = torch.nonzero(proto_grid)
-            for i, idx in enumerate(non_zero):
-                proto_grid[0, idx[1], idx[2], idx[3]] = i + 1
-            resized_proto_grid = torch.zeros([1, 1, proto_grid.shape[2]*val_wsize, proto_grid.shape[3]*val_wsize])
-            for index in non_zero:
-                resized_proto_grid[0, 0, index[2]*val_wsize:index[2]*val_wsize + val_wsize, index[3]*val_wsize:index[3]*val_wsize + 2] = proto_grid[0, 0, index[2], index[3]]
+            # number the prototype cells 1..npro in row-major order
+            is_proto = proto_grid > 0
+            proto_grid = torch.where(is_proto, is_proto.flatten().cumsum(0).view_as(proto_grid).to(proto_grid.dtype), proto_grid)
+            resized_proto_grid = self.upsample_proto_grid(proto_grid, val_wsize)
             
             sup_y_g = sup_y_g.view( sup_nshot, 1, -1  ).permute(1, 0, 2).view(1, -1).unsqueeze(0)
             protos = n_sup_x[sup_y_g > thresh, :]
@@ -158,6 +225,96 @@ class MultiProtoAsConv(nn.Module):
             pro_n = safe_norm(torch.cat( [protos, glb_proto], dim = 0 ))
         return pro_n, resized_proto_grid, non_zero
 
+    def get_prototype_bank(self, sup_x, sup_y, mode, val_wsize, thresh, isval = False):
+        """
+        get_prototypes followed by the optional compression to max_protos
+        Returns:
+            pro_n:          [npro, nc]
+            proto_weights:  [npro] or None
+            proto_grid:     see get_prototypes
+        """
+        pro_n, proto_grid, proto_indices = self.get_prototypes(sup_x, sup_y, mode, val_wsize, thresh, isval) 
+        if 0 in pro_n.shape:
+            print("failed to find prototypes")
+        proto_weights = None
+        if mode != 'mask' and self.max_protos and pro_n.shape[0] > self.max_protos:
+            pro_n, proto_weights = compress_prototypes(pro_n, self.max_protos)
+        return pro_n, proto_weights, proto_grid
+
+    def get_prototypes_multishot(self, sup_x, sup_y, mode, val_wsize, thresh, isval = False):
+        """
+        Build the prototype banks of all shots in one pass. A shot gets local + global prototypes ('gridconv+')
+        when its mask fills at least one pooling window, otherwise only its global prototype ('mask')
+        Args:
+            sup_x:      [nshot, nc, h, w]
+            sup_y:      [nshot, 1, h, w]
+        Returns:
+            pro_n:          [npro, nc], normalized prototypes of all shots, grouped by shot
+            shot_idx:       [npro], shot each prototype belongs to
+            proto_weights:  [npro] or None, number of merged prototypes when max_protos is set
+            proto_grid:     [nshot, 1, h', w'], pooled masks with cells under thresh zeroed
+        """
+        nshot = sup_x.shape[0]
+        n_sup_x = F.avg_pool2d(sup_x, val_wsize) if isval else self.avg_pool_op( sup_x  )
+        n_sup_x = n_sup_x.flatten(2).permute(0, 2, 1) # nshot, hw', nc
+        sup_y_g = F.avg_pool2d(sup_y, val_wsize) if isval else self.avg_pool_op(sup_y)
+
+        proto_grid = sup_y_g.clone().detach()
+        proto_grid[proto_grid < thresh] = 0
+
+        use_local = F.avg_pool2d(sup_y, self.kernel_size).flatten(1).max(dim = 1)[0] >= thresh
+        if mode == 'mask':
+            use_local = torch.zeros_like(use_local)
+        local_valid = (sup_y_g.flatten(1) > thresh) & use_local[:, None] # nshot, hw'
+
+        glb_proto = torch.sum(sup_x * sup_y, dim=(-1, -2)) \
+            / (sup_y.sum(dim=(-1, -2)) + 1e-5) # nshot, nc
+
+        bank = torch.cat([n_sup_x, glb_proto.unsqueeze(1)], dim = 1) # nshot, hw' + 1, nc
+        valid = torch.cat([local_valid, local_valid.new_ones(nshot, 1)], dim = 1)
+        shot_idx = torch.arange(nshot, device = sup_x.device)[:, None].expand_as(valid)[valid]
+        pro_n = safe_norm(bank[valid])
+
+        proto_weights = None
+        counts = torch.bincount(shot_idx, minlength = nshot)
+        if mode != 'mask' and self.max_protos and counts.max() > self.max_protos:
+            protos, weights, idxs = [], [], []
+            for shot in range(nshot):
+                shot_protos = pro_n[shot_idx == shot]
+                shot_weights = shot_protos.new_ones(shot_protos.shape[0])
+                if shot_protos.shape[0] > self.max_protos:
+                    shot_protos, shot_weights = compress_prototypes(shot_protos, self.max_protos)
+                protos.append(shot_protos)
+                weights.append(shot_weights)
+                idxs.append(shot_idx.new_full((shot_protos.shape[0],), shot))
+            pro_n, proto_weights, shot_idx = torch.cat(protos), torch.cat(weights), torch.cat(idxs)
+
+        return pro_n, shot_idx, proto_weights, proto_grid
+
+    def forward_multishot(self, qry, sup_x, sup_y, mode, thresh, isval = False, val_wsize = None, vis_sim = False):
+        """
+        Same as forward with mode 'gridconv+', but every shot keeps its own prototype bank and the score
+        is the max over shots. All shots are handled in batched tensor ops
+        Args:
+            qry:        [way(1), nb(1), nc, h, w]
+            sup_x:      [way(1), shot, nb(1), nc, h, w]
+            sup_y:      [way(1), shot, nb(1), h, w]
+        """
+        qry = qry.squeeze(1).float() # [way(1), nc, h, w]
+        sup_x = sup_x.flatten(0, 2).float() # [nshot, nc, h, w]
+        sup_y = sup_y.reshape(sup_x.shape[0], 1, sup_x.shape[-2], sup_x.shape[-1]).float()
+        if val_wsize is None:
+            val_wsize = self.avg_pool_op.kernel_size
+            if isinstance(val_wsize, (tuple, list)):
+                val_wsize = val_wsize[0]
+        # prototype pooling and the softmax scoring stay in fp32 under autocast
+        with torch.autocast(device_type = qry.device.type, enabled = False):
+            pro_n, shot_idx, proto_weights, proto_grid = self.get_prototypes_multishot(sup_x, sup_y, mode, val_wsize, thresh, isval)
+            qry_n = safe_norm(qry)
+            pred_grid, debug_assign, vis_dict = self.get_prediction_multishot(pro_n, shot_idx, sup_x.shape[0], qry_n, vis_sim=vis_sim, proto_weights=proto_weights)
+
+        return pred_grid, debug_assign, vis_dict, proto_grid
+
     def forward(self, qry, sup_x, sup_y, mode, thresh, isval = False, val_wsize = None, vis_sim = False, get_prototypes=False, **kwargs):
         """
         Now supports
@@ -175,25 +332,20 @@ class MultiProtoAsConv(nn.Module):
             vis_sim:    visualize raw similarities or not
         """
 
-        qry = qry.squeeze(1) # [way(1), nb(1), nc, hw] -> [way(1), nc, h, w]
-        sup_x = sup_x.squeeze(0).squeeze(1) # [nshot, nc, h, w]
-        sup_y = sup_y.squeeze(0) # [nshot, 1, h, w]
+        qry = qry.squeeze(1).float() # [way(1), nb(1), nc, hw] -> [way(1), nc, h, w]
+        sup_x = sup_x.squeeze(0).squeeze(1).float() # [nshot, nc, h, w]
+        sup_y = sup_y.squeeze(0).float() # [nshot, 1, h, w]
 
-        def safe_norm(x, p = 2, dim = 1, eps = 1e-4):
-            x_norm = torch.norm(x, p = p, dim = dim) # .detach()
-            x_norm = torch.max(x_norm, torch.ones_like(x_norm).cuda() * eps)
-            x = x.div(x_norm.unsqueeze(1).expand_as(x))
-            return x
         if val_wsize is None:
             val_wsize = self.avg_pool_op.kernel_size
             if isinstance(val_wsize, (tuple, list)):
                 val_wsize = val_wsize[0] 
         sup_y = sup_y.reshape(sup_x.shape[0], 1, sup_x.shape[-2], sup_x.shape[-1]) 
-        pro_n, proto_grid, proto_indices = self.get_prototypes(sup_x, sup_y, mode, val_wsize, thresh, isval) 
-        if 0 in pro_n.shape:
-            print("failed to find prototypes")
-        qry_n = qry if mode == 'mask' else safe_norm(qry)
-        pred_grid, debug_assign, vis_dict = self.get_prediction_from_prototypes(pro_n, qry_n, mode, vis_sim=vis_sim) 
+        # prototype pooling and the softmax scoring stay in fp32 under autocast
+        with torch.autocast(device_type = qry.device.type, enabled = False):
+            pro_n, proto_weights, proto_grid = self.get_prototype_bank(sup_x, sup_y, mode, val_wsize, thresh, isval)
+            qry_n = qry if mode == 'mask' else safe_norm(qry)
+            pred_grid, debug_assign, vis_dict = self.get_prediction_from_prototypes(pro_n, qry_n, mode, vis_sim=vis_sim, proto_weights=proto_weights) 
 
         return pred_grid, debug_assign, vis_dict, proto_grid
 
@@ -0,0 +1,241 @@
+"""
+DINOv2 vision transformer, vendored so that the encoder can be built from a local checkpoint without torch.hub.
+Module and parameter names follow facebookresearch/dinov2, so the official weights
+(e.g. dinov2_vitl14_pretrain.pth) load as-is and LoRA injection finds the same Attention / Mlp modules.
+Attention goes through F.scaled_dot_product_attention, except in ONNX export where it is written out.
+"""
+import math
+from functools import partial
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class PatchEmbed(nn.Module):
+    """
+    Image to patch embedding: B x C x H x W -> B x HW x D
+    """
+    def __init__(self, patch_size=14, in_chans=3, embed_dim=1024):
+        super().__init__()
+        self.patch_size = (patch_size, patch_size)
+        self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
+
+    def forward(self, x):
+        x = self.proj(x)  # B D H' W'
+        return x.flatten(2).transpose(1, 2)
+
+
+class Mlp(nn.Module):
+    def __init__(self, in_features, hidden_features, act_layer=nn.GELU, bias=True):
+        super().__init__()
+        self.fc1 = nn.Linear(in_features, hidden_features, bias=bias)
+        self.act = act_layer()
+        self.fc2 = nn.Linear(hidden_features, in_features, bias=bias)
+
+    def forward(self, x):
+        return self.fc2(self.act(self.fc1(x)))
+
+
+class LayerScale(nn.Module):
+    def __init__(self, dim, init_values=1e-5):
+        super().__init__()
+        self.gamma = nn.Parameter(init_values * torch.ones(dim))
+
+    def forward(self, x):
+        return x * self.gamma
+
+
+class Attention(nn.Module):
+    """
+    Multi-head self-attention computed with F.scaled_dot_product_attention
+    """
+    def __init__(self, dim, num_heads=8, qkv_bias=True, proj_bias=True):
+        super().__init__()
+        self.num_heads = num_heads
+        self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
+        self.proj = nn.Linear(dim, dim, bias=proj_bias)
+
+    def forward(self, x):
+        B, N, C = x.shape
+        # 3 x B x nHead x N x C'
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        if torch.onnx.is_in_onnx_export():  # no ONNX symbolic for scaled_dot_product_attention in torch 2.0
+            attn = (qkv[0] * (C // self.num_heads) ** -0.5) @ qkv[1].transpose(-2, -1)
+            x = attn.softmax(dim=-1) @ qkv[2]
+        else:
+            x = F.scaled_dot_product_attention(qkv[0], qkv[1], qkv[2])
+        x = x.transpose(1, 2).reshape(B, N, C)
+        return self.proj(x)
+
+
+class NestedTensorBlock(nn.Module):
+    """
+    Transformer block with layer scale
+    """
+    def __init__(self, dim, num_heads, mlp_ratio=4.0, init_values=1.0, norm_layer=partial(nn.LayerNorm, eps=1e-6)):
+        super().__init__()
+        self.norm1 = norm_layer(dim)
+        self.attn = Attention(dim, num_heads=num_heads)
+        self.ls1 = LayerScale(dim, init_values=init_values)
+        self.norm2 = norm_layer(dim)
+        self.mlp = Mlp(dim, int(dim * mlp_ratio))
+        self.ls2 = LayerScale(dim, init_values=init_values)
+
+    def forward(self, x):
+        x = x + self.ls1(self.attn(self.norm1(x)))
+        x = x + self.ls2(self.mlp(self.norm2(x)))
+        return x
+
+
+class DinoVisionTransformer(nn.Module):
+    def __init__(
+        self,
+        img_size=518,
+        patch_size=14,
+        in_chans=3,
+        embed_dim=1024,
+        depth=24,
+        num_heads=16,
+        mlp_ratio=4.0,
+        init_values=1.0,
+        num_register_tokens=0,
+        interpolate_antialias=False,
+        interpolate_offset=0.1,
+    ):
+        """
+        Args:
+            img_size:               Pre-training input size, the positional embedding is defined for this size
+            patch_size:             Patch size
+            embed_dim:              Patch embedding dimension
+            depth:                  Number of transformer blocks
+            num_heads:              Number of attention heads in each block
+            num_register_tokens:    Number of register tokens (the *_reg models use 4)
+            interpolate_antialias:  Antialias when interpolating the positional embedding
+            interpolate_offset:     Offset used when interpolating the positional embedding, see interpolate_pos_encoding
+        """
+        super().__init__()
+        self.embed_dim = embed_dim
+        self.patch_size = patch_size
+        self.num_register_tokens = num_register_tokens
+        self.interpolate_antialias = interpolate_antialias
+        self.interpolate_offset = interpolate_offset
+
+        self.patch_embed = PatchEmbed(patch_size=patch_size, in_chans=in_chans, embed_dim=embed_dim)
+        num_patches = (img_size // patch_size) ** 2
+        self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
+        self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.register_tokens = (
+            nn.Parameter(torch.zeros(1, num_register_tokens, embed_dim)) if num_register_tokens else None
+        )
+        self.blocks = nn.ModuleList(
+            [NestedTensorBlock(embed_dim, num_heads, mlp_ratio=mlp_ratio, init_values=init_values) for _ in range(depth)]
+        )
+        self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
+        self.head = nn.Identity()
+        self.mask_token = nn.Parameter(torch.zeros(1, embed_dim))
+
+        nn.init.trunc_normal_(self.pos_embed, std=0.02)
+        nn.init.normal_(self.cls_token, std=1e-6)
+        if self.register_tokens is not None:
+            nn.init.normal_(self.register_tokens, std=1e-6)
+
+    def interpolate_pos_encoding(self, x, w, h):
+        previous_dtype = x.dtype
+        npatch = x.shape[1] - 1
+        N = self.pos_embed.shape[1] - 1
+        if npatch == N and w == h:
+            return self.pos_embed
+        pos_embed = self.pos_embed.float()
+        class_pos_embed = pos_embed[:, 0]
+        patch_pos_embed = pos_embed[:, 1:]
+        dim = x.shape[-1]
+        w0 = w // self.patch_size
+        h0 = h // self.patch_size
+        M = int(math.sqrt(N))
+        kwargs = {}
+        if self.interpolate_offset:
+            # the offset avoids floating point error in the bicubic interpolation, see facebookresearch/dino#8
+            kwargs["scale_factor"] = (float(w0 + self.interpolate_offset) / M, float(h0 + self.interpolate_offset) / M)
+        else:
+            kwargs["size"] = (w0, h0)
+        patch_pos_embed = F.interpolate(
+            patch_pos_embed.reshape(1, M, M, dim).permute(0, 3, 1, 2),
+            mode="bicubic",
+            antialias=self.interpolate_antialias,
+            **kwargs,
+        )
+        assert (w0, h0) == patch_pos_embed.shape[-2:]
+        patch_pos_embed = patch_pos_embed.permute(0, 2, 3, 1).view(1, -1, dim)
+        return torch.cat((class_pos_embed.unsqueeze(0), patch_pos_embed), dim=1).to(previous_dtype)
+
+    def prepare_tokens_with_masks(self, x, masks=None):
+        """
+        Returns:
+            B x (1 + num_register_tokens + HW) x D tokens: CLS, registers, patches
+        """
+        B, nc, w, h = x.shape
+        x = self.patch_embed(x)
+        if masks is not None:
+            x = torch.where(masks.unsqueeze(-1), self.mask_token.to(x.dtype).unsqueeze(0), x)
+        x = torch.cat((self.cls_token.expand(x.shape[0], -1, -1), x), dim=1)
+        x = x + self.interpolate_pos_encoding(x, w, h)
+        if self.register_tokens is not None:
+            x = torch.cat((x[:, :1], self.register_tokens.expand(x.shape[0], -1, -1), x[:, 1:]), dim=1)
+        return x
+
+    def forward_features(self, x, masks=None):
+        x = self.prepare_tokens_with_masks(x, masks)
+        for blk in self.blocks:
+            x = blk(x)
+        x_norm = self.norm(x)
+        return {
+            "x_norm_clstoken": x_norm[:, 0],
+            "x_norm_regtokens": x_norm[:, 1: self.num_register_tokens + 1],
+            "x_norm_patchtokens": x_norm[:, self.num_register_tokens + 1:],
+            "x_prenorm": x,
+            "masks": masks,
+        }
+
+    def forward(self, x, masks=None):
+        return self.head(self.forward_features(x, masks)["x_norm_clstoken"])
+
+
+def build_dinov2_vitl14(checkpoint=None):
+    return _build_dinov2(embed_dim=1024, depth=24, num_heads=16, checkpoint=checkpoint)
+
+
+def build_dinov2_vitl14_reg(checkpoint=None):
+    return _build_dinov2(embed_dim=1024, depth=24, num_heads=16, num_register_tokens=4,
+                         interpolate_antialias=True, interpolate_offset=0.0, checkpoint=checkpoint)
+
+
+def build_dinov2_vitb14(checkpoint=None):
+    return _build_dinov2(embed_dim=768, depth=12, num_heads=12, checkpoint=checkpoint)
+
+
+# keyed by FewShotSeg's config['which_model']
+dinov2_model_registry = {
+    "dinov2_l14": build_dinov2_vitl14,
+    "dinov2_l14_reg": build_dinov2_vitl14_reg,
+    "dinov2_b14": build_dinov2_vitb14,
+}
+
+
+def _build_dinov2(embed_dim, depth, num_heads, num_register_tokens=0, interpolate_antialias=False,
+                  interpolate_offset=0.1, checkpoint=None):
+    model = DinoVisionTransformer(
+        img_size=518,
+        patch_size=14,
+        embed_dim=embed_dim,
+        depth=depth,
+        num_heads=num_heads,
+        num_register_tokens=num_register_tokens,
+        interpolate_antialias=interpolate_antialias,
+        interpolate_offset=interpolate_offset,
+    )
+    if checkpoint is not None:
+        with open(checkpoint, "rb") as f:
+            state_dict = torch.load(f, map_location="cpu")
+        model.load_state_dict(state_dict, strict=True)
+    return model
@@ -4,12 +4,19 @@ ALPNet
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .alpmodule import MultiProtoAsConv
+from .alpmodule import MultiProtoAsConv, safe_norm
 from .backbone.torchvision_backbones import TVDeeplabRes101Encoder
+from .backbone.dinov2 import dinov2_model_registry
 from util.consts import DEFAULT_FEATURE_SIZE
-from util.lora import inject_trainable_lora
+from util.lora import inject_trainable_lora, merge_lora, unmerge_lora, save_lora_adapter, load_lora_adapter, set_lora_adapter
+from util.quantization import quantize_linear_int8, save_quantized, load_quantized
+from util.compile_utils import BATCH_BUCKETS, pad_batch, compile_forward
+from util.onnx_utils import export_fewshotseg_encoder, load_or_export
+from util.checkpoint import skip_init, load_weights, build_model
 # from util.utils import load_config_from_url, plot_dinov2_fts
 import math
+import os
+from collections import Counter
 
 # Specify a local path to the repository (or use installed package instead)
 FG_PROT_MODE = 'gridconv+' # using both local and global prototype
@@ -37,40 +44,54 @@ class FewShotSeg(nn.Module):
         print(f'###### Pre-trained path: {self.pretrained_path} ######')
         self.config = cfg or {
             'align': False, 'debug': False}
-        self.get_encoder()
-        self.get_cls()
+        self.adapters = {}  # LoRA adapters kept in memory, by name
+        self.active_adapter = None
+        self.batch_buckets = None  # set by compile_for_inference
+        self.cls_units = {}  # classifier and feature size of each native_tokens setting used so far, see set_native_tokens
+        self.onnx_encoder = None  # set by use_onnx_runtime
+        # the snapshot holds all weights, random init and pretrained encoder weights would be overwritten
+        with skip_init(enabled=bool(self.pretrained_path)):
+            self.get_encoder()
+            self.get_cls()
         if self.pretrained_path:
-            self.load_state_dict(torch.load(self.pretrained_path), strict=True)
+            load_weights(self, self.pretrained_path, strict=True)
             print(
                 f'###### Pre-trained model f{self.pretrained_path} has been loaded ######')
+        if self.config.get('lora_adapter'):
+            self.load_adapter('default', self.config['lora_adapter'])
+            self.set_adapter('default')
 
     def get_encoder(self):
         self.config['feature_hw'] = [DEFAULT_FEATURE_SIZE,
                                      DEFAULT_FEATURE_SIZE]  # default feature map size
+        load_pretrained = not self.pretrained_path  # the snapshot overwrites the pretrained DINOv2 weights
         if self.config['which_model'] == 'dlfcn_res101' or self.config['which_model'] == 'default':
             use_coco_init = self.config['use_coco_init']
             self.encoder = TVDeeplabRes101Encoder(use_coco_init)
             self.config['feature_hw'] = [
                 math.ceil(self.image_size/8), math.ceil(self.image_size/8)]
+        elif self.config['which_model'] in dinov2_model_registry and self.config.get('dinov2_weights'):
+            # in-repo DINOv2 from a local checkpoint, no torch.hub / network access needed
+            print(f'###### NETWORK: Loading DINOv2 weights from {self.config["dinov2_weights"]} ######')
+            self.encoder = build_model(dinov2_model_registry[self.config['which_model']],
+                                       checkpoint=self.config['dinov2_weights'] if load_pretrained else None)
+            self.config['feature_hw'] = self.get_dino_feature_hw()
         elif self.config['which_model'] == 'dinov2_l14':
             self.encoder = torch.hub.load(
-                'facebookresearch/dinov2', 'dinov2_vitl14')
-            self.config['feature_hw'] = [max(
-                self.image_size//14, DEFAULT_FEATURE_SIZE), max(self.image_size//14, DEFAULT_FEATURE_SIZE)]
+                'facebookresearch/dinov2', 'dinov2_vitl14', pretrained=load_pretrained)
+            self.config['feature_hw'] = self.get_dino_feature_hw()
         elif self.config['which_model'] == 'dinov2_l14_reg':
             try:
                 self.encoder = torch.hub.load(
-                    'facebookresearch/dinov2', 'dinov2_vitl14_reg')
+                    'facebookresearch/dinov2', 'dinov2_vitl14_reg', pretrained=load_pretrained)
             except RuntimeError as e:
                 self.encoder = torch.hub.load(
-                    'facebookresearch/dino', 'dinov2_vitl14_reg', force_reload=True)
-            self.config['feature_hw'] = [max(
-                self.image_size//14, DEFAULT_FEATURE_SIZE), max(self.image_size//14, DEFAULT_FEATURE_SIZE)]
+                    'facebookresearch/dino', 'dinov2_vitl14_reg', force_reload=True, pretrained=load_pretrained)
+            self.config['feature_hw'] = self.get_dino_feature_hw()
         elif self.config['which_model'] == 'dinov2_b14':
             self.encoder = torch.hub.load(
-                'facebookresearch/dinov2', 'dinov2_vitb14')
-            self.config['feature_hw'] = [max(
-                self.image_size//14, DEFAULT_FEATURE_SIZE), max(self.image_size//14, DEFAULT_FEATURE_SIZE)]
+                'facebookresearch/dinov2', 'dinov2_vitb14', pretrained=load_pretrained)
+            self.config['feature_hw'] = self.get_dino_feature_hw()
         else:
             raise NotImplementedError(
                 f'Backbone network {self.config["which_model"]} not implemented')
@@ -81,26 +102,215 @@ class FewShotSeg(nn.Module):
             encoder_lora_params = inject_trainable_lora(
                 self.encoder, r=self.config['lora'])
 
-    def get_features(self, imgs_concat):
+    def get_dino_feature_hw(self):
+        """
+        Feature map size of the DINOv2 encoders: the patch token grid, upsampled to at least DEFAULT_FEATURE_SIZE
+        unless config['native_tokens'] is set
+        """
+        n_tokens = self.image_size // 14
+        if not self.config.get('native_tokens', False):
+            n_tokens = max(n_tokens, DEFAULT_FEATURE_SIZE)
+        return [n_tokens, n_tokens]
+
+    def set_native_tokens(self, native_tokens):
+        """
+        Switch between matching on the native DINOv2 token grid and on the upsampled DEFAULT_FEATURE_SIZE grid.
+        The classifier has no learnable weights, it is built for the new feature size the first time a setting is
+        used and kept, so switching back and forth is free and keeps a compiled classifier compiled
+        """
+        if 'dino' not in self.config['which_model']:
+            self.config['native_tokens'] = native_tokens
+            return
+        self.cls_units[self.config.get('native_tokens', False)] = (self.cls_unit, self.config['feature_hw'])
+        self.config['native_tokens'] = native_tokens
+        if native_tokens in self.cls_units:
+            self.cls_unit, self.config['feature_hw'] = self.cls_units[native_tokens]
+            return
+        self.config['feature_hw'] = self.get_dino_feature_hw()
+        self.get_cls()
+        if self.batch_buckets is not None:  # compiled for inference
+            self.compile_cls()
+
+    def get_val_wsize(self, val_wsize):
+        """
+        val_wsize is given w.r.t. the DEFAULT_FEATURE_SIZE grid, rescale it to the native token grid if needed
+        """
+        if val_wsize is None or not self.config.get('native_tokens', False) or 'dino' not in self.config['which_model']:
+            return val_wsize
+        return max(1, round(val_wsize * self.config['feature_hw'][0] / DEFAULT_FEATURE_SIZE))
+
+    def merge_lora(self, merge=True):
+        """
+        Fold (merge=True) or unfold (merge=False) the encoder LoRA weights into the base weights.
+        Merged, the encoder costs the same as the base model; unmerge before training again
+        """
+        if self.config['lora'] > 0:
+            print(f'###### {"Merging" if merge else "Unmerging"} LoRA weights of the encoder ######')
+            if merge:
+                merge_lora(self.encoder)
+            else:
+                unmerge_lora(self.encoder)
+
+    def save_adapter(self, path):
+        """
+        Save the encoder LoRA weights only (.pt or .safetensors), a few MB instead of a full snapshot
+        """
+        save_lora_adapter(self.encoder, path)
+
+    def load_adapter(self, name, path):
+        """
+        Read a LoRA adapter into memory on the encoder device, so that set_adapter is only an in-place copy
+        """
+        device = next(self.encoder.parameters()).device
+        self.adapters[name] = load_lora_adapter(path, device=device)
+        print(f'###### LoRA adapter {name} loaded from {path} ######')
+
+    def set_adapter(self, name):
+        """
+        Switch the encoder to a loaded adapter, the base encoder weights are untouched
+        """
+        set_lora_adapter(self.encoder, self.adapters[name])
+        self.active_adapter = name
+
+    def quantize_int8(self, path=None):
+        """
+        CPU inference: dynamic int8 quantization of the encoder linear layers, LoRA weights are merged first.
+        If path exists the int8 encoder is loaded from it, otherwise the quantized encoder is saved to path
+        """
+        self.merge_lora()
+        if path is not None and os.path.exists(path):
+            self.encoder = load_quantized(self.encoder, path)
+            print(f'###### int8 encoder loaded from {path} ######')
+        else:
+            self.encoder = quantize_linear_int8(self.encoder)
+            if path is not None:
+                save_quantized(self.encoder, path)
+                print(f'###### int8 encoder saved to {path} ######')
+
+    def compile_for_inference(self, batch_buckets=BATCH_BUCKETS, warmup=True):
+        """
+        Opt-in torch.compile of the encoder and of the prototype scoring, for inference.
+        The encoder batch is padded to batch_buckets so that it compiles once per bucket. The scoring is compiled
+        with dynamic shapes, the number of prototypes changes with the support. Prototype extraction (boolean
+        masking, data dependent shapes) stays eager. Classifiers built later by set_native_tokens are compiled too
+        """
+        print(f'###### Compiling the encoder (batch buckets {batch_buckets}) and the prototype scoring ######')
+        self.batch_buckets = batch_buckets
+        encoder_fn = 'forward_features' if 'dino' in self.config['which_model'] else 'forward'
+        compile_forward(self.encoder, encoder_fn, dynamic=False)
+        self.compile_cls()
+        if warmup:
+            self.warmup()
+
+    def compile_cls(self):
+        compile_forward(self.cls_unit, 'get_prediction_from_prototypes', dynamic=True)
+        compile_forward(self.cls_unit, 'get_prediction_multishot', dynamic=True)
+
+    @torch.no_grad()
+    def warmup(self, n_shots=1):
+        """
+        Run the encoder once per batch bucket and a full forward on a synthetic episode,
+        so that compilation happens before the first real slice
+        """
+        device = next(self.parameters()).device
+        img = torch.zeros(1, 3, self.image_size, self.image_size, device=device)
+        for bucket in self.batch_buckets or (1,):
+            self.get_features(img.expand(bucket, -1, -1, -1))
+        mask = torch.zeros(1, self.image_size, self.image_size, device=device)
+        mask[:, self.image_size // 4: 3 * self.image_size // 4, self.image_size // 4: 3 * self.image_size // 4] = 1
+        self.forward([[img] * n_shots], [[mask] * n_shots], [[1 - mask] * n_shots], [img], isval=True, val_wsize=2)
+
+    def use_onnx_runtime(self, path):
+        """
+        CPU inference: compute the features with ONNX Runtime, the encoder is exported to path if it does not exist.
+        The prototype head stays in PyTorch. Inputs at an encoder size other than self.image_size
+        (see forward_resolutions) still go through the PyTorch encoder
+        """
+        self.onnx_encoder = None  # the export and its parity check run the PyTorch encoder
+        self.onnx_encoder = load_or_export(path, lambda onnx_path: export_fewshotseg_encoder(self, onnx_path))
+        print(f'###### Encoder runs with ONNX Runtime from {path} ######')
+
+    def get_features(self, imgs_concat, image_size=None):
+        """
+        Args:
+            image_size: encoder input size, defaults to self.image_size for DINOv2 and to the input size for the resnet
+        """
+        if self.onnx_encoder is not None and image_size in (None, self.image_size):
+            return self.onnx_encoder(imgs_concat)
+        n_imgs = imgs_concat.shape[0]
+        if self.batch_buckets is not None:
+            imgs_concat, _ = pad_batch(imgs_concat, self.batch_buckets)
         if self.config['which_model'] == 'dlfcn_res101':
+            if image_size is not None and imgs_concat.shape[-1] != image_size:
+                imgs_concat = F.interpolate(imgs_concat, size=(
+                    image_size, image_size), mode='bilinear')
             img_fts = self.encoder(imgs_concat, low_level=False)
         elif 'dino' in self.config['which_model']:
+            image_size = image_size or self.image_size
             # resize imgs_concat to the closest size that is divisble by 14
             imgs_concat = F.interpolate(imgs_concat, size=(
-                self.image_size // 14 * 14, self.image_size // 14 * 14), mode='bilinear')
-            dino_fts = self.encoder.forward_features(imgs_concat)
-            img_fts = dino_fts["x_norm_patchtokens"]  # B, HW, C
+                image_size // 14 * 14, image_size // 14 * 14), mode='bilinear')
+            if self.config.get('body_token_thresh') is not None:
+                img_fts = self.forward_body_tokens(imgs_concat)  # B, HW, C
+            else:
+                dino_fts = self.encoder.forward_features(imgs_concat)
+                img_fts = dino_fts["x_norm_patchtokens"]  # B, HW, C
             img_fts = img_fts.permute(0, 2, 1)  # B, C, HW
             C, HW = img_fts.shape[-2:]
             img_fts = img_fts.view(-1, C, int(HW**0.5),
                                    int(HW**0.5))  # B, C, H, W
-            if HW < DEFAULT_FEATURE_SIZE ** 2:
+            if HW < DEFAULT_FEATURE_SIZE ** 2 and not self.config.get('native_tokens', False):
                 img_fts = F.interpolate(img_fts, size=(
                     DEFAULT_FEATURE_SIZE, DEFAULT_FEATURE_SIZE), mode='bilinear')  # this is if h,w < (32,32)
         else:
             raise NotImplementedError(
                 f'Backbone network {self.config["which_model"]} not implemented')
         
+        return img_fts[:n_imgs]
+
+    def get_body_token_mask(self, imgs):
+        """
+        Cheap intensity-based body mask on the DINOv2 patch grid
+        A patch is on the body if any of its pixels is above body_token_thresh of the per-image intensity range
+        Args:
+            imgs: B x 3 x H x W, H and W divisible by 14
+        Returns:
+            keep: B x HW, body patches dilated by one patch so that the body boundary keeps its context
+            body: B x HW, body patches
+        """
+        img = imgs.mean(dim=1, keepdim=True)
+        img_min = img.amin(dim=(-1, -2), keepdim=True)
+        img_max = img.amax(dim=(-1, -2), keepdim=True)
+        body = ((img - img_min) > self.config['body_token_thresh'] * (img_max - img_min)).float()
+        body = F.max_pool2d(body, 14)  # B x 1 x h x w
+        keep = F.max_pool2d(body, 3, stride=1, padding=1)
+        return keep.flatten(1) > 0, body.flatten(1) > 0
+
+    def forward_body_tokens(self, imgs):
+        """
+        DINOv2 forward where only the body patch tokens (plus CLS and register tokens) go through the transformer blocks
+        The kept set is the union over the batch so that the batch stays dense. Dropped (air) positions are filled with
+        the mean output of the kept tokens around the body, which are air themselves
+        Returns:
+            patch tokens, B x HW x C, same as forward_features(imgs)["x_norm_patchtokens"]
+        """
+        keep, body = self.get_body_token_mask(imgs)
+        keep_idx = torch.nonzero(keep.any(dim=0)).squeeze(1)
+        n_prefix = 1 + getattr(self.encoder, 'num_register_tokens', 0)
+        if keep_idx.shape[0] == keep.shape[1]:  # nothing to drop
+            return self.encoder.forward_features(imgs)["x_norm_patchtokens"]
+
+        x = self.encoder.prepare_tokens_with_masks(imgs)  # B x (n_prefix + HW) x C
+        x = torch.cat([x[:, :n_prefix], x[:, n_prefix + keep_idx]], dim=1)
+        for blk in self.encoder.blocks:
+            x = blk(x)
+        kept_fts = self.encoder.norm(x)[:, n_prefix:]  # B x n_keep x C
+
+        # fill value: mean over the kept tokens that are not on the body of that image
+        ring = (~body[:, keep_idx]).unsqueeze(-1).to(kept_fts.dtype)  # B x n_keep x 1
+        fill = (kept_fts * ring).sum(dim=1, keepdim=True) / ring.sum(dim=1, keepdim=True).clamp(min=1)
+        img_fts = fill.expand(-1, keep.shape[1], -1).clone()
+        img_fts[:, keep_idx] = kept_fts
         return img_fts
 
     def get_cls(self):
@@ -115,27 +325,89 @@ class FewShotSeg(nn.Module):
                 embed_dim = 768
             elif 'dinov2_l14' in self.config['which_model']:
                 embed_dim = 1024
-            self.cls_unit = MultiProtoAsConv(proto_grid=[proto_hw, proto_hw], feature_hw=self.config["feature_hw"], embed_dim=embed_dim)  # when treating it as ordinary prototype
+            self.cls_unit = MultiProtoAsConv(proto_grid=[proto_hw, proto_hw], feature_hw=self.config["feature_hw"], embed_dim=embed_dim,
+                                             max_protos=self.config.get('max_protos'))  # when treating it as ordinary prototype
             print(f"cls unit feature hw: {self.cls_unit.feature_hw}")
         else:
             raise NotImplementedError(
                 f'Classifier {self.config["cls_name"]} not implemented')
 
+    def get_encoder_input_size(self, res):
+        """
+        Input size actually seen by the encoder for an image resized to res, inputs that map to the
+        same size (e.g. same DINOv2 token grid) give identical features
+        """
+        if 'dino' in self.config['which_model']:
+            return res // 14 * 14
+        return res
+
     def forward_resolutions(self, resolutions, supp_imgs, fore_mask, back_mask, qry_imgs, isval, val_wsize, show_viz=False, supp_fts=None):
-        predictions = []
-        for res in resolutions:
-            supp_imgs_resized = [[F.interpolate(supp_img[0], size=(
-                res, res), mode='bilinear') for supp_img in supp_imgs]] if supp_imgs[0][0].shape[-1] != res else supp_imgs
-            fore_mask_resized = [[F.interpolate(fore_mask_way[0].unsqueeze(0), size=(res, res), mode='bilinear')[
-                0] for fore_mask_way in fore_mask]] if fore_mask[0][0].shape[-1] != res else fore_mask
-            back_mask_resized = [[F.interpolate(back_mask_way[0].unsqueeze(0), size=(res, res), mode='bilinear')[
-                0] for back_mask_way in back_mask]] if back_mask[0][0].shape[-1] != res else back_mask
-            qry_imgs_resized = [F.interpolate(qry_img, size=(res, res), mode='bilinear')
-                                for qry_img in qry_imgs] if qry_imgs[0][0].shape[-1] != res else qry_imgs
-
-            pred = self.forward(supp_imgs_resized, fore_mask_resized, back_mask_resized,
-                                qry_imgs_resized, isval, val_wsize, show_viz, supp_fts)[0]
-            predictions.append(pred)
+        """
+        Multi-scale coarse prediction.
+        The support prototypes are built once, from the support encoded at self.image_size, and matched against
+        the query encoded at every resolution. Resolutions that give the same encoder input size share one query
+        encoding, and the support is encoded in the same call as the query when their sizes match. Inputs of
+        different token counts cannot share a ViT call, so there is one encoder call per distinct size.
+        Args:
+            resolutions: list of query resolutions
+            see forward for the rest
+        Returns:
+            output: logits averaged over the resolutions, N x (1 + Wa) x H x W
+        """
+        n_ways = len(supp_imgs)
+        n_shots = len(supp_imgs[0])
+        assert n_ways == 1, "Multi-shot has not been implemented yet"
+        assert len(qry_imgs) == 1
+
+        img_size = qry_imgs[0].shape[-2:]
+        qry_img = torch.cat(qry_imgs, dim=0)
+        supp_img = torch.cat([torch.cat(way, dim=0) for way in supp_imgs], dim=0)
+        n_supp = supp_img.shape[0]
+        supp_size = self.get_encoder_input_size(self.image_size)
+        # resolutions mapping to the same encoder input size give identical logits, count them instead
+        enc_sizes = Counter(self.get_encoder_input_size(res) for res in resolutions)
+
+        ###### Encode: one call per distinct encoder input size ######
+        qry_fts_by_size = {}
+        for enc_size in enc_sizes:
+            if supp_fts is None and enc_size == supp_size:
+                img_fts = self.get_features(torch.cat([supp_img, qry_img], dim=0), enc_size)
+                supp_fts = img_fts[:n_supp]
+                qry_fts_by_size[enc_size] = img_fts[n_supp:]
+            else:
+                qry_fts_by_size[enc_size] = self.get_features(qry_img, enc_size)
+        if supp_fts is None:
+            supp_fts = self.get_features(supp_img, supp_size)
+        supp_fts = supp_fts.reshape(n_supp, *supp_fts.shape[-3:])  # Sh*B x C x H' x W'
+        fts_size = supp_fts.shape[-2:]
+
+        ###### Support prototypes, shared by all resolutions ######
+        fore_mask = torch.stack([torch.stack(way, dim=0)
+                                 for way in fore_mask], dim=0)  # Wa x Sh x B x H x W
+        back_mask = torch.stack([torch.stack(way, dim=0)
+                                 for way in back_mask], dim=0)
+        res_fg_msk = F.interpolate(fore_mask[0], size=fts_size, mode='nearest').reshape(n_supp, 1, *fts_size)
+        res_bg_msk = F.interpolate(back_mask[0], size=fts_size, mode='nearest').reshape(n_supp, 1, *fts_size)
+        val_wsize = self.get_val_wsize(val_wsize)
+        if val_wsize is None:
+            val_wsize = self.cls_unit.kernel_size[0]
+        bg_protos, bg_weights, _ = self.cls_unit.get_prototype_bank(
+            supp_fts, res_bg_msk, BG_PROT_MODE, val_wsize, BG_THRESH, isval)
+        fg_protos, fg_shot_idx, fg_weights, _ = self.cls_unit.get_prototypes_multishot(
+            supp_fts, res_fg_msk, FG_PROT_MODE, val_wsize, FG_THRESH, isval)
+
+        ###### Score every resolution and fuse ######
+        outputs = []
+        for enc_size in enc_sizes:
+            qry_n = safe_norm(qry_fts_by_size[enc_size])
+            bg_score = self.cls_unit.get_prediction_from_prototypes(
+                bg_protos, qry_n, BG_PROT_MODE, proto_weights=bg_weights)[0]
+            fg_score = self.cls_unit.get_prediction_multishot(
+                fg_protos, fg_shot_idx, n_supp, qry_n, proto_weights=fg_weights)[0]
+            pred = torch.cat([bg_score, fg_score], dim=1)  # N x (1 + Wa) x H' x W'
+            outputs.append(F.interpolate(pred, size=img_size, mode='bilinear') * enc_sizes[enc_size])
+
+        return torch.stack(outputs, dim=0).sum(dim=0) / len(resolutions)
 
     def resize_inputs_to_image_size(self, supp_imgs, fore_mask, back_mask, qry_imgs):
         supp_imgs = [[F.interpolate(supp_img, size=(
@@ -168,6 +440,7 @@ class FewShotSeg(nn.Module):
         n_ways = len(supp_imgs)
         n_shots = len(supp_imgs[0])
         n_queries = len(qry_imgs)
+        val_wsize = self.get_val_wsize(val_wsize)
 
         # NOTE: actual shot in support goes in batch dimension
         assert n_ways == 1, "Multi-shot has not been implemented yet"
@@ -243,26 +516,9 @@ class FewShotSeg(nn.Module):
             assign_maps.append(aux_attr['proto_assign'])
             
             for way, _msks in enumerate(res_fg_msk):
-                raw_scores = []
-                for i, _msk in enumerate(_msks):
-                    _msk = _msk.unsqueeze(0)
-                    supp_ft = supp_fts[:, i].unsqueeze(0)
-                    if self.config["cls_name"] == 'grid_proto_3d':  # 3D
-                        k_size = self.cls_unit.kernel_size
-                        fg_mode = FG_PROT_MODE if F.avg_pool3d(_msk, k_size).max(
-                        ) >= FG_THRESH and FG_PROT_MODE != 'mask' else 'mask'  # TODO figure out kernel size
-                    else:
-                        k_size = self.cls_unit.kernel_size
-                        fg_mode = FG_PROT_MODE if F.avg_pool2d(_msk, k_size).max(
-                        ) >= FG_THRESH and FG_PROT_MODE != 'mask' else 'mask'
-                        # TODO figure out kernel size
-                    _raw_score, _, aux_attr, proto_grid = self.cls_unit(qry_fts, supp_ft, _msk.unsqueeze(
-                        0), mode=fg_mode, thresh=FG_THRESH, isval=isval, val_wsize=val_wsize, vis_sim=show_viz)
-                    raw_scores.append(_raw_score)
-
-                # create a score where each feature is the max of the raw_score
-                _raw_score = torch.stack(raw_scores, dim=1).max(dim=1)[
-                    0] 
+                # all shots are scored in one pass; each keeps its own prototype bank and the max over shots is taken
+                _raw_score, _, aux_attr, proto_grid = self.cls_unit.forward_multishot(qry_fts, supp_fts[way: way + 1], _msks.unsqueeze(
+                    0), mode=FG_PROT_MODE, thresh=FG_THRESH, isval=isval, val_wsize=val_wsize, vis_sim=show_viz)
                 scores.append(_raw_score)
                 assign_maps.append(aux_attr['proto_assign'])
                 if show_viz:
@@ -326,52 +582,53 @@ class FewShotSeg(nn.Module):
         for way in range(n_ways):
             if way in skip_ways:
                 continue
-            # Get the query prototypes
-            for shot in range(n_shots):
-                # actual local query [way(1), nb(1, nb is now nshot), nc, h, w]
-                img_fts = supp_fts[way: way + 1, shot: shot + 1]
-                size = img_fts.shape[-2:]
-                mode = 'bilinear'
-                if self.config["cls_name"] == 'grid_proto_3d':
-                    size = img_fts.shape[-3:]
-                    mode = 'trilinear'
-                qry_pred_fg_msk = F.interpolate(
-                    binary_masks[way + 1].float(), size=size, mode=mode)  # [1 (way), n (shot), h, w]
-
-                # background
-                qry_pred_bg_msk = F.interpolate(
-                    binary_masks[0].float(), size=size, mode=mode)  # 1, n, h ,w
-                scores = []
-
-                bg_mode = BG_PROT_MODE
-                _raw_score_bg, _, _, _ = self.cls_unit(
-                    qry=img_fts, sup_x=qry_fts, sup_y=qry_pred_bg_msk.unsqueeze(-3), mode=bg_mode, thresh=BG_THRESH)
-
-                scores.append(_raw_score_bg)
-                if self.config["cls_name"] == 'grid_proto_3d':
-                    fg_mode = FG_PROT_MODE if F.avg_pool3d(qry_pred_fg_msk, 4).max(
-                    ) >= FG_THRESH and FG_PROT_MODE != 'mask' else 'mask'
-                else:
-                    fg_mode = FG_PROT_MODE if F.avg_pool2d(qry_pred_fg_msk, 4).max(
-                    ) >= FG_THRESH and FG_PROT_MODE != 'mask' else 'mask'
-                _raw_score_fg, _, _, _ = self.cls_unit(
-                    qry=img_fts, sup_x=qry_fts, sup_y=qry_pred_fg_msk.unsqueeze(2), mode=fg_mode, thresh=FG_THRESH)
-                scores.append(_raw_score_fg)
-
-                supp_pred = torch.cat(scores, dim=1)  # N x (1 + Wa) x H' x W'
-                size = fore_mask.shape[-2:]
-                if self.config["cls_name"] == 'grid_proto_3d':
-                    size = fore_mask.shape[-3:]
-                supp_pred = F.interpolate(supp_pred, size=size, mode=mode)
-
-                # Construct the support Ground-Truth segmentation
-                supp_label = torch.full_like(fore_mask[way, shot], 255,
-                                             device=img_fts.device).long()
-                supp_label[fore_mask[way, shot] == 1] = 1
-                supp_label[back_mask[way, shot] == 1] = 0
-                # Compute Loss
-                loss.append(F.cross_entropy(
-                    supp_pred.float(), supp_label[None, ...], ignore_index=255) / n_shots / n_ways)
+            # the query prototypes are shared, so all shots are scored at once: [nshot, nc, h, w]
+            img_fts = supp_fts[way]
+            size = img_fts.shape[-2:]
+            mode = 'bilinear'
+            if self.config["cls_name"] == 'grid_proto_3d':
+                size = img_fts.shape[-3:]
+                mode = 'trilinear'
+            qry_pred_fg_msk = F.interpolate(
+                binary_masks[way + 1].float(), size=size, mode=mode)  # [1 (way), n (shot), h, w]
+
+            # background
+            qry_pred_bg_msk = F.interpolate(
+                binary_masks[0].float(), size=size, mode=mode)  # 1, n, h ,w
+            scores = []
+
+            bg_mode = BG_PROT_MODE
+            _raw_score_bg, _, _, _ = self.cls_unit(
+                qry=img_fts.unsqueeze(1), sup_x=qry_fts, sup_y=qry_pred_bg_msk.unsqueeze(-3), mode=bg_mode, thresh=BG_THRESH)
+
+            scores.append(_raw_score_bg)
+            if self.config["cls_name"] == 'grid_proto_3d':
+                fg_mode = FG_PROT_MODE if F.avg_pool3d(qry_pred_fg_msk, 4).max(
+                ) >= FG_THRESH and FG_PROT_MODE != 'mask' else 'mask'
+            else:
+                fg_mode = FG_PROT_MODE if F.avg_pool2d(qry_pred_fg_msk, 4).max(
+                ) >= FG_THRESH and FG_PROT_MODE != 'mask' else 'mask'
+            _raw_score_fg, _, _, _ = self.cls_unit(
+                qry=img_fts.unsqueeze(1), sup_x=qry_fts, sup_y=qry_pred_fg_msk.unsqueeze(2), mode=fg_mode, thresh=FG_THRESH)
+            scores.append(_raw_score_fg)
+
+            supp_pred = torch.cat(scores, dim=1)  # Sh x (1 + Wa) x H' x W'
+            size = fore_mask.shape[-2:]
+            if self.config["cls_name"] == 'grid_proto_3d':
+                size = fore_mask.shape[-3:]
+            supp_pred = F.interpolate(supp_pred, size=size, mode=mode)
+
+            # Construct the support Ground-Truth segmentation
+            supp_label = torch.full_like(fore_mask[way], 255,
+                                         device=img_fts.device).long()  # Sh x H x W
+            supp_label[fore_mask[way] == 1] = 1
+            supp_label[back_mask[way] == 1] = 0
+            # Compute Loss, averaged over the labelled pixels of each shot separately
+            shot_loss = F.cross_entropy(
+                supp_pred.float(), supp_label, ignore_index=255, reduction='none')
+            shot_loss = shot_loss.flatten(1).sum(dim=1) / \
+                (supp_label != 255).flatten(1).sum(dim=1)
+            loss.append(shot_loss.sum() / n_shots / n_ways)
 
         return torch.sum(torch.stack(loss))
 
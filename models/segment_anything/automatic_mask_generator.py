@@ -12,6 +12,7 @@ from typing import Any, Dict, List, Optional, Tuple
 
 from .modeling import Sam
 from .predictor import SamPredictor
+from .batch_predictor import SamBatchPredictor
 from .utils.amg import (
     MaskData,
     area_from_rle,
@@ -122,6 +123,7 @@ class SamAutomaticMaskGenerator:
             import cv2  # type: ignore # noqa: F401
 
         self.predictor = SamPredictor(model)
+        self.batch_predictor = SamBatchPredictor(model)
         self.points_per_batch = points_per_batch
         self.pred_iou_thresh = pred_iou_thresh
         self.stability_score_thresh = stability_score_thresh
@@ -196,6 +198,159 @@ class SamAutomaticMaskGenerator:
 
         return curr_anns
 
+    @torch.no_grad()
+    def generate_dense(self, image: np.ndarray, crop_batch_size: int = 4) -> Dict[str, torch.Tensor]:
+        """
+        Generates masks for the given image like 'generate', but the masks
+        stay dense boolean tensors on the model's device: there is no RLE
+        encoding and no per-mask records. The crops of all layers are encoded
+        in batches, and the point prompts of all crops are decoded together.
+        min_mask_region_area postprocessing is not applied.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          crop_batch_size (int): The number of crops per image encoder call.
+
+        Returns:
+          dict(str, torch.Tensor): With N the number of masks kept,
+            masks (N x H x W bool), iou_preds (N), stability_score (N),
+            boxes (N x 4, XYXY), points (N x 2) and crop_boxes (N x 4, XYXY).
+        """
+        orig_size = image.shape[:2]
+        crop_boxes, layer_idxs = generate_crop_boxes(
+            orig_size, self.crop_n_layers, self.crop_overlap_ratio
+        )
+        handles = self.batch_predictor.encode(
+            [image[y0:y1, x0:x1, :] for x0, y0, x1, y1 in crop_boxes], batch_size=crop_batch_size
+        )
+        model = self.predictor.model
+        device = self.predictor.device
+
+        # Point prompts of all crops, each tagged with the index of its crop
+        points, in_points, crop_idxs = [], [], []
+        for i, (handle, layer_idx) in enumerate(zip(handles, layer_idxs)):
+            crop_points = self.point_grids[layer_idx] * np.array(handle.original_size)[None, ::-1]
+            points.append(crop_points)
+            in_points.append(self.predictor.transform.apply_coords(crop_points, handle.original_size))
+            crop_idxs.append(np.full(len(crop_points), i))
+        points, in_points, crop_idxs = map(np.concatenate, (points, in_points, crop_idxs))
+
+        # Decode in batches, the mask decoder selects the embedding of each point's crop
+        image_embeddings = torch.cat([handle.features for handle in handles], dim=0)
+        crop_data: List[List[Dict[str, torch.Tensor]]] = [[] for _ in crop_boxes]
+        for batch_points, batch_in_points, batch_crop_idxs in batch_iterator(
+            self.points_per_batch, points, in_points, crop_idxs
+        ):
+            coords = torch.as_tensor(batch_in_points, dtype=torch.float, device=device)
+            labels = self._get_point_labels(coords.shape[0], device)
+            sparse_embeddings, dense_embeddings = model.prompt_encoder(
+                points=(coords[:, None, :], labels[:, None]), boxes=None, masks=None
+            )
+            low_res_masks, iou_preds = model.mask_decoder(
+                image_embeddings=image_embeddings,
+                image_pe=model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=True,
+                image_indices=torch.as_tensor(batch_crop_idxs, device=device) if len(handles) > 1 else None,
+            )
+            for i in np.unique(batch_crop_idxs):
+                in_crop = batch_crop_idxs == i
+                in_crop_torch = torch.as_tensor(in_crop, device=device)
+                masks = model.postprocess_masks(
+                    low_res_masks[in_crop_torch], handles[i].input_size, handles[i].original_size
+                )
+                crop_data[i].append(
+                    self._filter_dense(
+                        masks, iou_preds[in_crop_torch], batch_points[in_crop], crop_boxes[i], orig_size
+                    )
+                )
+
+        # Remove duplicates within each crop, then return to the original image frame
+        data: Dict[str, List[torch.Tensor]] = {
+            k: [] for k in ("masks", "iou_preds", "stability_score", "boxes", "points", "crop_boxes")
+        }
+        for crop_box, batches in zip(crop_boxes, crop_data):
+            crop = {k: torch.cat([batch[k] for batch in batches]) for k in batches[0]}
+            keep_by_nms = batched_nms(
+                crop["boxes"].float(),
+                crop["iou_preds"],
+                torch.zeros_like(crop["boxes"][:, 0]),  # categories
+                iou_threshold=self.box_nms_thresh,
+            )
+            crop = {k: v[keep_by_nms.to(v.device)] for k, v in crop.items()}
+            data["masks"].append(uncrop_masks(crop["masks"], crop_box, *orig_size))
+            data["boxes"].append(uncrop_boxes_xyxy(crop["boxes"], crop_box))
+            data["points"].append(uncrop_points(crop["points"], crop_box))
+            data["iou_preds"].append(crop["iou_preds"])
+            data["stability_score"].append(crop["stability_score"])
+            data["crop_boxes"].append(torch.tensor(crop_box).repeat(len(keep_by_nms), 1))
+        dense = {k: torch.cat(v) for k, v in data.items()}
+
+        # Remove duplicate masks between crops
+        if len(crop_boxes) > 1:
+            # Prefer masks from smaller crops
+            scores = 1 / box_area(dense["crop_boxes"])
+            scores = scores.to(dense["boxes"].device)
+            keep_by_nms = batched_nms(
+                dense["boxes"].float(),
+                scores,
+                torch.zeros_like(dense["boxes"][:, 0]),  # categories
+                iou_threshold=self.crop_nms_thresh,
+            )
+            dense = {k: v[keep_by_nms.to(v.device)] for k, v in dense.items()}
+
+        return dense
+
+    def _filter_dense(
+        self,
+        masks: torch.Tensor,
+        iou_preds: torch.Tensor,
+        points: np.ndarray,
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+    ) -> Dict[str, torch.Tensor]:
+        """The filtering of '_process_batch' on dense masks, in the crop frame."""
+        orig_h, orig_w = orig_size
+        data = {
+            "masks": masks.flatten(0, 1),
+            "iou_preds": iou_preds.flatten(0, 1),
+            "points": torch.as_tensor(points.repeat(masks.shape[1], axis=0)),
+        }
+
+        def _filter(keep: torch.Tensor) -> None:
+            for k, v in data.items():
+                data[k] = v[keep.to(v.device)]
+
+        # Filter by predicted IoU
+        if self.pred_iou_thresh > 0.0:
+            _filter(data["iou_preds"] > self.pred_iou_thresh)
+
+        # Calculate stability score
+        data["stability_score"] = calculate_stability_score(
+            data["masks"], self.predictor.model.mask_threshold, self.stability_score_offset
+        )
+        if self.stability_score_thresh > 0.0:
+            _filter(data["stability_score"] >= self.stability_score_thresh)
+
+        # Threshold masks and calculate boxes
+        data["masks"] = data["masks"] > self.predictor.model.mask_threshold
+        data["boxes"] = batched_mask_to_box(data["masks"])
+
+        # Filter boxes that touch crop boundaries
+        keep_mask = ~is_box_near_crop_edge(data["boxes"], crop_box, [0, 0, orig_w, orig_h])
+        if not torch.all(keep_mask):
+            _filter(keep_mask)
+
+        return data
+
+    def _get_point_labels(self, n_points: int, device: torch.device) -> torch.Tensor:
+        if self.custom_points:
+            in_pos_labels = torch.ones(n_points // 2, dtype=torch.int, device=device)
+            in_neg_labels = torch.zeros_like(in_pos_labels)
+            return torch.cat((in_pos_labels, in_neg_labels), dim=0)
+        return torch.ones(n_points, dtype=torch.int, device=device)
+
     def _generate_masks(self, image: np.ndarray) -> MaskData:
         orig_size = image.shape[:2]
         crop_boxes, layer_idxs = generate_crop_boxes(
@@ -277,12 +432,7 @@ class SamAutomaticMaskGenerator:
         # Run model on this batch
         transformed_points = self.predictor.transform.apply_coords(points, im_size)
         in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
-        if self.custom_points:
-            in_pos_labels = torch.ones(in_points.shape[0]//2, dtype=torch.int, device=in_points.device)
-            in_neg_labels = torch.zeros_like(in_pos_labels)
-            in_labels = torch.cat((in_pos_labels, in_neg_labels), dim = 0)
-        else: 
-            in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
+        in_labels = self._get_point_labels(in_points.shape[0], in_points.device)
 
         masks, iou_preds, _ = self.predictor.predict_torch(
             in_points[:, None, :],
@@ -0,0 +1,255 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+from torch import nn
+
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from .utils.transforms import ResizeLongestSide
+
+
+class ImageEmbedding(NamedTuple):
+    """
+    Handle to an encoded image, as returned by SamBatchPredictor.encode.
+
+    features (torch.Tensor): the image embedding, with shape 1xCxHxW
+    original_size (tuple(int, int)): the image size before transformation, (H, W)
+    input_size (tuple(int, int)): the image size after ResizeLongestSide, (H, W)
+    """
+
+    features: torch.Tensor
+    original_size: Tuple[int, int]
+    input_size: Tuple[int, int]
+
+
+class SamBatchPredictor:
+    def __init__(
+        self,
+        sam_model: nn.Module,
+    ) -> None:
+        """
+        Stateless counterpart of SamPredictor. Images are encoded into
+        ImageEmbedding handles owned by the caller, and prompts on any mix
+        of handles are decoded together. The predictor keeps no per-image
+        state, so one instance can serve several images and threads, and
+        encoding and prediction do not need to alternate.
+
+        Arguments:
+          sam_model (Sam): The model to use for mask prediction.
+        """
+        self.model = sam_model
+        self.transform = ResizeLongestSide(sam_model.image_encoder.img_size)
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    def encode(
+        self,
+        images: List[np.ndarray],
+        image_format: str = "RGB",
+        batch_size: int = 4,
+    ) -> List[ImageEmbedding]:
+        """
+        Calculates the image embeddings of a list of images.
+
+        Arguments:
+          images (list(np.ndarray)): The images, in HWC uint8 format with
+            pixel values in [0, 255]. They may have different sizes.
+          image_format (str): The color format of the images, in ['RGB', 'BGR'].
+          batch_size (int): The number of images per image encoder call.
+
+        Returns:
+          (list(ImageEmbedding)): One handle per image, in input order.
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        transformed_images, original_sizes = [], []
+        for image in images:
+            if image_format != self.model.image_format:
+                image = image[..., ::-1]
+            input_image = self.transform.apply_image(image)
+            input_image_torch = torch.as_tensor(input_image, device=self.device)
+            transformed_images.append(input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :])
+            original_sizes.append(image.shape[:2])
+        return self.encode_torch(transformed_images, original_sizes, batch_size)
+
+    @torch.no_grad()
+    def encode_torch(
+        self,
+        transformed_images: List[torch.Tensor],
+        original_sizes: List[Tuple[int, ...]],
+        batch_size: int = 4,
+    ) -> List[ImageEmbedding]:
+        """
+        Calculates the image embeddings of images already transformed with
+        ResizeLongestSide. See 'encode' for more details.
+
+        Arguments:
+          transformed_images (list(torch.Tensor)): The input images, each with
+            shape 1x3xHxW and long side image_encoder.img_size.
+          original_sizes (list(tuple(int, int))): The size of each image
+            before transformation, in (H, W) format.
+          batch_size (int): The number of images per image encoder call.
+        """
+        img_size = self.model.image_encoder.img_size
+        handles = []
+        for start in range(0, len(transformed_images), batch_size):
+            chunk = transformed_images[start : start + batch_size]
+            for image in chunk:
+                assert (
+                    len(image.shape) == 4 and image.shape[1] == 3 and max(*image.shape[2:]) == img_size
+                ), f"encode_torch inputs must be 1x3xHxW with long side {img_size}."
+            # preprocess pads every image to img_size x img_size, so they stack
+            input_images = torch.cat([self.model.preprocess(image) for image in chunk], dim=0)
+            features = self.model.image_encoder(input_images)
+            for i, image in enumerate(chunk):
+                handles.append(
+                    ImageEmbedding(
+                        features[i : i + 1],
+                        tuple(original_sizes[start + i]),
+                        tuple(image.shape[-2:]),
+                    )
+                )
+        return handles
+
+    @torch.no_grad()
+    def predict(
+        self,
+        prompts: List[Dict[str, Any]],
+        multimask_output: bool = True,
+        return_logits: bool = False,
+    ) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Predict masks for a list of prompts, each on one of the encoded images.
+
+        Prompts with the same structure (number of points, box or not, mask
+        input or not) are decoded in a single mask decoder call whatever image
+        they are on, the image embedding of each prompt is selected by index
+        inside the decoder. Prompts of a typical caller (one point or one box
+        per prompt) all share one structure, so the whole list is one call.
+
+        Arguments:
+          prompts (list(dict)): One dict per prompt with keys
+            'embedding': The ImageEmbedding of the image to segment.
+            'point_coords': (np.ndarray) Nx2 point prompts in (X,Y) pixels of
+              the original image. Optional.
+            'point_labels': (np.ndarray) The N labels of the points, 1 for
+              foreground, 0 for background. Required with point_coords.
+            'box': (np.ndarray) A length 4 box prompt, XYXY. Optional.
+            'mask_input': (np.ndarray) A 1x256x256 low resolution mask logits
+              input, e.g. from a previous prediction. Optional.
+          multimask_output (bool): If true, the model returns three masks
+            per prompt, see SamPredictor.predict.
+          return_logits (bool): If true, returns un-thresholded masks logits
+            instead of binary masks.
+
+        Returns:
+          (list(tuple)): For each prompt, in input order, the same outputs as
+            SamPredictor.predict: CxHxW masks in the original size of its
+            image, C mask quality predictions, and Cx256x256 low resolution
+            logits.
+        """
+        groups: Dict[Tuple[Optional[int], bool, bool], List[int]] = {}
+        for i, prompt in enumerate(prompts):
+            point_coords = prompt.get("point_coords")
+            assert point_coords is None or prompt.get("point_labels") is not None, (
+                "point_labels must be supplied if point_coords is supplied."
+            )
+            key = (
+                None if point_coords is None else len(point_coords),
+                prompt.get("box") is not None,
+                prompt.get("mask_input") is not None,
+            )
+            groups.setdefault(key, []).append(i)
+
+        results: List[Any] = [None] * len(prompts)
+        for group in groups.values():
+            outputs = self._predict_group([prompts[i] for i in group], multimask_output, return_logits)
+            for i, output in zip(group, outputs):
+                results[i] = output
+        return results
+
+    def _predict_group(
+        self,
+        prompts: List[Dict[str, Any]],
+        multimask_output: bool,
+        return_logits: bool,
+    ) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Decodes prompts of one structure in a single mask decoder call."""
+        # Distinct images of the group, each prompt refers to its image by index
+        handles: List[ImageEmbedding] = []
+        handle_index: Dict[int, int] = {}
+        image_indices = []
+        for prompt in prompts:
+            handle = prompt["embedding"]
+            if id(handle.features) not in handle_index:
+                handle_index[id(handle.features)] = len(handles)
+                handles.append(handle)
+            image_indices.append(handle_index[id(handle.features)])
+
+        # Transform input prompts to the input frame of their image
+        coords_torch, labels_torch, box_torch, mask_input_torch = None, None, None, None
+        if prompts[0].get("point_coords") is not None:
+            point_coords = np.stack(
+                [self.transform.apply_coords(p["point_coords"], p["embedding"].original_size) for p in prompts]
+            )
+            coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=self.device)
+            labels_torch = torch.as_tensor(
+                np.stack([p["point_labels"] for p in prompts]), dtype=torch.int, device=self.device
+            )
+        if prompts[0].get("box") is not None:
+            box = np.concatenate(
+                [self.transform.apply_boxes(np.asarray(p["box"]), p["embedding"].original_size) for p in prompts]
+            )
+            box_torch = torch.as_tensor(box, dtype=torch.float, device=self.device)
+        if prompts[0].get("mask_input") is not None:
+            mask_input_torch = torch.as_tensor(
+                np.stack([p["mask_input"] for p in prompts]), dtype=torch.float, device=self.device
+            )
+
+        sparse_embeddings, dense_embeddings = self.model.prompt_encoder(
+            points=(coords_torch, labels_torch) if coords_torch is not None else None,
+            boxes=box_torch,
+            masks=mask_input_torch,
+        )
+        decoder_kwargs = {}
+        if len(handles) > 1:
+            decoder_kwargs["image_indices"] = torch.as_tensor(image_indices, device=self.device)
+        low_res_masks, iou_predictions = self.model.mask_decoder(
+            image_embeddings=torch.cat([h.features for h in handles], dim=0),
+            image_pe=self.model.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=multimask_output,
+            **decoder_kwargs,
+        )
+
+        # Upscale the masks of each image to its original size
+        masks: List[Any] = [None] * len(prompts)
+        image_indices_torch = torch.as_tensor(image_indices, device=low_res_masks.device)
+        for idx, handle in enumerate(handles):
+            members = torch.nonzero(image_indices_torch == idx).flatten()
+            image_masks = self.model.postprocess_masks(
+                low_res_masks[members], handle.input_size, handle.original_size
+            )
+            if not return_logits:
+                image_masks = image_masks > self.model.mask_threshold
+            for j, member in enumerate(members.tolist()):
+                masks[member] = image_masks[j]
+
+        return [
+            (
+                masks[i].detach().cpu().numpy(),
+                iou_predictions[i].detach().cpu().numpy(),
+                low_res_masks[i].detach().cpu().numpy(),
+            )
+            for i in range(len(prompts))
+        ]
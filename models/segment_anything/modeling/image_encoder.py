@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import torch
+import torch._dynamo
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -108,7 +109,9 @@ class ImageEncoderViT(nn.Module):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.patch_embed(x)
         if self.pos_embed is not None:
-            x = x + self.pos_embed
+            # inputs smaller than img_size (e.g. ROI crops) get an interpolated embedding, the global
+            # attention blocks interpolate their relative position embeddings in get_rel_pos
+            x = x + interpolate_pos_embed(self.pos_embed, x.shape[1:3])
 
         for blk in self.blocks:
             if self.use_grad_checkpointing:
@@ -196,6 +199,9 @@ class Block(nn.Module):
 class Attention(nn.Module):
     """Multi-head Attention block with relative position embeddings."""
 
+    # queries per scaled_dot_product_attention call when the relative position bias is used, see rel_pos_attention
+    rel_pos_query_chunk = 1024
+
     def __init__(
         self,
         dim: int,
@@ -231,6 +237,35 @@ class Attention(nn.Module):
             # initialize relative positional embeddings
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
+        # (q_size, k_size) -> (weights version, (Rh, Rw)), see get_rel_pos_tables
+        self._rel_pos_cache = {}
+
+    def get_rel_pos_tables(
+        self, q_size: Tuple[int, int], k_size: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Gathered relative position embeddings Rh, Rw for the given query / key sizes.
+        At inference they are computed once per size and cached on the device of the weights. The cache
+        entry is rebuilt when the weights change (in-place update, load_state_dict, .to(), .half()).
+        With autograd enabled, in ONNX export and under torch.compile they are recomputed on every call.
+        """
+        if torch.is_grad_enabled() or torch.onnx.is_in_onnx_export() or _is_compiling():
+            return (
+                get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                get_rel_pos(q_size[1], k_size[1], self.rel_pos_w),
+            )
+        version = tuple(
+            (p._version, p.data_ptr(), p.dtype) for p in (self.rel_pos_h, self.rel_pos_w)
+        )
+        cached = self._rel_pos_cache.get((q_size, k_size))
+        if cached is None or cached[0] != version:
+            tables = (
+                get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                get_rel_pos(q_size[1], k_size[1], self.rel_pos_w),
+            )
+            cached = (version, tables)
+            self._rel_pos_cache[(q_size, k_size)] = cached
+        return cached[1]
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
@@ -239,17 +274,68 @@ class Attention(nn.Module):
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
-        attn = (q * self.scale) @ k.transpose(-2, -1)
-
-        if self.use_rel_pos:
-            attn = add_decomposed_rel_pos(attn, q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
-
-        attn = attn.softmax(dim=-1)
-        x = (attn @ v).view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        if torch.onnx.is_in_onnx_export():  # no ONNX symbolic for scaled_dot_product_attention in torch 2.0
+            attn = (q * self.scale) @ k.transpose(-2, -1)
+            if self.use_rel_pos:
+                Rh, Rw = self.get_rel_pos_tables((H, W), (H, W))
+                attn = attn + get_decomposed_rel_pos_bias(q, Rh, Rw, (H, W), (H, W), gathered=True)
+            x = attn.softmax(dim=-1) @ v
+        elif self.use_rel_pos:
+            x = self.rel_pos_attention(q, k, v, (H, W))
+        else:
+            # scaled_dot_product_attention scales by head_dim**-0.5, i.e. self.scale
+            x = F.scaled_dot_product_attention(q, k, v)
+        x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
         x = self.proj(x)
 
         return x
 
+    def rel_pos_attention(
+        self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, q_size: Tuple[int, int]
+    ) -> torch.Tensor:
+        """
+        Attention with the decomposed relative position term as an additive attn_mask, over chunks of query rows.
+        The mask is dense, so it is only built for rel_pos_query_chunk queries at a time: in the global blocks
+        (B * nHead, rows * W, H * W) instead of (B * nHead, H * W, H * W). The window blocks take a single chunk.
+        """
+        H, W = q_size
+        Rh, Rw = self.get_rel_pos_tables(q_size, q_size)
+        rows = max(1, self.rel_pos_query_chunk // W)
+        out = []
+        for h0 in range(0, H, rows):
+            h1 = min(H, h0 + rows)
+            q_chunk = q[:, h0 * W : h1 * W]
+            attn_bias = get_decomposed_rel_pos_bias(
+                q_chunk, Rh[h0:h1], Rw, (h1 - h0, W), q_size, gathered=True
+            ).to(q.dtype)
+            # scaled_dot_product_attention scales by head_dim**-0.5, i.e. self.scale
+            out.append(F.scaled_dot_product_attention(q_chunk, k, v, attn_mask=attn_bias))
+        return out[0] if len(out) == 1 else torch.cat(out, dim=1)
+
+
+def interpolate_pos_embed(pos_embed: torch.Tensor, hw: Tuple[int, int]) -> torch.Tensor:
+    """
+    Resize the absolute positional embedding to a different token grid.
+    Args:
+        pos_embed (Tensor): positional embedding with [1, H, W, C].
+        hw (Tuple): target token grid size (H', W').
+
+    Returns:
+        pos_embed: positional embedding with [1, H', W', C].
+    """
+    if tuple(pos_embed.shape[1:3]) == tuple(hw):
+        return pos_embed
+    pos_embed = F.interpolate(
+        pos_embed.permute(0, 3, 1, 2), size=tuple(hw), mode="bicubic", align_corners=False
+    )
+    return pos_embed.permute(0, 2, 3, 1)
+
+
+def _is_compiling() -> bool:
+    # torch._dynamo.is_compiling is not available in every torch 2.0 release
+    is_compiling = getattr(torch._dynamo, "is_compiling", None)
+    return is_compiling is not None and is_compiling()
+
 
 def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, Tuple[int, int]]:
     """
@@ -326,50 +412,74 @@ def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor
         rel_pos_resized = rel_pos
 
     # Scale the coords with short length if shapes for q and k are different.
-    q_coords = torch.arange(q_size)[:, None] * max(k_size / q_size, 1.0)
-    k_coords = torch.arange(k_size)[None, :] * max(q_size / k_size, 1.0)
+    q_coords = torch.arange(q_size, device=rel_pos.device)[:, None] * max(k_size / q_size, 1.0)
+    k_coords = torch.arange(k_size, device=rel_pos.device)[None, :] * max(q_size / k_size, 1.0)
     relative_coords = (q_coords - k_coords) + (k_size - 1) * max(q_size / k_size, 1.0)
 
     return rel_pos_resized[relative_coords.long()]
 
 
-def add_decomposed_rel_pos(
-    attn: torch.Tensor,
+def get_decomposed_rel_pos_bias(
     q: torch.Tensor,
     rel_pos_h: torch.Tensor,
     rel_pos_w: torch.Tensor,
     q_size: Tuple[int, int],
     k_size: Tuple[int, int],
+    gathered: bool = False,
 ) -> torch.Tensor:
     """
-    Calculate decomposed Relative Positional Embeddings from :paper:`mvitv2`.
-    https://github.com/facebookresearch/mvit/blob/19786631e330df9f3622e5402b4a419a263a2c80/mvit/models/attention.py   # noqa B950
+    Decomposed Relative Positional Embeddings as an additive attention bias, see add_decomposed_rel_pos.
     Args:
-        attn (Tensor): attention map.
         q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
         rel_pos_h (Tensor): relative position embeddings (Lh, C) for height axis.
         rel_pos_w (Tensor): relative position embeddings (Lw, C) for width axis.
         q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
         k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+        gathered (bool): If True, rel_pos_h and rel_pos_w are already the outputs of get_rel_pos,
+            (q_h, k_h, C) and (q_w, k_w, C).
 
     Returns:
-        attn (Tensor): attention map with added relative positional embeddings.
+        bias (Tensor): relative position bias with shape (B, q_h * q_w, k_h * k_w).
     """
     q_h, q_w = q_size
     k_h, k_w = k_size
-    Rh = get_rel_pos(q_h, k_h, rel_pos_h)
-    Rw = get_rel_pos(q_w, k_w, rel_pos_w)
+    if gathered:
+        Rh, Rw = rel_pos_h, rel_pos_w
+    else:
+        Rh = get_rel_pos(q_h, k_h, rel_pos_h)
+        Rw = get_rel_pos(q_w, k_w, rel_pos_w)
 
     B, _, dim = q.shape
     r_q = q.reshape(B, q_h, q_w, dim)
     rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
     rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
 
-    attn = (
-        attn.view(B, q_h, q_w, k_h, k_w) + rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]
-    ).view(B, q_h * q_w, k_h * k_w)
+    return (rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]).reshape(B, q_h * q_w, k_h * k_w)
 
-    return attn
+
+def add_decomposed_rel_pos(
+    attn: torch.Tensor,
+    q: torch.Tensor,
+    rel_pos_h: torch.Tensor,
+    rel_pos_w: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> torch.Tensor:
+    """
+    Calculate decomposed Relative Positional Embeddings from :paper:`mvitv2`.
+    https://github.com/facebookresearch/mvit/blob/19786631e330df9f3622e5402b4a419a263a2c80/mvit/models/attention.py   # noqa B950
+    Args:
+        attn (Tensor): attention map.
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        rel_pos_h (Tensor): relative position embeddings (Lh, C) for height axis.
+        rel_pos_w (Tensor): relative position embeddings (Lw, C) for width axis.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+    Returns:
+        attn (Tensor): attention map with added relative positional embeddings.
+    """
+    return attn + get_decomposed_rel_pos_bias(q, rel_pos_h, rel_pos_w, q_size, k_size)
 
 
 class PatchEmbed(nn.Module):
@@ -8,7 +8,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import List, Tuple, Type
+from typing import List, Optional, Tuple, Type
 
 from .common import LayerNorm2d
 
@@ -75,6 +75,7 @@ class MaskDecoder(nn.Module):
         sparse_prompt_embeddings: torch.Tensor,
         dense_prompt_embeddings: torch.Tensor,
         multimask_output: bool,
+        image_indices: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Predict masks given image and prompt embeddings.
@@ -86,6 +87,10 @@ class MaskDecoder(nn.Module):
           dense_prompt_embeddings (torch.Tensor): the embeddings of the mask inputs
           multimask_output (bool): Whether to return multiple masks or a single
             mask.
+          image_indices (torch.Tensor or None): for prompts on several images,
+            image_embeddings holds one embedding per distinct image and
+            image_indices gives the index of the image of each prompt. If None,
+            all prompts are on the single image of image_embeddings.
 
         Returns:
           torch.Tensor: batched predicted masks
@@ -96,6 +101,7 @@ class MaskDecoder(nn.Module):
             image_pe=image_pe,
             sparse_prompt_embeddings=sparse_prompt_embeddings,
             dense_prompt_embeddings=dense_prompt_embeddings,
+            image_indices=image_indices,
         )
 
         # Select the correct mask or masks for output
@@ -115,6 +121,7 @@ class MaskDecoder(nn.Module):
         image_pe: torch.Tensor,
         sparse_prompt_embeddings: torch.Tensor,
         dense_prompt_embeddings: torch.Tensor,
+        image_indices: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Predicts masks. See 'forward' for more details."""
         # Concatenate output tokens
@@ -122,11 +129,25 @@ class MaskDecoder(nn.Module):
         output_tokens = output_tokens.unsqueeze(0).expand(sparse_prompt_embeddings.size(0), -1, -1)
         tokens = torch.cat((output_tokens, sparse_prompt_embeddings), dim=1)
 
-        # Expand per-image data in batch direction to be per-mask
-        src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
-        src = src + dense_prompt_embeddings
-        pos_src = torch.repeat_interleave(image_pe, tokens.shape[0], dim=0)
-        b, c, h, w = src.shape
+        # Per-image data is not expanded to be per-mask: a single image embedding
+        # and the positional encoding are broadcast over the masks by the transformer.
+        # Without mask inputs the dense prompt embedding is an expanded no_mask_embed,
+        # the same for all masks, so it is added to the image embedding once
+        if dense_prompt_embeddings.shape[0] > 1 and dense_prompt_embeddings.stride(0) == 0:
+            dense_prompt_embeddings = dense_prompt_embeddings[:1]
+        if image_embeddings.shape[0] == 1:
+            src = image_embeddings + dense_prompt_embeddings
+        elif image_indices is not None:
+            if dense_prompt_embeddings.shape[0] == 1:
+                src = (image_embeddings + dense_prompt_embeddings)[image_indices]
+            else:
+                src = image_embeddings[image_indices] + dense_prompt_embeddings
+        else:
+            src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
+            src = src + dense_prompt_embeddings
+        pos_src = image_pe
+        b = tokens.shape[0]
+        c, h, w = src.shape[1:]
 
         # Run the transformer
         hs, src = self.transformer(src, pos_src, tokens)
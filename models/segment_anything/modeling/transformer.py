@@ -5,9 +5,9 @@
 # LICENSE file in the root directory of this source tree.
 
 import torch
+import torch.nn.functional as F
 from torch import Tensor, nn
 
-import math
 from typing import Tuple, Type
 
 from .common import MLPBlock
@@ -68,9 +68,10 @@ class TwoWayTransformer(nn.Module):
         """
         Args:
           image_embedding (torch.Tensor): image to attend to. Should be shape
-            B x embedding_dim x h x w for any h and w.
+            B x embedding_dim x h x w for any h and w, or 1 x embedding_dim x h x w
+            for an image shared by all B queries, it is then broadcast.
           image_pe (torch.Tensor): the positional encoding to add to the image. Must
-            have the same shape as image_embedding.
+            have the same shape as image_embedding, or a batch of 1.
           point_embedding (torch.Tensor): the embedding to add to the query points.
             Must have shape B x N_points x embedding_dim for any N_points.
 
@@ -216,6 +217,14 @@ class Attention(nn.Module):
         return x.reshape(b, n_tokens, n_heads * c_per_head)  # B x N_tokens x C
 
     def forward(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
+        # Keys and values of a single image shared by a batch of queries: the
+        # tokens attend independently, so fold the batch into the tokens instead
+        # of copying the image per query
+        bs = q.shape[0]
+        fold = bs > 1 and k.shape[0] == 1
+        if fold:
+            q = q.reshape(1, -1, q.shape[-1])
+
         # Input projections
         q = self.q_proj(q)
         k = self.k_proj(k)
@@ -225,16 +234,20 @@ class Attention(nn.Module):
         q = self._separate_heads(q, self.num_heads)
         k = self._separate_heads(k, self.num_heads)
         v = self._separate_heads(v, self.num_heads)
+        # Queries of a shared image attending to per-mask tokens, projected once
+        q = q.expand(k.shape[0], -1, -1, -1) if q.shape[0] == 1 else q
 
-        # Attention
-        _, _, _, c_per_head = q.shape
-        attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
-        attn = attn / math.sqrt(c_per_head)
-        attn = torch.softmax(attn, dim=-1)
+        # Attention, scaled by 1 / sqrt(c_per_head)
+        if torch.onnx.is_in_onnx_export():  # no ONNX symbolic for scaled_dot_product_attention in torch 2.0
+            attn = q @ k.permute(0, 1, 3, 2) * q.shape[-1] ** -0.5
+            out = torch.softmax(attn, dim=-1) @ v
+        else:
+            out = F.scaled_dot_product_attention(q, k, v)
 
         # Get output
-        out = attn @ v
         out = self._recombine_heads(out)
         out = self.out_proj(out)
+        if fold:
+            out = out.reshape(bs, -1, out.shape[-1])
 
         return out
@@ -94,6 +94,10 @@ def get_nii_dataset(_config):
         use_clahe=_config['use_clahe'],
         use_3_slices=_config["use_3_slices"],
         tile_z_dim=3 if not _config["use_3_slices"] else 1,
+        read_workers=_config['dataset_read_workers'],
+        img_dtype=_config['dataset_img_dtype'],
+        lazy_scans=_config['dataset_lazy_scans'],
+        cache_dir=_config['dataset_cache_dir'],
     )
     
     return tr_parent
@@ -134,10 +138,17 @@ def main(_run, _config, _log):
     tr_parent = get_dataset(_config)
 
     # dataloaders
+    if _config['dataset_lazy_scans'] > 0:
+        # consecutive slices of a scan, whole batches of it, so that a lazily loaded scan serves many draws
+        group_size = max(1, _config['dataset_scan_group_size'] // _config['batch_size']) * _config['batch_size']
+        sampler = tr_parent.get_scan_sampler(group_size=group_size)
+    else:
+        sampler = None
     trainloader = DataLoader(
         tr_parent,
         batch_size=_config['batch_size'],
-        shuffle=True,
+        shuffle=sampler is None,
+        sampler=sampler,
         num_workers=_config['num_workers'],
         pin_memory=True,
         drop_last=True
@@ -0,0 +1,189 @@
+"""
+Fast model start-up
+Models loaded from a checkpoint are built without random initialisation (skip_init), the weights are overwritten
+by the checkpoint anyway. Checkpoints are read without unpickling a full copy of the weights first: safetensors
+files are memory-mapped and copied into the model tensor by tensor, .pth files are memory-mapped when the torch
+version supports it (torch.load(mmap=True), torch >= 2.1).
+
+Convert existing .pth checkpoints once with
+    python -m util.checkpoint pretrained_model/sam_vit_h.pth [more .pth files]
+which writes e.g. pretrained_model/sam_vit_h.safetensors next to each file, load_weights prefers it when it exists.
+"""
+import functools
+import os
+import threading
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+try:
+    from safetensors import safe_open
+    from safetensors.torch import save_file as safe_save
+
+    safetensors_available = True
+except ImportError:
+    safetensors_available = False
+
+# in-place initialisers of torch.nn.init, used by the reset_parameters of all torch layers
+INIT_FUNCTIONS = ('uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'eye_', 'dirac_',
+                  'xavier_uniform_', 'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_')
+
+
+# skip_init patches torch.nn.init for the whole process while any thread is inside it, the patched initialisers
+# only skip in the threads that are
+_skip_init_lock = threading.Lock()
+_skip_init_local = threading.local()
+_skip_init_originals = {}  # name -> original initialiser, while patched
+_skip_init_users = 0
+
+
+def _skippable(fn):
+    @functools.wraps(fn)
+    def init_fn(tensor, *args, **kwargs):
+        if getattr(_skip_init_local, 'depth', 0) > 0:
+            return tensor
+        return fn(tensor, *args, **kwargs)
+    return init_fn
+
+
+@contextmanager
+def skip_init(enabled=True):
+    """
+    Turn the torch.nn.init initialisers into no-ops in the calling thread: parameters built inside keep the
+    uninitialised memory of torch.empty, which the OS only commits when the checkpoint is copied in. Buffers computed
+    in the constructors (e.g. SAM's pixel_mean) are unaffected. Only for models whose weights are all loaded afterwards
+    with strict=True
+    Thread-safe: models built meanwhile in other threads are initialised as usual. Code that imported an initialiser
+    by name (from torch.nn.init import normal_) is not affected, in any thread
+    """
+    global _skip_init_users
+    if not enabled:
+        yield
+        return
+    with _skip_init_lock:
+        if _skip_init_users == 0:
+            for name in INIT_FUNCTIONS:
+                if hasattr(nn.init, name):
+                    _skip_init_originals[name] = getattr(nn.init, name)
+                    setattr(nn.init, name, _skippable(_skip_init_originals[name]))
+        _skip_init_users += 1
+    _skip_init_local.depth = getattr(_skip_init_local, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _skip_init_local.depth -= 1
+        with _skip_init_lock:
+            _skip_init_users -= 1
+            if _skip_init_users == 0:
+                for name, fn in _skip_init_originals.items():
+                    setattr(nn.init, name, fn)
+                _skip_init_originals.clear()
+
+
+def get_safetensors_path(path):
+    return os.path.splitext(path)[0] + '.safetensors'
+
+
+def resolve_checkpoint(path):
+    """
+    The converted .safetensors file next to a .pth checkpoint if there is one (and safetensors is installed)
+    """
+    if path.endswith('.safetensors') or not safetensors_available:
+        return path
+    converted = get_safetensors_path(path)
+    return converted if os.path.exists(converted) else path
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """
+    State dict of a .pth or .safetensors checkpoint. .pth files are memory-mapped if torch supports it
+    """
+    path = resolve_checkpoint(path)
+    if path.endswith('.safetensors'):
+        if not safetensors_available:
+            raise EnvironmentError(
+                "Loading safetensors requires the safetensors library. Please install with pip or similar."
+            )
+        with safe_open(path, framework='pt', device=str(map_location)) as f:
+            return {key: f.get_tensor(key) for key in f.keys()}
+    try:
+        return torch.load(path, map_location=map_location, mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1 has no mmap argument, and legacy (non zip) checkpoints cannot be memory-mapped
+        return torch.load(path, map_location=map_location)
+
+
+def load_weights(model, path, strict=True, prefix=''):
+    """
+    model.load_state_dict from a checkpoint. For safetensors files the tensors are copied into the model one at a
+    time, so peak memory is the model plus a single tensor instead of the model plus a full state dict
+    Args:
+        prefix:     only load the checkpoint entries under prefix, stripped of it (e.g. 'image_encoder.' to load
+                    SAM's image encoder alone from a full SAM checkpoint)
+    """
+    path = resolve_checkpoint(path)
+    if not path.endswith('.safetensors'):
+        state_dict = load_checkpoint(path)
+        if prefix:
+            state_dict = {key[len(prefix):]: value for key, value in state_dict.items() if key.startswith(prefix)}
+        return model.load_state_dict(state_dict, strict=strict)
+    if not safetensors_available:
+        raise EnvironmentError(
+            "Loading safetensors requires the safetensors library. Please install with pip or similar."
+        )
+    state_dict = model.state_dict()  # shares memory with the model parameters and buffers
+    with safe_open(path, framework='pt', device='cpu') as f:
+        keys = set(key[len(prefix):] for key in f.keys() if key.startswith(prefix))
+        missing_keys = [key for key in state_dict if key not in keys]
+        unexpected_keys = [key for key in keys if key not in state_dict]
+        if strict and (missing_keys or unexpected_keys):
+            raise RuntimeError(f'Error(s) in loading {path} into {model.__class__.__name__}: '
+                               f'missing keys {missing_keys}, unexpected keys {unexpected_keys}')
+        with torch.no_grad():
+            for key in keys & state_dict.keys():
+                state_dict[key].copy_(f.get_tensor(prefix + key))
+    return missing_keys, unexpected_keys
+
+
+def build_model(build_fn, checkpoint=None, **kwargs):
+    """
+    build_fn(**kwargs) without random initialisation, then all weights loaded from checkpoint.
+    Builds with random weights as usual if there is no checkpoint
+    """
+    with skip_init(enabled=checkpoint is not None):
+        model = build_fn(**kwargs)
+    if checkpoint is not None:
+        load_weights(model, checkpoint, strict=True)
+    return model
+
+
+def convert_to_safetensors(path, out_path=None):
+    """
+    Offline conversion of a .pth state dict to .safetensors, written next to it by default
+    """
+    if not safetensors_available:
+        raise EnvironmentError(
+            "Saving safetensors requires the safetensors library. Please install with pip or similar."
+        )
+    out_path = out_path or get_safetensors_path(path)
+    state_dict = torch.load(path, map_location='cpu')
+    skipped = [key for key, value in state_dict.items() if not isinstance(value, torch.Tensor)]
+    if skipped:
+        print(f'###### Skipping non tensor entries {skipped} ######')
+    # safetensors stores neither views nor shared storage
+    tensors = {key: value.detach().clone().contiguous() for key, value in state_dict.items()
+               if isinstance(value, torch.Tensor)}
+    safe_save(tensors, out_path)
+    print(f'###### Converted {path} to {out_path} ######')
+    return out_path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoints', nargs='+', help='.pth state dicts to convert')
+    args = parser.parse_args()
+    for checkpoint in args.checkpoints:
+        convert_to_safetensors(checkpoint)
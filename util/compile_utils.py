@@ -0,0 +1,42 @@
+"""
+torch.compile helpers for inference
+Slices are resized to a fixed size before the encoders, so the only varying input dimension is the batch
+(number of support + query slices). The batch is zero-padded up to a small set of bucket sizes, so every
+bucket compiles once, during a warm-up pass, instead of recompiling on every new support set size.
+"""
+import torch
+
+BATCH_BUCKETS = (1, 2, 4, 8)
+
+
+def get_bucket(n, buckets=BATCH_BUCKETS):
+    """
+    Smallest bucket that fits n, n itself if it is larger than all buckets
+    """
+    for bucket in sorted(buckets):
+        if n <= bucket:
+            return bucket
+    return n
+
+
+def pad_batch(x, buckets=BATCH_BUCKETS):
+    """
+    Zero-pad dim 0 of x up to its bucket. The encoders process the samples of a batch independently,
+    so the padded samples do not change the outputs of the real ones
+    Returns:
+        padded tensor, original batch size
+    """
+    n = x.shape[0]
+    bucket = get_bucket(n, buckets)
+    if bucket == n:
+        return x, n
+    return torch.cat([x, x.new_zeros(bucket - n, *x.shape[1:])], dim=0), n
+
+
+def compile_forward(module, name='forward', **compile_kwargs):
+    """
+    Replace module.<name> with its compiled version in place.
+    Unlike torch.compile(module) the parameters stay where they are, so state dict keys are unchanged
+    """
+    setattr(module, name, torch.compile(getattr(module, name), **compile_kwargs))
+    return module
@@ -47,11 +47,14 @@ class LoraInjectedLinear(nn.Module):
         self.lora_up = nn.Linear(r, out_features, bias=False)
         self.scale = scale
         self.selector = nn.Identity()
+        self.merged = False
 
         nn.init.normal_(self.lora_down.weight, std=1 / r)
         nn.init.zeros_(self.lora_up.weight)
 
     def forward(self, input):
+        if self.merged:
+            return self.linear(input)
         return (
             self.linear(input)
             + self.dropout(self.lora_up(self.selector(self.lora_down(input))))
@@ -61,6 +64,25 @@ class LoraInjectedLinear(nn.Module):
     def realize_as_lora(self):
         return self.lora_up.weight.data * self.scale, self.lora_down.weight.data
 
+    def lora_delta(self):
+        up = self.lora_up.weight.data
+        if isinstance(self.selector, nn.Linear):
+            up = up @ self.selector.weight.data
+        return (up @ self.lora_down.weight.data * self.scale).to(
+            self.linear.weight.dtype
+        )
+
+    def merge(self):
+        # fold the low-rank delta into the base weight, forward is then a plain linear
+        if not self.merged:
+            self.linear.weight.data += self.lora_delta()
+            self.merged = True
+
+    def unmerge(self):
+        if self.merged:
+            self.linear.weight.data -= self.lora_delta()
+            self.merged = False
+
     def set_selector_from_diag(self, diag: torch.Tensor):
         # diag is a 1D tensor of size (r,)
         assert diag.shape == (self.r,)
@@ -401,8 +423,12 @@ def extract_lora_ups_down(model, target_replace_module=DEFAULT_TARGET_REPLACE):
 
 
 def extract_lora_as_tensor(
-    model, target_replace_module=DEFAULT_TARGET_REPLACE, as_fp16=True
+    model, target_replace_module=DEFAULT_TARGET_REPLACE, as_fp16=True, scaled=True
 ):
+    """
+    scaled: fold the lora scale into up (realize_as_lora), for loading into modules of scale 1.
+        Otherwise the raw lora_up weights, as extract_lora_ups_down
+    """
 
     loras = []
 
@@ -411,7 +437,10 @@ def extract_lora_as_tensor(
         target_replace_module,
         search_class=[LoraInjectedLinear, LoraInjectedConv2d],
     ):
-        up, down = _child_module.realize_as_lora()
+        if scaled:
+            up, down = _child_module.realize_as_lora()
+        else:
+            up, down = _child_module.lora_up.weight.data, _child_module.lora_down.weight.data
         if as_fp16:
             up = up.to(torch.float16)
             down = down.to(torch.float16)
@@ -455,9 +484,11 @@ def save_safeloras_with_embeds(
     modelmap: Dict[str, Tuple[nn.Module, Set[str]]] = {},
     embeds: Dict[str, torch.Tensor] = {},
     outpath="./lora.safetensors",
+    scaled=True,
 ):
     """
     Saves the Lora from multiple modules in a single safetensor file.
+    scaled: see extract_lora_as_tensor
 
     modelmap is a dictionary of {
         "module name": (module, target_replace_module)
@@ -470,7 +501,7 @@ def save_safeloras_with_embeds(
         metadata[name] = json.dumps(list(target_replace_module))
 
         for i, (_up, _down) in enumerate(
-            extract_lora_as_tensor(model, target_replace_module)
+            extract_lora_as_tensor(model, target_replace_module, scaled=scaled)
         ):
             rank = _down.shape[0]
 
@@ -489,8 +520,9 @@ def save_safeloras_with_embeds(
 def save_safeloras(
     modelmap: Dict[str, Tuple[nn.Module, Set[str]]] = {},
     outpath="./lora.safetensors",
+    scaled=True,
 ):
-    return save_safeloras_with_embeds(modelmap=modelmap, outpath=outpath)
+    return save_safeloras_with_embeds(modelmap=modelmap, outpath=outpath, scaled=scaled)
 
 
 def convert_loras_to_safeloras_with_embeds(
@@ -672,6 +704,83 @@ def collapse_lora(model, alpha=1.0):
             )
 
 
+def merge_lora(model, target_replace_module=DINO_TARGET_REPLACE):
+    """
+    Fold every injected LoRA delta into its base linear weight, for inference.
+    The low-rank weights are kept, so unmerge_lora restores the base weights.
+    Do not change the lora scale or weights while merged.
+    """
+    for _module, name, _child_module in _find_modules(
+        model, target_replace_module, search_class=[LoraInjectedLinear]
+    ):
+        _child_module.merge()
+
+
+def unmerge_lora(model, target_replace_module=DINO_TARGET_REPLACE):
+    for _module, name, _child_module in _find_modules(
+        model, target_replace_module, search_class=[LoraInjectedLinear]
+    ):
+        _child_module.unmerge()
+
+
+def save_lora_adapter(model, path, target_replace_module=DINO_TARGET_REPLACE):
+    """
+    Save only the LoRA weights of model, as a safetensors file if path ends with .safetensors,
+    otherwise as the fp16 list of save_lora_weight. Both hold the raw lora_up weights, the modules
+    set_lora_adapter loads them into apply their scale themselves
+    """
+    if path.endswith(".safetensors"):
+        save_safeloras({"adapter": (model, target_replace_module)}, outpath=path, scaled=False)
+    else:
+        save_lora_weight(model, path, target_replace_module)
+
+
+def load_lora_adapter(path, device="cpu"):
+    """
+    Read an adapter saved by save_lora_adapter into a list [up, down, up, down, ...] of tensors on device
+    """
+    if path.endswith(".safetensors"):
+        weights, ranks, target = load_safeloras(path, device)["adapter"]
+        return [weight.data for weight in weights]
+    return [weight.to(device) for weight in torch.load(path, map_location=device)]
+
+
+def set_lora_adapter(model, loras, target_replace_module=DINO_TARGET_REPLACE):
+    """
+    Swap the weights of the LoRA modules already injected in model, in place.
+    The base weights are neither reloaded nor copied, merged modules are unmerged and merged again.
+    loras: [up, down, up, down, ...] in the order of extract_lora_ups_down, e.g. from load_lora_adapter
+    """
+    loras = list(loras)
+    for _module, name, _child_module in _find_modules(
+        model, target_replace_module, search_class=[LoraInjectedLinear]
+    ):
+        if len(loras) < 2:
+            raise ValueError("Adapter has fewer LoRA weights than the injected model")
+        merged = _child_module.merged
+        _child_module.unmerge()
+
+        weight = _child_module.linear.weight
+        for _layer, _new_weight in (
+            (_child_module.lora_up, loras.pop(0)),
+            (_child_module.lora_down, loras.pop(0)),
+        ):
+            _new_weight = _new_weight.to(device=weight.device, dtype=weight.dtype)
+            if _layer.weight.shape == _new_weight.shape:
+                _layer.weight.data.copy_(_new_weight)
+            else:  # different rank
+                _layer.weight = nn.Parameter(
+                    _new_weight.clone(), requires_grad=_layer.weight.requires_grad
+                )
+        _child_module.r = _child_module.lora_down.weight.shape[0]
+
+        if merged:
+            _child_module.merge()
+
+    if len(loras) > 0:
+        raise ValueError("Adapter has more LoRA weights than the injected model")
+
+
 def monkeypatch_or_replace_lora(
     model,
     loras,
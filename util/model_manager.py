@@ -0,0 +1,256 @@
+"""
+Memory-budgeted model residency
+ProtoSAM keeps several large models (ALPNet with DINOv2-L, SAM vit_h, MedSAM) that may not fit in memory together.
+ModelManager tracks the resident size of the models it manages. When the budget is exceeded, the least recently
+used model is evicted: its weights are written once to offload_dir and the parameters are swapped for
+memory-mapped views of that file, so the OS can page them out. An evicted model is still callable (its weights
+are paged in from disk), calling it through the manager copies it back into memory first.
+Registered models are only built when first used, through the LazyModel standing in for them.
+
+An evicted model is restored only after room was made for it, so restoring never exceeds the budget. The size of a
+model is only known once it is built, so for a first build the budget is a soft limit: the other models are
+evicted right after the build, and the peak meanwhile is the budget plus the new model.
+
+Models managed here are used for inference only, their weights are not written back on later evictions.
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from util.checkpoint import skip_init, load_weights
+
+OFFSET_ALIGNMENT = 64  # bytes, every tensor starts aligned in the offload file
+
+
+def get_model_tensors(model):
+    """
+    Unique parameters and buffers of model
+    """
+    return list(model.parameters()) + list(model.buffers())
+
+
+def get_model_size(model):
+    """
+    Size in bytes of the parameters and buffers of model, memory-mapped or not
+    """
+    return sum(t.numel() * t.element_size() for t in get_model_tensors(model))
+
+
+def get_resident_size(model):
+    """
+    Size in bytes of the parameters and buffers of model that are not memory-mapped
+    """
+    return sum(t.numel() * t.element_size() for t in get_model_tensors(model)
+               if not getattr(t, '_offloaded', False))
+
+
+def _aligned(offset):
+    return (offset + OFFSET_ALIGNMENT - 1) // OFFSET_ALIGNMENT * OFFSET_ALIGNMENT
+
+
+def write_offload_file(tensors, path):
+    """
+    Raw bytes of tensors, one after the other at aligned offsets
+    Returns:
+        offset of each tensor in the file
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    offsets = []
+    with open(path, 'wb') as f:
+        offset = 0
+        for tensor in tensors:
+            offset = _aligned(offset)
+            f.seek(offset)
+            offsets.append(offset)
+            if tensor.numel() > 0:
+                f.write(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+            offset += tensor.numel() * tensor.element_size()
+        f.truncate(_aligned(offset))
+    return offsets
+
+
+def map_tensor(path, offset, like):
+    """
+    CPU tensor with the shape and dtype of like backed by a copy-on-write memory map of path at offset
+    """
+    n_bytes = like.numel() * like.element_size()
+    array = np.memmap(path, dtype=np.uint8, mode='c', offset=offset, shape=(n_bytes,))
+    return torch.from_numpy(array).view(like.dtype).reshape(like.shape)
+
+
+class LazyModel(nn.Module):
+    """
+    Stand-in for a model registered with a ModelManager, without weights of its own. Calling it, or reading an
+    attribute it does not have, gets the model from the manager, which builds it on first use.
+    Attributes the callers read without running the model (e.g. img_size for SAM) are passed as kwargs
+    """
+    def __init__(self, manager, name, **attributes):
+        super().__init__()
+        # follows .to() of the parent model, the device the model is built on
+        self.register_buffer('device_probe', torch.empty(0), persistent=False)
+        self.manager = manager
+        self.managed_name = name
+        for key, value in attributes.items():
+            setattr(self, key, value)
+
+    @property
+    def device(self):
+        return self.device_probe.device
+
+    def forward(self, *args, **kwargs):
+        return self.manager.get(self.managed_name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            if 'managed_name' not in self.__dict__:  # still in __init__
+                raise
+            return getattr(self.manager.get(self.managed_name), name)
+
+
+def build_with_lazy_submodule(build_fn, checkpoint, attr, manager, name, **attributes):
+    """
+    build_fn() with its weights from checkpoint, except for its attr submodule (e.g. SAM's image_encoder), which is
+    registered with manager as name. The submodule is only built, loaded from checkpoint and moved to the device of
+    the model when it is first used
+    """
+    def build_submodule():
+        with skip_init(enabled=checkpoint is not None):
+            submodule = getattr(build_fn(), attr)
+        if checkpoint is not None:
+            load_weights(submodule, checkpoint, strict=True, prefix=f'{attr}.')
+        return submodule.eval().requires_grad_(False).to(stand_in.device)
+
+    # the submodule built here is never initialised nor loaded, its memory is not committed before it is dropped
+    with skip_init(enabled=checkpoint is not None):
+        model = build_fn()
+    stand_in = manager.register(name, build_submodule, **attributes)
+    setattr(model, attr, stand_in)
+    if checkpoint is not None:
+        missing_keys, _ = load_weights(model, checkpoint, strict=False)
+        assert not missing_keys, f'{checkpoint} misses {missing_keys}'
+    return model
+
+
+class ModelManager:
+    """
+    Args:
+        budget_mb:      memory budget for the resident models in MB, None for no limit
+        offload_dir:    where the weights of evicted models are written
+    """
+    def __init__(self, budget_mb=None, offload_dir='./offload'):
+        self.budget = None if budget_mb is None else budget_mb * 1024 ** 2
+        self.offload_dir = offload_dir
+        self.builders = {}
+        self.models = {}
+        self.hooks = {}
+        self.resident = OrderedDict()  # name -> resident size in bytes, least recently used first
+        self.offloaded = {}  # name -> device the model is restored to
+        self.offload_files = {}  # name -> (path, offsets), written on the first eviction
+
+    def register(self, name, build_fn, **attributes):
+        """
+        Add a model that is only built, by build_fn(), when it is first requested with get
+        Returns:
+            LazyModel standing in for the model, attributes are set on it
+        """
+        self.builders[name] = build_fn
+        return LazyModel(self, name, **attributes)
+
+    def attach(self, name, model):
+        """
+        Manage an already built model. Calling the model marks it used and brings it back in if it was evicted
+        """
+        def pre_forward_hook(module, args):
+            self.get(name)
+
+        self.models[name] = model
+        self.hooks[name] = model.register_forward_pre_hook(pre_forward_hook)
+        self._touch(name)
+        return model
+
+    def detach(self, name):
+        """
+        Stop managing a model, it is brought back in first
+        """
+        if name in self.offloaded:
+            self.restore(name)
+        self.hooks.pop(name).remove()
+        self.resident.pop(name, None)
+        return self.models.pop(name)
+
+    def get(self, name):
+        """
+        The model, built if needed and resident in memory. Other models are evicted to respect the budget,
+        before an evicted model is restored, after a model is built (see the module docstring)
+        """
+        if name not in self.models:
+            print(f'###### Building {name} ######')
+            return self.attach(name, self.builders[name]())
+        if name in self.offloaded:
+            self.enforce_budget(keep=name, reserve=get_model_size(self.models[name]))
+            self.restore(name)
+        self._touch(name)
+        return self.models[name]
+
+    def _touch(self, name):
+        if name in self.resident:
+            self.resident.move_to_end(name)
+        else:
+            self.resident[name] = get_resident_size(self.models[name])
+        self.enforce_budget(keep=name)
+
+    def total_resident_mb(self):
+        return sum(self.resident.values()) / 1024 ** 2
+
+    def enforce_budget(self, keep=None, reserve=0):
+        """
+        Evict least recently used models until the resident ones fit in the budget, leaving reserve bytes free
+        (e.g. for a model about to be restored). keep is never evicted
+        """
+        if self.budget is None:
+            return
+        while sum(self.resident.values()) + reserve > self.budget:
+            candidates = [name for name in self.resident if name != keep]
+            if not candidates:
+                print(f'###### {keep} alone ({(self.resident.get(keep, 0) + reserve) / 1024 ** 2:.0f} MB) exceeds the memory budget '
+                      f'({self.budget / 1024 ** 2:.0f} MB) ######')
+                break
+            self.evict(candidates[0])
+
+    @torch.no_grad()
+    def evict(self, name):
+        """
+        Swap the weights of a model for memory-mapped views of its offload file
+        """
+        model = self.models[name]
+        tensors = get_model_tensors(model)
+        if name not in self.offload_files:
+            path = os.path.join(self.offload_dir, f'{name}.bin')
+            self.offload_files[name] = (path, write_offload_file(tensors, path))
+        path, offsets = self.offload_files[name]
+        self.offloaded[name] = tensors[0].device if tensors else torch.device('cpu')
+        for tensor, offset in zip(tensors, offsets):
+            if tensor.numel() > 0:
+                tensor.data = map_tensor(path, offset, tensor)
+                tensor._offloaded = True
+        self.resident.pop(name, None)
+        if self.offloaded[name].type == 'cuda':
+            torch.cuda.empty_cache()
+        print(f'###### Evicted {name} to {path}, {self.total_resident_mb():.0f} MB resident ######')
+
+    @torch.no_grad()
+    def restore(self, name):
+        """
+        Copy the memory-mapped weights of an evicted model back into memory on its original device
+        """
+        device = self.offloaded.pop(name)
+        for tensor in get_model_tensors(self.models[name]):
+            if getattr(tensor, '_offloaded', False):
+                tensor.data = tensor.data.to(device, copy=True)
+                tensor._offloaded = False
+        print(f'###### Restored {name} ######')
@@ -0,0 +1,206 @@
+"""
+ONNX export and ONNX Runtime execution of the heavy encoders for CPU inference
+FewShotSeg is exported up to its feature maps (FewShotSegEncoder), the prototype extraction and matching have
+data dependent shapes and stay in PyTorch, they are cheap compared to the ViT. SAM's ImageEncoderViT is exported
+as is, prompts are decoded by the PyTorch mask decoder (or by SamOnnxModel, see segment_anything/utils/onnx.py).
+Every export is run with ONNX Runtime on its dummy input and removed again unless it matches PyTorch.
+
+Parity test of ONNX Runtime against PyTorch on randomly initialised encoders, no checkpoint needed:
+    python -m util.onnx_utils [--skip_sam]
+fails unless the outputs agree within PARITY_RTOL / PARITY_ATOL.
+"""
+import os
+
+import torch
+import torch.nn as nn
+
+try:
+    import onnx
+
+    onnx_available = True
+except ImportError:
+    onnx_available = False
+
+try:
+    import onnxruntime
+
+    onnxruntime_available = True
+except ImportError:
+    onnxruntime_available = False
+
+# fp32 ONNX Runtime vs PyTorch: both run the same graph, only kernel choice and fusion change the rounding
+PARITY_RTOL = 1e-3
+PARITY_ATOL = 1e-4
+
+
+class FewShotSegEncoder(nn.Module):
+    """
+    FewShotSeg.get_features as a standalone module: B x 3 x H x W images -> B x C x H' x W' feature maps
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, imgs):
+        return self.model.get_features(imgs)
+
+
+def export_onnx(module, dummy_input, path, dynamic_axes, opset=17):
+    if not onnx_available:
+        raise EnvironmentError(
+            "Exporting to ONNX requires the onnx library. Please install with pip or similar."
+        )
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            dummy_input,
+            path,
+            input_names=['images'],
+            output_names=['features'],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+    print(f'###### Exported {module.__class__.__name__} to {path} ######')
+    verify_export(module, dummy_input, path)
+
+
+def verify_export(module, dummy_input, path):
+    """
+    Check the exported graph against the module on the export input, and remove it if they differ
+    so that the next load_or_export does not pick it up
+    """
+    with torch.no_grad():
+        ref = module(dummy_input)
+    try:
+        assert_parity(os.path.basename(path), ref, OrtModule(path)(dummy_input))
+    except AssertionError:
+        for fid in (path, path + '.data'):  # weights may be stored as external data next to the graph
+            if os.path.exists(fid):
+                os.remove(fid)
+        raise
+
+
+def export_fewshotseg_encoder(model, path, opset=17):
+    """
+    Export the encoder of a FewShotSeg model. The batch is dynamic, and so is the image size for DINOv2 since
+    get_features resizes its input to model.image_size. Body token dropping and compilation are not exportable
+    """
+    assert model.config.get('body_token_thresh') is None, "body token dropping has data dependent shapes"
+    batch_buckets, model.batch_buckets = model.batch_buckets, None
+    dynamic_axes = {'images': {0: 'batch'}, 'features': {0: 'batch'}}
+    if 'dino' in model.config['which_model']:
+        dynamic_axes['images'].update({2: 'height', 3: 'width'})
+    device = next(model.parameters()).device
+    dummy = torch.randn(2, 3, model.image_size, model.image_size, device=device)
+    export_onnx(FewShotSegEncoder(model).eval(), dummy, path, dynamic_axes, opset)
+    model.batch_buckets = batch_buckets
+
+
+def export_sam_image_encoder(image_encoder, path, opset=17):
+    """
+    Export SAM's ImageEncoderViT, input is the padded B x 3 x img_size x img_size image
+    """
+    device = next(image_encoder.parameters()).device
+    dummy = torch.randn(1, 3, image_encoder.img_size, image_encoder.img_size, device=device)
+    dynamic_axes = {'images': {0: 'batch'}, 'features': {0: 'batch'}}
+    export_onnx(image_encoder.eval(), dummy, path, dynamic_axes, opset)
+
+
+class OrtModule(nn.Module):
+    """
+    ONNX Runtime session behind a module interface: tensors in, tensors out on the device of the input.
+    Extra attributes the callers read from the replaced module (e.g. img_size for SAM) are passed as kwargs
+    """
+    def __init__(self, path, num_threads=None, **attributes):
+        super().__init__()
+        if not onnxruntime_available:
+            raise EnvironmentError(
+                "ONNX Runtime execution requires the onnxruntime library. Please install with pip or similar."
+            )
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        for name, value in attributes.items():
+            setattr(self, name, value)
+
+    def forward(self, x):
+        out = self.session.run(None, {self.input_name: x.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(out).to(x.device)
+
+
+def load_or_export(path, export_fn, **attributes):
+    """
+    OrtModule for path, running export_fn(path) first if the file does not exist yet
+    """
+    if not os.path.exists(path):
+        export_fn(path)
+    return OrtModule(path, **attributes)
+
+
+def check_parity(ref, out):
+    """
+    Compare the output of the ONNX Runtime path to the PyTorch reference
+    Returns:
+        max absolute difference, cosine similarity of the flattened outputs
+    """
+    ref, out = ref.float(), out.float()
+    max_diff = (ref - out).abs().max().item()
+    cos = torch.nn.functional.cosine_similarity(ref.flatten(), out.flatten(), dim=0).item()
+    return max_diff, cos
+
+
+def assert_parity(name, ref, out, rtol=PARITY_RTOL, atol=PARITY_ATOL):
+    """
+    Fail unless the ONNX Runtime output matches the PyTorch reference elementwise, |out - ref| <= atol + rtol * |ref|
+    """
+    max_diff, cos = check_parity(ref, out)
+    print(f'{name} ONNX Runtime vs PyTorch: max abs diff {max_diff:.2e}, cosine similarity {cos:.6f}')
+    assert torch.allclose(out.float(), ref.float(), rtol=rtol, atol=atol), \
+        f'{name}: ONNX Runtime output differs from PyTorch beyond rtol {rtol}, atol {atol}'
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    from models.backbone.dinov2 import build_dinov2_vitb14
+    from models.grid_proto_fewshot import FewShotSeg
+    from models.segment_anything import build_sam_vit_b
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--rtol', type=float, default=PARITY_RTOL)
+    parser.add_argument('--atol', type=float, default=PARITY_ATOL)
+    parser.add_argument('--skip_sam', action='store_true', help='only test the FewShotSeg encoder, SAM ViT-B is slow on cpu')
+    args = parser.parse_args()
+    onnx_dir = tempfile.mkdtemp()
+    torch.manual_seed(0)
+
+    ###### FewShotSeg with a randomly initialised DINOv2-B encoder ######
+    dinov2_weights = os.path.join(onnx_dir, 'dinov2_vitb14_random.pth')
+    torch.save(build_dinov2_vitb14().state_dict(), dinov2_weights)
+    cfg = {'align': False, 'debug': False, 'which_model': 'dinov2_b14', 'dinov2_weights': dinov2_weights,
+           'cls_name': 'grid_proto', 'proto_grid_size': 8, 'lora': 0}
+    alpnet = FewShotSeg(args.image_size, cfg=cfg).eval()
+    imgs = torch.randn(2, 3, args.image_size, args.image_size)
+    with torch.no_grad():
+        fts = alpnet.get_features(imgs)
+    alpnet.use_onnx_runtime(os.path.join(onnx_dir, 'fewshotseg_encoder.onnx'))
+    with torch.no_grad():
+        fts_ort = alpnet.get_features(imgs)
+    assert_parity('FewShotSeg encoder', fts, fts_ort, args.rtol, args.atol)
+
+    ###### randomly initialised SAM ViT-B image encoder ######
+    if not args.skip_sam:
+        sam_encoder = build_sam_vit_b().image_encoder.eval()
+        sam_encoder_ort = load_or_export(os.path.join(onnx_dir, 'sam_image_encoder.onnx'),
+                                         lambda path: export_sam_image_encoder(sam_encoder, path),
+                                         img_size=sam_encoder.img_size)
+        sam_input = torch.randn(1, 3, sam_encoder.img_size, sam_encoder.img_size)
+        with torch.no_grad():
+            assert_parity('SAM image encoder', sam_encoder(sam_input), sam_encoder_ort(sam_input), args.rtol, args.atol)
@@ -0,0 +1,193 @@
+"""
+Dynamic int8 quantization of the encoders for CPU inference
+The DINOv2 encoder of FewShotSeg and SAM's ImageEncoderViT are almost entirely nn.Linear matmuls,
+quantize_linear_int8 stores those weights in int8 and quantizes activations on the fly.
+
+Benchmark (latency, resident memory, Dice on a synthetic slice) with
+    python -m util.quantization [--dinov2_weights <dinov2_vitb14_pretrain.pth>] [--sam_checkpoint <sam_vit_b.pth>]
+Without checkpoints the encoders have random weights: latency and memory are representative, Dice is not.
+"""
+import ctypes
+import gc
+import io
+import multiprocessing
+import os
+import resource
+import time
+
+import torch
+import torch.nn as nn
+
+
+def quantize_linear_int8(model):
+    """
+    Dynamic int8 quantization of all nn.Linear layers of model, CPU only.
+    LoRA weights should be merged beforehand (see FewShotSeg.merge_lora)
+    """
+    model = model.cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized(model, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    torch.save(model.state_dict(), path)
+
+
+def load_quantized(float_model, path):
+    """
+    Rebuild a model saved with save_quantized: quantize a freshly built float model of the same architecture,
+    then load the int8 weights into it
+    """
+    model = quantize_linear_int8(float_model)
+    model.load_state_dict(torch.load(path, map_location='cpu'))
+    return model
+
+
+def get_model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1024 ** 2
+
+
+def get_rss_mb():
+    """
+    Resident set size of this process (Linux)
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+
+def release_free_memory():
+    """
+    Return the free heap pages to the OS (glibc), so that RSS only counts memory in use
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _rss_worker(build_fn, run_fn, queue):
+    # the forked process starts with the parent's freed heap, which it would reuse without growing its RSS
+    release_free_memory()
+    base = get_rss_mb()
+    model = build_fn()
+    with torch.no_grad():
+        run_fn(model)
+    release_free_memory()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+    queue.put((get_rss_mb() - base, peak - base))
+
+
+def measure_rss(build_fn, run_fn):
+    """
+    Memory cost of a model: build_fn() then run_fn(model) once in a forked process, so that models measured
+    one after another do not reuse each other's freed memory
+    Returns:
+        RSS increase once built and run (weights, kept buffers), peak RSS increase (MB)
+    """
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_rss_worker, args=(build_fn, run_fn, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+@torch.no_grad()
+def measure_latency(fn, n_warmup=2, n_runs=10):
+    """
+    Average wall time of fn() in seconds
+    """
+    for _ in range(n_warmup):
+        fn()
+    start = time.time()
+    for _ in range(n_runs):
+        fn()
+    return (time.time() - start) / n_runs
+
+
+def get_synthetic_slice(image_size, center, radius):
+    """
+    A bright body disc with a textured ellipse ('organ') inside, 3 x H x W image and H x W organ mask
+    """
+    yy, xx = torch.meshgrid(torch.arange(image_size, dtype=torch.float32),
+                            torch.arange(image_size, dtype=torch.float32), indexing='ij')
+    body = ((yy - image_size / 2) ** 2 + (xx - image_size / 2) ** 2) < (0.45 * image_size) ** 2
+    organ = ((yy - center[0]) / radius[0]) ** 2 + ((xx - center[1]) / radius[1]) ** 2 < 1
+    img = body.float() * 0.3 + organ.float() * (0.5 + 0.1 * torch.sin(xx / 3) * torch.cos(yy / 3))
+    img = img + 0.02 * torch.randn_like(img)
+    return img[None].repeat(3, 1, 1), organ.float()
+
+
+def dice(pred, gt):
+    return (2 * (pred * gt).sum() / (pred.sum() + gt.sum() + 1e-5)).item()
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    from models.backbone.dinov2 import build_dinov2_vitb14
+    from models.grid_proto_fewshot import FewShotSeg
+    from models.segment_anything import build_sam_vit_b
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dinov2_weights', default=None, help='local dinov2_vitb14 checkpoint, random weights if not given')
+    parser.add_argument('--sam_checkpoint', default=None, help='SAM vit_b checkpoint, random weights if not given')
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--n_runs', type=int, default=5)
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    dinov2_weights = args.dinov2_weights
+    if dinov2_weights is None:
+        # every FewShotSeg built below loads the same random encoder
+        dinov2_weights = os.path.join(tempfile.mkdtemp(), 'dinov2_vitb14_random.pth')
+        torch.save(build_dinov2_vitb14().state_dict(), dinov2_weights)
+
+    ###### ALPNet with DINOv2-B encoder ######
+    cfg = {'align': False, 'debug': False, 'which_model': 'dinov2_b14', 'dinov2_weights': dinov2_weights,
+           'cls_name': 'grid_proto', 'proto_grid_size': 8, 'lora': 0}
+
+    def build_alpnet(int8):
+        model = FewShotSeg(args.image_size, cfg=dict(cfg)).eval()
+        if int8:
+            model.quantize_int8()
+        return model
+
+    supp_img, supp_lb = get_synthetic_slice(args.image_size, (0.45 * args.image_size, 0.4 * args.image_size), (30, 40))
+    qry_img, qry_lb = get_synthetic_slice(args.image_size, (0.5 * args.image_size, 0.45 * args.image_size), (32, 38))
+    inputs = ([[supp_img[None]]], [[supp_lb[None]]], [[1 - supp_lb[None]]], [qry_img[None]], True, 2)
+
+    results = {}
+    for name in ['fp32', 'int8']:
+        rss, peak_rss = measure_rss(lambda: build_alpnet(name == 'int8'), lambda model: model(*inputs))
+        model = build_alpnet(name == 'int8')
+        with torch.no_grad():
+            pred = model(*inputs)[0].argmax(dim=1)[0].float()
+        results[name] = pred
+        latency = measure_latency(lambda: model(*inputs), n_runs=args.n_runs)
+        print(f'ALPNet {name}: {latency * 1000:.1f} ms/slice, RSS {rss:.0f} MB (peak {peak_rss:.0f} MB), '
+              f'Dice vs gt {dice(pred, qry_lb):.4f}')
+        del model
+    print(f'ALPNet int8 vs fp32 prediction Dice: {dice(results["int8"], results["fp32"]):.4f}')
+
+    ###### SAM ViT-B image encoder ######
+    def build_sam_encoder(int8):
+        torch.manual_seed(0)
+        model = build_sam_vit_b(checkpoint=args.sam_checkpoint).image_encoder.cpu().eval()
+        return quantize_linear_int8(model) if int8 else model
+
+    sam_input = torch.randn(1, 3, 1024, 1024)
+    embeddings = {}
+    for name in ['fp32', 'int8']:
+        rss, peak_rss = measure_rss(lambda: build_sam_encoder(name == 'int8'), lambda model: model(sam_input))
+        model = build_sam_encoder(name == 'int8')
+        with torch.no_grad():
+            embeddings[name] = model(sam_input)
+        latency = measure_latency(lambda: model(sam_input), n_warmup=1, n_runs=max(1, args.n_runs // 2))
+        print(f'SAM encoder {name}: {latency * 1000:.1f} ms/image, RSS {rss:.0f} MB (peak {peak_rss:.0f} MB)')
+        del model
+    cos = torch.nn.functional.cosine_similarity(embeddings['fp32'].flatten(1), embeddings['int8'].flatten(1)).item()
+    print(f'SAM encoder int8 vs fp32 embedding cosine similarity: {cos:.4f}')
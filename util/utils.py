@@ -3,6 +3,7 @@ Extended from original PANet code
 TODO: move part of dataset configurations to data_utils
 """
 import random
+import contextlib
 import torch
 import numpy as np
 import operator
@@ -548,6 +549,23 @@ def set_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
 
+AUTOCAST_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def get_autocast(device, precision='fp32'):
+    """
+    Autocast context for reduced precision inference on any device.
+    precision: 'fp32' (no autocast), 'bf16' or 'fp16'. fp16 falls back to bf16 on cpu
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision not in AUTOCAST_DTYPES:
+        raise ValueError(f"precision must be one of fp32, {', '.join(AUTOCAST_DTYPES)}, got {precision}")
+    device_type = torch.device(device).type
+    dtype = AUTOCAST_DTYPES[precision]
+    if device_type == 'cpu' and dtype == torch.float16:
+        dtype = torch.bfloat16
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
 CLASS_LABELS = {
     'SABS': {
         'pa_all': set( [1,2,3,6]  ),
@@ -3,6 +3,7 @@ Validation script
 """
 import os
 import shutil
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -97,6 +98,24 @@ def test_time_training(_config, model, image, prediction):
     return model
 
 
+def predict_query_logits(_config, model, sup_img_part, sup_fgm_part, sup_bgm_part, query_images):
+    """
+    Coarse query logits. If _config["coarse_resolutions"] is set, multi-scale prediction: the logits of the query
+    at each of these resolutions are averaged (see FewShotSeg.forward_resolutions)
+    """
+    with torch.no_grad():
+        if _config["coarse_resolutions"]:
+            return model.forward_resolutions(_config["coarse_resolutions"], sup_img_part, sup_fgm_part, sup_bgm_part,
+                                             query_images, isval=True, val_wsize=_config["val_wsize"])
+        return model(sup_img_part, sup_fgm_part, sup_bgm_part,
+                     query_images, isval=True, val_wsize=_config["val_wsize"])[0]
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
 @ex.automain
 def main(_run, _config, _log):
     if _run.observers:
@@ -107,15 +126,32 @@ def main(_run, _config, _log):
             _run.observers[0].save_file(source_file, f'source/{source_file}')
         shutil.rmtree(f'{_run.observers[0].basedir}/_sources')
 
-    torch.cuda.set_device(device=_config['gpu_id'])
+    # the int8 encoder only runs on cpu
+    device = torch.device("cpu") if _config['int8_encoders'] else torch.device("cuda")
+    if device.type == "cuda":
+        torch.cuda.set_device(device=_config['gpu_id'])
     torch.set_num_threads(1)
 
     _log.info(f'###### Reload model {_config["reload_model_path"]} ######')
     model = FewShotSeg(image_size=_config['input_size'][0],
                            pretrained_path=_config['reload_model_path'], cfg=_config['model'])
 
-    model = model.cuda()
+    model = model.to(device)
     model.eval()
+    if _config['merge_lora'] and not _config['ttt']:
+        model.merge_lora()
+    if _config['int8_encoders']:
+        assert not _config['ttt'], "the int8 encoder cannot be finetuned, int8_encoders does not go with ttt"
+        model.quantize_int8(os.path.join(_config['int8_dir'], 'fewshotseg_encoder_int8.pt') if _config['int8_dir'] else None)
+    if _config['torch_compile'] and not _config['ttt']:
+        model.compile_for_inference()
+    native_tokens = _config['model']['native_tokens']
+    if _config["compare_native_tokens"]:
+        # build (and compile) the classifier of the other setting once, the loop then only switches between the two
+        model.set_native_tokens(not native_tokens)
+        if _config['torch_compile'] and not _config['ttt']:
+            model.warmup()
+        model.set_native_tokens(native_tokens)
 
     _log.info('###### Load data ######')
     # Training set
@@ -162,6 +198,8 @@ def main(_run, _config, _log):
             fix_length=_config["max_iters_per_load"] if (data_name == 'C0_Superpix') or (
                 data_name == 'CHAOST2_Superpix') else None,
             use_clahe=_config['use_clahe'],
+            read_workers=_config['dataset_read_workers'],
+            img_dtype=_config['dataset_img_dtype'],
             norm_mean=0.18792 * 256 if baseset_name == 'LITS17' else None,
             norm_std=0.25886 * 256 if baseset_name == 'LITS17' else None
         )
@@ -180,7 +218,11 @@ def main(_run, _config, _log):
         extern_normalize_func=norm_func,
         image_size=_config["input_size"][0],
         use_clahe=_config['use_clahe'],
-        use_3_slices=_config["use_3_slices"]
+        use_3_slices=_config["use_3_slices"],
+        cache_dir=_config["dataset_cache_dir"],
+        read_workers=_config["dataset_read_workers"],
+        img_dtype=_config["dataset_img_dtype"],
+        lazy_scans=_config["dataset_lazy_scans"],
     )
 
     # dataloaders
@@ -196,6 +238,12 @@ def main(_run, _config, _log):
     _log.info('###### Set validation nodes ######')
     mar_val_metric_node = Metric(max_label=max_label, n_scans=len(
         te_dataset.dataset.pid_curr_load) - _config['task']['n_shots'])
+    if _config["compare_native_tokens"]:
+        # same evaluation with the other native_tokens setting, reported side by side
+        cmp_val_metric_node = Metric(max_label=max_label, n_scans=len(
+            te_dataset.dataset.pid_curr_load) - _config['task']['n_shots'])
+        cmp_val_metric_node.reset()
+        inference_time = {native_tokens: 0.0, not native_tokens: 0.0}
 
     _log.info('###### Starting validation ######')
     mar_val_metric_node.reset()
@@ -210,12 +258,12 @@ def main(_run, _config, _log):
                                                 curr_lb], scan_idx=_config["support_idx"], npart=_config['task']['npart'])
 
         # way(1 for now) x part x shot x 3 x H x W] #
-        support_images = [[shot.cuda() for shot in way]
+        support_images = [[shot.to(device) for shot in way]
                             for way in support_batched['support_images']]  # way x part x [shot x C x H x W]
         suffix = 'mask'
-        support_fg_mask = [[shot[f'fg_{suffix}'].float().cuda() for shot in way]
+        support_fg_mask = [[shot[f'fg_{suffix}'].float().to(device) for shot in way]
                             for way in support_batched['support_mask']]
-        support_bg_mask = [[shot[f'bg_{suffix}'].float().cuda() for shot in way]
+        support_bg_mask = [[shot[f'bg_{suffix}'].float().to(device) for shot in way]
                             for way in support_batched['support_mask']]
 
         curr_scan_count = -1  # counting for current scan
@@ -247,9 +295,9 @@ def main(_run, _config, _log):
 
             # the chunck of query, for assignment with support
             q_part = sample_batched["part_assign"]
-            query_images = [sample_batched['image'].cuda()]
+            query_images = [sample_batched['image'].to(device)]
             query_labels = torch.cat(
-                [sample_batched['label'].cuda()], dim=0)
+                [sample_batched['label'].to(device)], dim=0)
             if 1 not in query_labels and not sample_batched["is_end"] and _config["skip_no_organ_slices"]:
                 ii += 1
                 continue
@@ -264,18 +312,19 @@ def main(_run, _config, _log):
 
             # query_pred_logits, _, _, assign_mats, proto_grid, _, _ = model(
             #     sup_img_part, sup_fgm_part, sup_bgm_part, query_images, isval=True, val_wsize=_config["val_wsize"], show_viz=True)
-            with torch.no_grad():
-                out = model(sup_img_part, sup_fgm_part, sup_bgm_part,
-                        query_images, isval=True, val_wsize=_config["val_wsize"])
-            query_pred_logits, _, _, assign_mats, proto_grid, _, _ = out
+            if _config["compare_native_tokens"]:
+                synchronize(device)
+                start_time = time.time()
+            query_pred_logits = predict_query_logits(_config, model, sup_img_part, sup_fgm_part, sup_bgm_part, query_images)
             pred = np.array(query_pred_logits.argmax(dim=1)[0].cpu())
+
+            if _config["compare_native_tokens"]:
+                inference_time[native_tokens] += time.time() - start_time
                 
             if _config["ttt"]: 
                 state_dict = model.state_dict()
                 model = test_time_training(_config, model, sample_batched['image'].numpy()[0], pred)
-                out = model(sup_img_part, sup_fgm_part, sup_bgm_part,
-                        query_images, isval=True, val_wsize=_config["val_wsize"])
-                query_pred_logits, _, _, assign_mats, proto_grid, _, _ = out
+                query_pred_logits = predict_query_logits(_config, model, sup_img_part, sup_fgm_part, sup_bgm_part, query_images)
                 pred = np.array(query_pred_logits.argmax(dim=1)[0].cpu())
                 if _config["reset_after_slice"]:
                     model.load_state_dict(state_dict)
@@ -294,6 +343,28 @@ def main(_run, _config, _log):
                     save_pred_gt_fig(query_images, query_pred, query_labels,
                                         f'debug/scan_{_scan_id}_label_{curr_lb}_{idx}_gt_vs_pred_after_cca.png')
 
+            if _config["compare_native_tokens"]:
+                # same slice with the other setting, with the same post-processing. Both classifiers are built once
+                # before the loop, switching does not rebuild (nor recompile) them
+                model.set_native_tokens(not native_tokens)
+                synchronize(device)
+                start_time = time.time()
+                cmp_pred_logits = predict_query_logits(_config, model, sup_img_part, sup_fgm_part, sup_bgm_part, query_images)
+                synchronize(device)
+                inference_time[not native_tokens] += time.time() - start_time
+                if _config["ttt"]:
+                    # the comparison must not change the weights of the evaluated model
+                    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+                    model = test_time_training(_config, model, sample_batched['image'].numpy()[0], np.array(cmp_pred_logits.argmax(dim=1)[0].cpu()))
+                    cmp_pred_logits = predict_query_logits(_config, model, sup_img_part, sup_fgm_part, sup_bgm_part, query_images)
+                    model.load_state_dict(state_dict)
+                model.set_native_tokens(native_tokens)
+                cmp_pred = cmp_pred_logits.argmax(dim=1).cpu()
+                cmp_pred = F.interpolate(cmp_pred.unsqueeze(
+                    0).float(), size=query_labels.shape[-2:], mode='nearest').squeeze(0).long().numpy()[0]
+                if _config['do_cca']:
+                    cmp_pred = cca(cmp_pred, cmp_pred_logits)
+
             _pred[..., ii] = query_pred.copy()
             # _vis['assigned_proto'][ii] = assign_mats
             # _vis['proto_grid'][ii] = proto_grid.cpu()
@@ -303,6 +374,9 @@ def main(_run, _config, _log):
             if (sample_batched["z_id"] - sample_batched["z_max"] <= _config['z_margin']) and (sample_batched["z_id"] - sample_batched["z_min"] >= -1 * _config['z_margin']) and not sample_batched["is_end"]:
                 mar_val_metric_node.record(query_pred, np.array(
                     query_labels[0].cpu()), labels=[curr_lb], n_scan=curr_scan_count)
+                if _config["compare_native_tokens"]:
+                    cmp_val_metric_node.record(cmp_pred, np.array(
+                        query_labels[0].cpu()), labels=[curr_lb], n_scan=curr_scan_count)
             else:
                 pass
 
@@ -339,6 +413,16 @@ def main(_run, _config, _log):
 
     mar_val_metric_node.reset()  # reset this calculation node
 
+    if _config["compare_native_tokens"]:
+        c_classDice, _, c_meanDice, _, _ = cmp_val_metric_node.get_mDice(
+            labels=sorted(test_labels), n_scan=None, give_raw=True)
+        cmp_val_metric_node.reset()
+        _run.log_scalar('cmp_native_tokens_classDice', c_classDice.tolist())
+        _run.log_scalar('cmp_native_tokens_meanDice', c_meanDice.tolist())
+        for _native, _classDice, _meanDice in [(native_tokens, m_classDice, m_meanDice), (not native_tokens, c_classDice, c_meanDice)]:
+            _log.info(
+                f'native_tokens={_native}: classDice {_classDice}, meanDice {_meanDice}, inference time {inference_time[_native]:.1f}s')
+
     # write validation result to log file
     _run.log_scalar('mar_val_batches_classDice', m_classDice.tolist())
     _run.log_scalar('mar_val_batches_meanDice', m_meanDice.tolist())
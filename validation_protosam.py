@@ -21,6 +21,7 @@ from models.ProtoMedSAM import ProtoMedSAM
 from models.grid_proto_fewshot import FewShotSeg
 from models.segment_anything.utils.transforms import ResizeLongestSide
 from models.SamWrapper import SamWrapper
+from util.model_manager import ModelManager
 # from dataloaders.PolypDataset import get_polyp_dataset, get_vps_easy_unseen_dataset, get_vps_hard_unseen_dataset, PolypDataset, KVASIR, CVC300, COLON_DB, ETIS_DB, CLINIC_DB
 from dataloaders.PolypDataset import get_polyp_dataset, PolypDataset
 from dataloaders.PolypTransforms import get_polyp_transform
@@ -346,13 +347,20 @@ def get_dice_iou_precision_recall(pred: torch.Tensor, gt: torch.Tensor):
     return {"dice": dice, "iou": iou, "precision": precision, "recall": recall}
 
 
+def get_device(_config):
+    # the int8 encoders only run on cpu
+    return torch.device("cpu") if _config["int8_encoders"] else torch.device("cuda")
+
+
 def get_alpnet_model(_config) -> ModelWrapper:
     alpnet = FewShotSeg(
        _config["input_size"][0],
        _config["reload_model_path"],
        _config["model"]
     )
-    alpnet.cuda()
+    alpnet.to(get_device(_config))
+    if _config["merge_lora"]:
+        alpnet.merge_lora()
     alpnet_wrapper = ALPNetWrapper(alpnet)
     
     return alpnet_wrapper
@@ -366,10 +374,16 @@ def get_sam_model(_config) -> ModelWrapper:
     sam_wrapper = SamWrapperWrapper(sam)
     return sam_wrapper  
 
-def get_model(_config) -> ProtoSAM:
+def get_model(_config, model_manager=None) -> ProtoSAM:
+    """
+    With a model_manager, ALPNet and the SAM image encoder are registered with it and only built when first used
+    """
     # Initial Segmentation Model
     if _config["base_model"] == TYPE_ALPNET:
-        base_model = get_alpnet_model(_config)
+        if model_manager is None:
+            base_model = get_alpnet_model(_config)
+        else:
+            base_model = ALPNetWrapper(model_manager.register("alpnet", lambda: get_alpnet_model(_config).model))
     else:
         raise NotImplementedError(f"base model {_config['base_model']} not implemented")
     
@@ -390,12 +404,18 @@ def get_model(_config) -> ProtoSAM:
                     use_sam_trans=True, 
                     coarse_pred_only=_config["coarse_pred_only"],
                     sam_pretrained_path=sam_checkpoint,
-                    use_neg_points=_config["use_neg_points"],) 
+                    use_neg_points=_config["use_neg_points"],
+                    precision=_config["precision"],
+                    roi_size=_config["sam_roi_size"],
+                    roi_margin=_config["sam_roi_margin"],
+                    model_manager=model_manager,) 
     elif _config["protosam_sam_ver"] == "medsam":
         model = ProtoMedSAM(image_size = (1024, 1024),
                             coarse_segmentation_model=base_model,
                             debug=_config["debug"],
                             use_cca=_config["do_cca"],
+                            precision=_config["precision"],
+                            model_manager=model_manager,
         )
     else:
         raise NotImplementedError(f"protosam_sam_ver {_config['protosam_sam_ver']} not implemented")
@@ -403,6 +423,34 @@ def get_model(_config) -> ProtoSAM:
     return model
 
 
+def quantize_model_int8(_config, model):
+    """
+    Dynamic int8 quantization of the ALPNet encoder and of the SAM image encoder, saved to / loaded from int8_dir
+    """
+    assert _config["onnx_dir"] is None, "onnx_dir and int8_encoders both replace the encoders, use one of them"
+    assert _config["precision"] == "fp32", "the int8 encoders take fp32 activations, use precision fp32"
+    int8_dir = _config["int8_dir"]
+    if isinstance(model.coarse_segmentation_model, ALPNetWrapper):
+        model.coarse_segmentation_model.model.quantize_int8(
+            os.path.join(int8_dir, 'fewshotseg_encoder_int8.pt') if int8_dir else None)
+    if isinstance(model, ProtoSAM):
+        model.quantize_sam_encoder_int8(os.path.join(int8_dir, 'sam_image_encoder_int8.pt') if int8_dir else None)
+    else:
+        print('###### int8_encoders: the MedSAM image encoder stays in fp32 ######')
+
+
+def get_model_manager(_config) -> ModelManager:
+    """
+    With model_memory_budget_mb, ALPNet and the SAM image encoder are built on first use and kept within the budget:
+    the least recently used one is evicted to memory-mapped weights in offload_dir and brought back in when it is called
+    """
+    if not _config["model_memory_budget_mb"]:
+        return None
+    assert not (_config["onnx_dir"] or _config["torch_compile"] or _config["int8_encoders"]), \
+        "model_memory_budget_mb manages the PyTorch encoders, it does not go with onnx_dir, torch_compile or int8_encoders"
+    return ModelManager(_config["model_memory_budget_mb"], _config["offload_dir"])
+
+
 def get_support_set_polyps(_config, dataset:PolypDataset):
     n_support = _config["n_support"]
     (support_images, support_labels, case) = dataset.get_support(n_support=n_support)
@@ -456,14 +504,25 @@ def main(_run, _config, _log):
     print(f"config do_cca: {_config['do_cca']}, use_bbox: {_config['use_bbox']}")
     cudnn.enabled = True
     cudnn.benchmark = True
-    torch.cuda.set_device(device=_config['gpu_id'])
+    device = get_device(_config)
+    if device.type == "cuda":
+        torch.cuda.set_device(device=_config['gpu_id'])
     torch.set_num_threads(1)
 
     _log.info(f'###### Reload model {_config["reload_model_path"]} ######')
     print(f'###### Reload model {_config["reload_model_path"]} ######')
-    model = get_model(_config)
-    model = model.to(torch.device("cuda"))
+    model_manager = get_model_manager(_config)
+    model = get_model(_config, model_manager)
+    model = model.to(device)
     model.eval()
+    if _config["int8_encoders"]:
+        quantize_model_int8(_config, model)
+    assert not (_config["onnx_dir"] and _config["torch_compile"]), \
+        "onnx_dir runs the encoders with ONNX Runtime, there is nothing left for torch_compile to compile, use one of them"
+    if _config["onnx_dir"]:
+        model.use_onnx_runtime(_config["onnx_dir"])
+    if _config["torch_compile"]:
+        model.compile_for_inference()
     
     sam_trans = ResizeLongestSide(1024)
     if _config["dataset"].lower() == POLYPS:
@@ -526,7 +585,7 @@ def main(_run, _config, _log):
             if is_alp_ds and sample_batched["scan_id"][0] in support_scan_id:
                 continue
              
-            query_images = sample_batched['image'].cuda()
+            query_images = sample_batched['image'].to(device)
             query_labels = torch.cat([sample_batched['label']], dim=0)
             if not 1 in query_labels and _config["skip_no_organ_slices"]:
                 continue
@@ -544,7 +603,7 @@ def main(_run, _config, _log):
                                         img_sz=query_images.shape[-2:],
                                         gts=query_labels,
                 )
-                coarse_model_input.to(torch.device("cuda"))
+                coarse_model_input.to(device)
                     
                 query_pred, scores = model(
                         query_images, coarse_model_input, degrees_rotate=0)